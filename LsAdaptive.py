@@ -0,0 +1,122 @@
+'''Adaptive number of subjects.
+
+A run with the @run property 'target_se' simulates subjects in batches of 'subjects' (the
+parameter) until the standard error of the averages that the post commands evaluate is at most
+target_se, or 'max_subjects' subjects are simulated. The averages are the evaluations of the
+plot and export commands with 'subject':'average' for the run. The standard error applies to
+the points of their curves in the @run property 'se_at' (indices into the curves), or to all
+points reached by at least two subjects.
+
+Each finished subject's curves are added to running sums, so the stopping rule does not keep
+per-subject curves. The subjects themselves are kept for the post commands as usual.
+'''
+import LsOutput
+from LsSimulation import RunGroup, run_parallel
+from LsConstants import *
+
+import math
+import random
+
+DEFAULT_MAX_SUBJECTS = 1000
+
+
+class Target():
+
+    '''The target standard error of a run, and the averaged quantities it applies to.'''
+
+    def __init__(self, target_se, max_subjects=DEFAULT_MAX_SUBJECTS, se_at=None):
+        self.target_se = target_se
+        self.max_subjects = max_subjects
+
+        # Indices into the averaged curves, or None for all points
+        self.se_at = se_at
+
+        # A list of (vwpn, expression, evaluation properties) of the averaged evaluations
+        self.quantities = list()
+
+
+class RunningStats():
+
+    '''Running mean and variance, point by point, of curves of different lengths (Welford's
+       algorithm).'''
+
+    def __init__(self):
+        self.n = list()
+        self.mean = list()
+        self.m2 = list()
+
+    def add(self, curve):
+        n, mean, m2 = self.n, self.mean, self.m2
+        if len(curve) > len(n):
+            extension = [0] * (len(curve) - len(n))
+            n.extend(extension)
+            mean.extend(extension)
+            m2.extend(extension)
+        for i, value in enumerate(curve):
+            n[i] += 1
+            delta = value - mean[i]
+            mean[i] += delta / n[i]
+            m2[i] += delta * (value - mean[i])
+
+    def se(self, points=None):
+        '''The largest standard error of the mean at the indices points, or at all points
+           reached by at least two curves if points is None. Infinite if a point in points is
+           reached by less than two curves.'''
+        n = self.n
+        if points is None:
+            points = [i for i in range(len(n)) if n[i] >= 2]
+        se = -math.inf
+        for i in points:
+            if i >= len(n) or n[i] < 2:
+                return math.inf
+            se = max(se, math.sqrt(self.m2[i] / (n[i] - 1) / n[i]))
+        if se < 0:
+            return math.inf
+        return se
+
+
+def run(script_run, jobs=1, seed=None, progress=None, spill=None):
+    '''Simulates subjects of the ScriptRun object script_run in batches until its target is
+       met, in parallel as in LsSimulation.run_parallel if jobs is not 1. Returns a RunOutput
+       object whose precision is a dict with the achieved standard error 'se', 'target_se',
+       the number of subjects 'n_subjects', 'max_subjects' and whether the target was met
+       ('converged').'''
+    target = script_run.target
+    out = LsOutput.RunOutput(0, script_run.mechanism_obj.stimulus_req)
+    script_output = LsOutput.ScriptOutput({script_run.runlabel: out})
+    quantities = list()
+    for vwpn, expr, eval_prop in target.quantities:
+        evalprops = dict(eval_prop)
+        evalprops[EVAL_SUBJECT] = EVAL_AVERAGE
+        evalprops[EVAL_RUNLABEL] = script_run.runlabel
+        quantities.append((vwpn, expr, script_output._evalparse(evalprops), RunningStats()))
+    if jobs != 1 and seed is None:
+        seed = random.getrandbits(64)  # The same for all batches
+
+    batch_size = max(script_run.n_subjects, 1)
+    se = math.inf
+    while out.n_subjects < target.max_subjects:
+        batch = range(out.n_subjects, min(out.n_subjects + batch_size, target.max_subjects))
+        if jobs != 1:
+            batch_outputs = run_parallel([RunGroup([script_run])], jobs, seed, progress, spill,
+                                         batch)
+            if len(batch_outputs) == 0:
+                break  # Cancelled
+            batch_output = batch_outputs[0]
+        else:
+            batch_output = script_run.run(progress, batch, seed, spill)
+
+        for output_subject in batch_output.output_subjects:
+            for vwpn, expr, evalprops, stats in quantities:
+                stats.add(output_subject.vwpn_eval(vwpn, expr, evalprops))
+        out.output_subjects.extend(batch_output.output_subjects)
+        out.n_subjects = len(out.output_subjects)
+        se = max(stats.se(target.se_at) for _, _, _, stats in quantities)
+        if se <= target.target_se or (progress is not None and progress.cancelled):
+            break
+
+    if progress is not None:
+        progress.n_subjects -= target.max_subjects - out.n_subjects
+    out.precision = {'se': se, 'target_se': target.target_se, 'n_subjects': out.n_subjects,
+                     'max_subjects': target.max_subjects, 'converged': se <= target.target_se}
+    return out
@@ -0,0 +1,238 @@
+import LsScript
+
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+# Names of the benchmark workloads, in the order they are run
+GA = "ga"
+RESCORLA_WAGNER = "rescorla_wagner"
+Q_LEARNING = "q_learning"
+EXP_SARSA = "exp_sarsa"
+ACTOR_CRITIC = "actor_critic"
+LARGE_SETS = "large_sets"
+PROBABILISTIC = "probabilistic"
+POSTPROCESSING = "postprocessing"
+
+ALL_WORKLOADS = [GA, RESCORLA_WAGNER, Q_LEARNING, EXP_SARSA, ACTOR_CRITIC,
+                 LARGE_SETS, PROBABILISTIC, POSTPROCESSING]
+
+
+def small_sets_script(mechanism, n_rewards, n_subjects=1):
+    '''A chaining experiment with a small behavior and stimulus element set.'''
+    return '''
+    @parameters
+    {{
+    'subjects'          : {subjects},
+    'mechanism'         : '{mechanism}',
+    'behaviors'         : ['R0','R1','R2'],
+    'stimulus_elements' : ['S1','S2','reward','new trial'],
+    'start_v'           : {{'default':-1}},
+    'alpha_v'           : 0.1,
+    'alpha_w'           : 0.1,
+    'beta'              : 1,
+    'behavior_cost'     : {{'R1':1, 'R2':1, 'default':0}},
+    'u'                 : {{'reward':10, 'default': 0}},
+    'omit_learning'     : ['new trial']
+    }}
+
+    @phase {{'label':'chaining', 'end':'reward={rewards}'}}
+    NEW_TRIAL   'new trial'  | STIMULUS_1
+    STIMULUS_1  'S1'         | R1: STIMULUS_2 | NEW_TRIAL
+    STIMULUS_2  'S2'         | R2: REWARD     | NEW_TRIAL
+    REWARD      'reward'     | NEW_TRIAL
+
+    @run {{'label':'{mechanism}'}}
+    '''.format(mechanism=mechanism, rewards=n_rewards, subjects=n_subjects)
+
+
+def large_sets_script(n_rewards, n_lines=20, n_behaviors=30):
+    '''A world with many stimulus elements and behaviors, presented as compound stimuli.'''
+    elements = ["E{}".format(i) for i in range(3 * n_lines)] + ['reward', 'new trial']
+    behaviors = ["B{}".format(i) for i in range(n_behaviors)]
+    lines = list()
+    for i in range(n_lines):
+        stimulus = "('E{0}','E{1}','E{2}')".format(i, i + n_lines, i + 2 * n_lines)
+        next_line = "L{}".format((i + 1) % n_lines)
+        lines.append("L{0} {1} | B{2}: REWARD | {3}".format(i, stimulus, i % n_behaviors,
+                                                            next_line))
+    lines.append("REWARD 'reward' | NEW_TRIAL")
+    lines.append("NEW_TRIAL 'new trial' | L0")
+    return '''
+    @parameters
+    {{
+    'mechanism'         : 'ga',
+    'behaviors'         : {behaviors},
+    'stimulus_elements' : {elements},
+    'start_v'           : {{'default':0}},
+    'alpha_v'           : 0.1,
+    'alpha_w'           : 0.1,
+    'u'                 : {{'reward':10, 'default': 0}},
+    'omit_learning'     : ['new trial']
+    }}
+
+    @phase {{'label':'large', 'end':'reward={rewards}'}}
+    {lines}
+
+    @run {{'label':'large'}}
+    '''.format(behaviors=behaviors, elements=elements, rewards=n_rewards,
+               lines="\n".join(lines))
+
+
+def probabilistic_script(n_rewards):
+    '''A world where most phase lines branch with probabilities.'''
+    return '''
+    @parameters
+    {{
+    'mechanism'         : 'ga',
+    'behaviors'         : ['R0','R1','R2'],
+    'stimulus_elements' : ['A','B','C','reward','new trial'],
+    'start_v'           : {{'default':0}},
+    'alpha_v'           : 0.1,
+    'alpha_w'           : 0.1,
+    'u'                 : {{'reward':10, 'default': 0}}
+    }}
+
+    @phase {{'label':'probabilistic', 'end':'reward={rewards}'}}
+    NEW_TRIAL  'new trial'  | LINE_A(0.3),LINE_B(0.3),LINE_C(0.4)
+    LINE_A     'A'          | R1: REWARD(0.5),NEW_TRIAL(0.5) | LINE_B(0.2),LINE_C(0.2) | NEW_TRIAL
+    LINE_B     'B'          | R2: REWARD(0.7) | LINE_A(0.5),NEW_TRIAL(0.5)
+    LINE_C     'C'          | 3: NEW_TRIAL | R0: LINE_A(0.1),LINE_B(0.1) | LINE_C
+    REWARD     'reward'     | NEW_TRIAL
+
+    @run {{'label':'probabilistic'}}
+    '''.format(rewards=n_rewards)
+
+
+def postprocessing_script(n_rewards, n_subjects=5):
+    '''The chaining experiment followed by many steps- and phase-filtered @nplot and @pplot.'''
+    script = small_sets_script('ga', n_rewards, n_subjects)
+    script = script.replace("@run {'label':'ga'}", '''
+    @phase {'label':'extinction', 'end':'new trial=50'}
+    NEW_TRIAL   'new trial'  | STIMULUS_1
+    STIMULUS_1  'S1'         | R1: STIMULUS_2 | NEW_TRIAL
+    STIMULUS_2  'S2'         | NEW_TRIAL
+
+    @run {'label':'ga'}''')
+    postcmds = '''
+    @figure 'n'
+    @nplot 'R1'                     {'cumulative':'on'}
+    @nplot ['S1','R1']              {'cumulative':'on'}
+    @nplot ['S1','R1'] 'S1'         {'steps':'new trial'}
+    @nplot ['S2','R2']              {'steps':'new trial', 'cumulative':'on'}
+    @nplot ['S1','R1','S2']         {'phase':'chaining'}
+    @nplot 'reward'                 {'subject':'all', 'cumulative':'on'}
+
+    @figure 'p'
+    @pplot ('S1','R1')              {'steps':'S1'}
+    @pplot (('S1','S2'),'R2')       {'steps':['S1','R1','S2']}
+    @pplot ('S1','R0')              {'phase':'extinction'}
+    @pplot ('S2','R2')              {'subject':'all'}
+    '''
+    return script + postcmds
+
+
+def workload_script(name, scale=1):
+    '''Returns the script text of the specified workload, scaled by the factor scale.'''
+    n_rewards = max(1, int(2000 * scale))
+    if name in (GA, RESCORLA_WAGNER, Q_LEARNING, EXP_SARSA, ACTOR_CRITIC):
+        return small_sets_script(name, n_rewards)
+    elif name == LARGE_SETS:
+        return large_sets_script(n_rewards)
+    elif name == PROBABILISTIC:
+        return probabilistic_script(n_rewards)
+    elif name == POSTPROCESSING:
+        return postprocessing_script(max(1, n_rewards // 4))
+    else:
+        raise Exception("Unknown benchmark workload '{}'.".format(name))
+
+
+def count_steps(simulation_data):
+    '''Returns the total number of simulated steps over all runs and subjects.'''
+    n_steps = 0
+    for run_output in simulation_data.run_outputs.values():
+        for output_subject in run_output.output_subjects:
+            n_steps += len(output_subject.history) // 2
+    return n_steps
+
+
+def run_workload(name, scale=1, repeat=1, measure_memory=True):
+    '''Runs a workload and returns a dict with its timings.
+
+       The simulation is timed repeat times and the fastest run is reported. Peak memory is
+       measured in a separate run, since tracemalloc slows down the simulation.
+    '''
+    import matplotlib.pyplot as plt
+
+    script = workload_script(name, scale)
+
+    parse_time = None
+    simulation_time = None
+    postprocessing_time = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        script_obj = LsScript.LsScript(script)
+        t1 = time.perf_counter()
+        simulation_data = script_obj.run()
+        t2 = time.perf_counter()
+        script_obj.postcmds.run(simulation_data)
+        t3 = time.perf_counter()
+        plt.close('all')
+        if simulation_time is None or t2 - t1 < simulation_time:
+            parse_time = t1 - t0
+            simulation_time = t2 - t1
+            postprocessing_time = t3 - t2
+
+    n_steps = count_steps(simulation_data)
+    result = {'name': name,
+              'steps': n_steps,
+              'parse_time': parse_time,
+              'simulation_time': simulation_time,
+              'steps_per_second': n_steps / simulation_time if simulation_time > 0 else None,
+              'postprocessing_time': postprocessing_time,
+              'n_postcmds': len(script_obj.postcmds.cmds)}
+
+    if measure_memory:
+        tracemalloc.start()
+        script_obj = LsScript.LsScript(script)
+        simulation_data = script_obj.run()
+        script_obj.postcmds.run(simulation_data)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        plt.close('all')
+        result['peak_memory'] = peak
+
+    return result
+
+
+def run_bench(names=None, scale=1, repeat=1, measure_memory=True):
+    '''Runs the specified workloads (all if names is None) and returns the results as a dict
+       that can be serialized to JSON.'''
+    import matplotlib
+    matplotlib.use('Agg')
+
+    if names is None or len(names) == 0:
+        names = ALL_WORKLOADS
+    for name in names:
+        if name not in ALL_WORKLOADS:
+            raise Exception("Unknown benchmark workload '{}'.".format(name))
+
+    results = list()
+    for name in names:
+        results.append(run_workload(name, scale, repeat, measure_memory))
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'scale': scale,
+            'repeat': repeat,
+            'workloads': results}
+
+
+def bench_json(results):
+    return json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    print(bench_json(run_bench(sys.argv[1:])))
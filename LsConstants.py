@@ -19,9 +19,10 @@ VEXPORT = KWP + "vexport"
 PEXPORT = KWP + "pexport"
 NEXPORT = KWP + "nexport"
 HEXPORT = KWP + "hexport"
+EXPORT = KWP + "export"  # Several v, w, p and n series in one file
 
 ALL_PLOTCMDS = [WPLOT, VPLOT, PPLOT, NPLOT, SUBPLOT, FIGURE, LEGEND]
-ALL_EXPORTCMDS = [WEXPORT, VEXPORT, PEXPORT, NEXPORT, HEXPORT]
+ALL_EXPORTCMDS = [WEXPORT, VEXPORT, PEXPORT, NEXPORT, HEXPORT, EXPORT]
 ALL_POSTCMDS = ALL_PLOTCMDS + ALL_EXPORTCMDS
 ALL_KEYWORDS = [COMMENT, PARAMETERS, PHASE, RUN] + ALL_POSTCMDS
 
@@ -46,6 +47,26 @@ PHASEDIV = "|"
 
 # @run
 PHASES = "phases"
+RECORD = "record"
+RECORD_EVERY = "record_every"  # Record all v and w every n:th step
+RECORD_STEPS = "record_steps"  # Record all v and w at the specified steps
+HISTORY = "history"  # 'off' to not keep the history, and count the patterns of n instead
+TARGET_SE = "target_se"  # Simulate subjects until the standard error of the averages is below this
+MAX_SUBJECTS = "max_subjects"  # The largest number of subjects to simulate with TARGET_SE
+SE_AT = "se_at"  # Points of the averaged curves that TARGET_SE applies to (default: all)
+ENGINE = "engine"  # How the run is simulated, one of the values below
+
+# Values of ENGINE
+ENGINE_MONTE_CARLO = "montecarlo"  # Simulate each subject (default)
+ENGINE_MEAN_FIELD = "meanfield"  # Propagate the expected v and w and the state probabilities
+
+# Values of HISTORY, besides 'on' and 'off'
+HISTORY_CODED = "coded"  # Keep the history as one-byte codes of the stimuli and responses
+HISTORY_RUN_LENGTH = "runlength"  # Also run-length encode the repeated steps
+
+# Values of RECORD
+RECORD_ALL = "all"  # Record v and w of the learning stimulus in each step
+RECORD_CHANGES = "changes"  # Only record v and w when they change
 
 # Generic
 LABEL = "label"
@@ -1,4 +1,5 @@
 from LsExceptions import LsGuiException
+from LsSimulation import Progress
 import LsScript
 
 import tkinter as tk
@@ -8,17 +9,27 @@ from tkinter import messagebox, filedialog
 import matplotlib.pyplot as plt
 
 import traceback
+import threading
 import os
 
 TITLE = "Learning Simulator"
 FILETYPES = (('Text files', '*.txt'), ('All files', '*.*'))
 
+# Interval in milliseconds between the checks of a running simulation
+POLL_INTERVAL = 200
+
 
 class Gui():
     def __init__(self):
         self.file_path = None
         self.simulation_data = None  # A ScriptOutput object
 
+        # The currently running simulation
+        self.simulation_thread = None
+        self.simulation_script = None  # The LsScript object being simulated
+        self.simulation_progress = None  # A Progress object
+        self.simulation_result = None  # The ScriptOutput object or the raised exception
+
         self.root = tk.Tk()
         self.root.protocol("WM_DELETE_WINDOW", self.file_quit)
 
@@ -26,6 +37,9 @@ class Gui():
 
         self.scriptLabel = None
         self.scriptField = None
+        self.statusLabel = None
+        self.simButton = None
+        self.cancelButton = None
         self._create_widgets()
         self._assign_accelerators()
 
@@ -97,23 +111,88 @@ class Gui():
         closefigButton.pack(side="right")
 
         # The Simulate button
-        simButton = tk.Button(frame, text="Simulate and Plot", command=self.simulate)
-        simButton.pack(side="left")
+        self.simButton = tk.Button(frame, text="Simulate and Plot", command=self.simulate)
+        self.simButton.pack(side="left")
 
         # The Plot button
         plotButton = tk.Button(frame, text="Plot", command=self.plot)
         plotButton.pack(side="left")
 
+        # The Cancel button
+        self.cancelButton = tk.Button(frame, text="Cancel", command=self.cancel,
+                                      state=tk.DISABLED)
+        self.cancelButton.pack(side="left")
+
+        # The status bar
+        self.statusLabel = tk.Label(self.root, text="", bd=1, relief=tk.SUNKEN, anchor="w")
+        self.statusLabel.pack(side="bottom", fill=tk.X)
+
         frame.pack(fill=BOTH, expand=YES)
 
     def simulate(self, event=None):
+        '''Parses the script and starts the simulation in a worker thread. The thread is
+           polled with root.after, and the results are plotted when it is finished.'''
+        if self.simulation_thread is not None:
+            return
         try:
             script = self.scriptField.get("1.0", "end-1c")
             script_obj = LsScript.LsScript(script)
-            self.simulation_data = script_obj.run()
-            script_obj.postproc(self.simulation_data)
         except Exception as ex:
             self.handle_exception(ex)
+            return
+
+        self.simulation_script = script_obj
+        self.simulation_progress = Progress()
+        self.simulation_result = None
+        self.simulation_thread = threading.Thread(target=self._simulate_worker, daemon=True)
+        self.simButton.config(state=tk.DISABLED)
+        self.cancelButton.config(state=tk.NORMAL)
+        self.simulation_thread.start()
+        self.root.after(POLL_INTERVAL, self._poll_simulation)
+
+    def _simulate_worker(self):
+        try:
+            self.simulation_result = self.simulation_script.run(self.simulation_progress)
+        except Exception as ex:
+            self.simulation_result = ex  # Printed with its traceback by _poll_simulation
+
+    def _poll_simulation(self):
+        progress = self.simulation_progress
+        if self.simulation_thread.is_alive():
+            self.set_status("Simulating: {0}/{1} subjects done, {2:.0f} steps/s".format(
+                progress.n_subjects_done, progress.n_subjects, progress.steps_per_second()))
+            self.root.after(POLL_INTERVAL, self._poll_simulation)
+            return
+
+        self.simulation_thread = None
+        self.simButton.config(state=tk.NORMAL)
+        self.cancelButton.config(state=tk.DISABLED)
+        result = self.simulation_result
+        self.simulation_result = None
+        if isinstance(result, Exception):
+            self.set_status("Simulation failed.")
+            self.handle_exception(result)
+        elif progress.cancelled:
+            self.simulation_data = result
+            self.set_status(("Cancelled after {0}/{1} subjects and {2} steps. " +
+                             "Press Plot to plot the partial results.").format(
+                progress.n_subjects_done, progress.n_subjects, progress.n_steps))
+        else:
+            self.simulation_data = result
+            self.set_status("Simulation done: {0} subjects, {1} steps.".format(
+                progress.n_subjects_done, progress.n_steps))
+            try:
+                self.simulation_script.postproc(self.simulation_data)
+            except Exception as ex:
+                self.handle_exception(ex)
+
+    def cancel(self):
+        if self.simulation_progress is not None:
+            self.simulation_progress.cancel()
+            self.set_status("Cancelling...")
+
+    def set_status(self, text):
+        self.statusLabel.config(text=text)
 
     def plot(self):
         try:
@@ -135,7 +214,9 @@ class Gui():
         #     err_msg = "{0} {1}".format(err_msg, ex.args[1])
         #     # err_msg = err_msg + ex.args[1]
         messagebox.showerror("Error", err_msg)
-        print(traceback.format_exc())
+        # From the traceback of ex, which is also set when ex is no longer being handled (as
+        # for an exception in the simulation thread)
+        print("".join(traceback.format_exception(type(ex), ex, ex.__traceback__)))
 
     # def file_open(self):
     #     filename = filedialog.askopenfilename()
@@ -212,6 +293,7 @@ class Gui():
         save_changes = self.save_changes()
         if not save_changes:
             return
+        self.cancel()
         self.close_figs()
         self.root.destroy()  # sys.exit(0)
 
@@ -0,0 +1,388 @@
+import LsUtil
+from LsExceptions import LsEvalException
+from LsConstants import *
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from collections.abc import Sequence
+from itertools import accumulate, chain, repeat
+
+
+def symbol_typecode(n_symbols):
+    '''The smallest unsigned array typecode that can hold n_symbols codes.'''
+    if n_symbols <= 0xFF:
+        return 'B'
+    elif n_symbols <= 0xFFFF:
+        return 'H'
+    else:
+        return 'I'
+
+
+def new_history(coding=None):
+    '''An empty history to write a subject's stimuli and responses to: a list if coding is
+       None, otherwise a CodedHistory (HISTORY_CODED) or a RunLengthHistory
+       (HISTORY_RUN_LENGTH).'''
+    if coding is None:
+        return list()
+    elif coding == HISTORY_CODED:
+        return CodedHistory()
+    elif coding == HISTORY_RUN_LENGTH:
+        return RunLengthHistory()
+    raise ValueError("Invalid history coding '{}'.".format(coding))
+
+
+def add_symbol(symbols, symbol_codes, symbol):
+    '''The code of symbol in the list symbols, where symbol_codes has the code of each symbol.
+       A new symbol is added to both.'''
+    code = symbol_codes.get(symbol)
+    if code is None:
+        code = len(symbols)
+        symbol_codes[symbol] = code
+        symbols.append(symbol)
+    return code
+
+
+def encode(history):
+    '''Dictionary-encodes the history list [S1, R1, S2, R2, ...] (strings and tuples of
+       strings). Returns an array of integer codes and the list of symbols, such that
+       history[i] == symbols[codes[i]].'''
+    if type(history) is CodedHistory and type(history.codes) is array:
+        return history.codes, history.symbols
+    elif type(history) is RunLengthHistory:
+        return history.item_codes(0, len(history)), history.symbols
+    symbol_codes = dict()
+    symbols = list()
+    codes = list()
+    for item in history:
+        code = symbol_codes.get(item)
+        if code is None:
+            code = len(symbols)
+            symbol_codes[item] = code
+            symbols.append(item)
+        codes.append(code)
+    return array(symbol_typecode(len(symbols)), codes), symbols
+
+
+class CodedHistory(Sequence):
+    '''A history [S1, R1, S2, R2, ...] stored as integer codes into a list of symbols (strings
+       and tuples of strings). codes can be any sequence of ints, for example an array or a
+       memoryview into a memory-mapped file. A CodedHistory with an array of codes can be
+       written to with write, and the array then uses the smallest typecode for the
+       symbols, normally one byte per item.'''
+
+    def __init__(self, codes=None, symbols=None):
+        self.codes = array('B') if codes is None else codes
+        self.symbols = list() if symbols is None else symbols
+
+        # Keys are symbols, values are their codes. Made when first written to.
+        self.symbol_codes = None
+
+    def write(self, stimulus, response):
+        '''Appends a stimulus and the response to it.'''
+        if self.symbol_codes is None:
+            self.symbol_codes = {symbol: code for code, symbol in enumerate(self.symbols)}
+        symbols = self.symbols
+        codes = self.codes
+        stimulus_code = add_symbol(symbols, self.symbol_codes, stimulus)
+        response_code = add_symbol(symbols, self.symbol_codes, response)
+        if symbol_typecode(len(symbols)) != codes.typecode:
+            codes = array(symbol_typecode(len(symbols)), codes)
+            self.codes = codes
+        codes.append(stimulus_code)
+        codes.append(response_code)
+
+    def nbytes(self):
+        '''The memory used by the codes, in bytes.'''
+        return len(self.codes) * self.codes.itemsize
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, ind):
+        if type(ind) is slice:
+            symbols = self.symbols
+            return [symbols[code] for code in self.codes[ind]]
+        return self.symbols[self.codes[ind]]
+
+    def __iter__(self):
+        return map(self.symbols.__getitem__, self.codes)
+
+    def select(self, ranges):
+        '''A CodedHistory with the items in the (start, end) ranges, with the same symbols. The
+           codes are a slice of codes if there is one range, so a view for a memoryview.'''
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            return CodedHistory(self.codes[start:end], self.symbols)
+        codes = array(symbol_typecode(len(self.symbols)))
+        for start, end in ranges:
+            codes.extend(self.codes[start:end])
+        return CodedHistory(codes, self.symbols)
+
+    def find_and_cumsum(self, pattern, use_exact_match):
+        '''Same as LsUtil.find_and_cumsum, but each pattern item is matched once against each
+           symbol instead of against each history item.'''
+        pattern_list, pattern_len = LsUtil.parse_pattern(pattern)
+        codes = self.codes
+        seq_len = len(codes)
+
+        # match_tables[p][code] is 1 if symbol code matches pattern item p
+        match_tables = list()
+        for pattern_item in pattern_list:
+            match_tables.append([int(LsUtil.is_match_item(symbol, pattern_item, use_exact_match))
+                                 for symbol in self.symbols])
+
+        n_match = max(seq_len - pattern_len + 1, 0)
+        if pattern_len == 1:
+            match_table = match_tables[0]
+            findind = [match_table[code] for code in codes]
+        else:
+            findind = [0] * seq_len
+            for i in range(n_match):
+                for p in range(pattern_len):
+                    if not match_tables[p][codes[i + p]]:
+                        break
+                else:
+                    findind[i] = 1
+        for i in range(n_match, seq_len):
+            findind[i] = 0
+        cumsum = list(accumulate(findind))
+        return findind, cumsum
+
+
+class RunLengthHistory(Sequence):
+    '''A history [S1, R1, S2, R2, ...] stored as runs of a repeated step (a stimulus and the
+       response to it). The symbols (strings and tuples of strings) are coded as in
+       CodedHistory, each distinct step as a pair of symbol codes, and each run as the code of
+       its step and the history index where it ends. Smaller than a CodedHistory when the
+       same step is often repeated in a row.'''
+
+    def __init__(self):
+        self.symbols = list()
+        self.symbol_codes = dict()
+
+        # (stimulus code, response code) of each distinct step
+        self.steps = list()
+        # Keys are (stimulus, response), values are indices into steps
+        self.step_codes = dict()
+
+        # The step code of each run, and the history index after it
+        self.run_steps = array('B')
+        self.run_ends = array('q')
+
+    def write(self, stimulus, response):
+        '''Appends a stimulus and the response to it.'''
+        step_code = self.step_codes.get((stimulus, response))
+        if step_code is None:
+            step_code = len(self.steps)
+            self.step_codes[(stimulus, response)] = step_code
+            self.steps.append((add_symbol(self.symbols, self.symbol_codes, stimulus),
+                               add_symbol(self.symbols, self.symbol_codes, response)))
+            if symbol_typecode(len(self.steps)) != self.run_steps.typecode:
+                self.run_steps = array(symbol_typecode(len(self.steps)), self.run_steps)
+        run_ends = self.run_ends
+        if len(run_ends) > 0 and self.run_steps[-1] == step_code:
+            run_ends[-1] += 2
+        else:
+            self.run_steps.append(step_code)
+            run_ends.append(run_ends[-1] + 2 if len(run_ends) > 0 else 2)
+
+    def nbytes(self):
+        '''The memory used by the runs, in bytes.'''
+        return (len(self.run_steps) * self.run_steps.itemsize +
+                len(self.run_ends) * self.run_ends.itemsize)
+
+    def __len__(self):
+        return self.run_ends[-1] if len(self.run_ends) > 0 else 0
+
+    def __getitem__(self, ind):
+        if type(ind) is slice:
+            start, end, stride = ind.indices(len(self))
+            if stride != 1:
+                return [self[i] for i in range(start, end, stride)]
+            symbols = self.symbols
+            return [symbols[code] for code in self.item_codes(start, end)]
+        if ind < 0:
+            ind += len(self)
+        if ind < 0 or ind >= len(self):
+            raise IndexError("history index out of range")
+        step = self.steps[self.run_steps[bisect_right(self.run_ends, ind)]]
+        return self.symbols[step[ind % 2]]
+
+    def __iter__(self):
+        symbols = self.symbols
+        steps = [(symbols[stimulus_code], symbols[response_code])
+                 for stimulus_code, response_code in self.steps]
+        return chain.from_iterable(chain.from_iterable(
+            repeat(steps[step_code], (end - start) // 2)
+            for step_code, start, end in self.runs(0, len(self))))
+
+    def runs(self, start, end):
+        '''Generates the (step code, start, end) of the runs, clipped to the history indices
+           from start to end.'''
+        run_steps = self.run_steps
+        run_ends = self.run_ends
+        r = bisect_right(run_ends, start)
+        run_start = run_ends[r - 1] if r > 0 else 0
+        while r < len(run_ends) and run_start < end:
+            run_end = run_ends[r]
+            yield run_steps[r], max(run_start, start), min(run_end, end)
+            run_start = run_end
+            r += 1
+
+    def item_codes(self, start, end):
+        '''An array with the codes into symbols of the history items from start to end.'''
+        codes = array(symbol_typecode(len(self.symbols)))
+        for step_code, run_start, run_end in self.runs(start, end):
+            step = self.steps[step_code]
+            if run_start % 2:
+                step = step[::-1]
+            n_items = run_end - run_start
+            codes.extend((step * ((n_items + 1) // 2))[:n_items])
+        return codes
+
+    def select(self, ranges):
+        '''A RunLengthHistory with the items in the (start, end) ranges, sharing the symbols and
+           steps. A CodedHistory if a range starts or ends within a step.'''
+        if any(start % 2 or end % 2 for start, end in ranges):
+            codes = array(symbol_typecode(len(self.symbols)))
+            for start, end in ranges:
+                codes.extend(self.item_codes(start, end))
+            return CodedHistory(codes, self.symbols)
+        out = RunLengthHistory()
+        out.symbols, out.symbol_codes = self.symbols, self.symbol_codes
+        out.steps, out.step_codes = self.steps, self.step_codes
+        out.run_steps = array(self.run_steps.typecode)
+        n_items = 0
+        for start, end in ranges:
+            for step_code, run_start, run_end in self.runs(start, end):
+                n_items += run_end - run_start
+                if len(out.run_steps) > 0 and out.run_steps[-1] == step_code:
+                    out.run_ends[-1] = n_items
+                else:
+                    out.run_steps.append(step_code)
+                    out.run_ends.append(n_items)
+        return out
+
+    def find_and_cumsum(self, pattern, use_exact_match):
+        '''Same as LsUtil.find_and_cumsum. A pattern of one item is matched once against each
+           symbol and the matches are repeated for each run, a longer pattern is found in the
+           codes of the items as in CodedHistory.'''
+        pattern_list, pattern_len = LsUtil.parse_pattern(pattern)
+        if pattern_len > 1:
+            return CodedHistory(self.item_codes(0, len(self)),
+                                self.symbols).find_and_cumsum(pattern, use_exact_match)
+        match_table = [int(LsUtil.is_match_item(symbol, pattern_list[0], use_exact_match))
+                       for symbol in self.symbols]
+        findind = list()
+        for step_code, start, end in self.runs(0, len(self)):
+            stimulus_code, response_code = self.steps[step_code]
+            findind.extend([match_table[stimulus_code], match_table[response_code]] *
+                           ((end - start) // 2))
+        return findind, list(accumulate(findind))
+
+
+class PatternCounter():
+    '''Finds patterns in a history [S1, R1, S2, R2, ...] while it is written, so that
+       find_and_cumsum can be evaluated without keeping the history.
+
+       patterns is a list of (pattern, use_exact_match) as for LsUtil.find_and_cumsum. For each
+       of them, the history indices where a match starts are kept. boundary is called with the
+       history index where each phase starts. The history items near the phase boundaries are
+       kept, to also find the matches that span the boundaries of a phase-filtered history.
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.pattern_lists = [LsUtil.parse_pattern(pattern)[0] for pattern, _ in patterns]
+
+        # positions[p] is the increasing history indices where patterns[p] matches
+        self.positions = [array('q') for _ in patterns]
+
+        # Items closer than this to a phase boundary are kept
+        self.window = max([len(pattern_list) for pattern_list in self.pattern_lists],
+                          default=1) - 1
+
+        # Keys are history indices, values are history items
+        self.boundary_items = dict()
+
+        # Number of written history items
+        self.n_items = 0
+
+        # The last written items, and the index up to which written items are kept
+        self.recent = deque(maxlen=self.window + 2)
+        self.keep_until = 0
+
+        # match_tables[p][i] has, for each history item seen, whether it matches item i of
+        # pattern p
+        self.match_tables = [[dict() for _ in pattern_list] for pattern_list in self.pattern_lists]
+
+    def write(self, item):
+        index = self.n_items
+        self.n_items += 1
+        recent = self.recent
+        recent.append(item)
+        if index < self.keep_until:
+            self.boundary_items[index] = item
+        n_recent = len(recent)
+        for p, pattern_list in enumerate(self.pattern_lists):
+            pattern_len = len(pattern_list)
+            if pattern_len > n_recent:
+                continue
+            use_exact_match = self.patterns[p][1]
+            match_table = self.match_tables[p]
+            for i in range(pattern_len):
+                recent_item = recent[n_recent - pattern_len + i]
+                is_match = match_table[i].get(recent_item)
+                if is_match is None:
+                    is_match = LsUtil.is_match_item(recent_item, pattern_list[i], use_exact_match)
+                    match_table[i][recent_item] = is_match
+                if not is_match:
+                    break
+            else:
+                self.positions[p].append(index - pattern_len + 1)
+
+    def boundary(self, index):
+        '''Called when a phase starts at history index index, at most two items after it.'''
+        if self.window == 0:
+            return
+        first_recent = self.n_items - len(self.recent)
+        for i, item in enumerate(self.recent):
+            if abs(first_recent + i - index) <= self.window:
+                self.boundary_items[first_recent + i] = item
+        self.keep_until = max(self.keep_until, index + self.window)
+
+    def find_and_cumsum(self, pattern, use_exact_match, ranges):
+        '''LsUtil.find_and_cumsum of the pattern in the history filtered by ranges, a list of
+           (start index, end index) that each start and end at a phase boundary.'''
+        if (pattern, use_exact_match) not in self.patterns:
+            raise LsEvalException("The history is not kept, and {} was not counted during the "
+                                  "simulation.".format(pattern))
+        p = self.patterns.index((pattern, use_exact_match))
+        pattern_list = self.pattern_lists[p]
+        pattern_len = len(pattern_list)
+        positions = self.positions[p]
+
+        findind = [0] * sum(end - start for start, end in ranges)
+        offset = 0
+        for r, (start, end) in enumerate(ranges):
+            for i in range(bisect_left(positions, start),
+                           bisect_right(positions, end - pattern_len)):
+                findind[offset + positions[i] - start] = 1
+
+            # Matches that start in this range and continue in the following ones
+            first = max(start, end - pattern_len + 1)
+            items = [self.boundary_items[i] for i in range(first, end)]
+            n_before = len(items)
+            for next_start, next_end in ranges[r + 1:]:
+                for i in range(next_start, min(next_end, next_start + pattern_len - 1)):
+                    items.append(self.boundary_items[i])
+                if len(items) >= n_before + pattern_len - 1:
+                    break
+            for j in range(max(len(items) - pattern_len + 1, 0)):
+                if j < n_before and all(LsUtil.is_match_item(items[j + i], pattern_list[i],
+                                                             use_exact_match)
+                                        for i in range(pattern_len)):
+                    findind[offset + first + j - start] = 1
+            offset += end - start
+        return findind, list(accumulate(findind))
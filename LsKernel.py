@@ -0,0 +1,57 @@
+'''Specialized learning kernels.
+
+For each (previous stimulus, stimulus, previous response) that occurs in a simulation, a
+mechanism writes the update of its learn() for that combination as a function kernel(v, w) of
+straight-line code (see Mechanism.write_kernel): the loops over the stimulus elements are
+unrolled, the keys of v and w are constants, and u, c and the learning rates are folded into
+literals. The function is compiled once and cached, so later steps with the same combination
+only call it.
+
+A kernel makes the same floating point operations in the same order as learn(), so the
+simulation results are the same.
+'''
+import math
+
+
+class KernelWriter():
+
+    '''Collects the source lines of a kernel and compiles them.'''
+
+    def __init__(self):
+        self.lines = list()
+
+        # The globals of the kernel: exp and the constants that have no literal
+        self.namespace = {'exp': math.exp}
+
+    def const(self, value):
+        '''A Python expression with the constant value.'''
+        if type(value) in (int, float) and math.isfinite(value):
+            return "({!r})".format(value)
+        if type(value) is str or (type(value) is tuple and
+                                  all(type(item) is str for item in value)):
+            return repr(value)
+        name = "_c{}".format(len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def add(self, line):
+        self.lines.append(line)
+
+    @staticmethod
+    def sum(terms):
+        '''The sum of the expressions in terms, from 0 as in learn().'''
+        return " + ".join(["0"] + list(terms))
+
+    def compile(self):
+        '''Returns the kernel function. Its source is in its attribute source.'''
+        body = self.lines if len(self.lines) > 0 else ["pass"]
+        source = "def kernel(v, w, exp=exp):\n" + "".join("    " + line + "\n" for line in body)
+        exec(compile(source, "<kernel>", "exec"), self.namespace)
+        kernel = self.namespace['kernel']
+        kernel.source = source
+        return kernel
+
+
+def no_learning(v, w):
+    '''The kernel for a stimulus with an element in omit_learning.'''
+    pass
@@ -0,0 +1,278 @@
+'''Mean-field engine.
+
+A run with the @run property 'engine':'meanfield' is not simulated subject by subject.
+Instead, the probability distribution over the states of the world (see WorldStates) and the
+last response is propagated step by step, using the response probabilities of the mechanism
+(LsMechanism.support_vector_static) and the probabilities of the conditions of the phase
+lines. v and w are replaced by their expected values: in each step they change by the
+expected change of learn() over the states, and the response probabilities use the expected v.
+
+The result approximates the average over infinitely many subjects in a single pass. It is a
+RunOutput with one subject, whose v and w are the expected values at each step among the
+subjects that have not yet finished, as the average over subjects of a simulated run. It is
+exact when all subjects see the same stimuli, otherwise it ignores the spread of v and w
+between subjects. There is no history, so the run can only be evaluated for the average of
+v, w and p over all steps (see LsScript.LsScript._check_mean_field).
+'''
+import LsOutput
+from LsMechanism import support_vector_static
+from LsConstants import *
+
+import copy
+
+# States with a smaller probability are dropped, and the run ends when the probability that a
+# subject is still running is smaller
+MIN_PROB = 1e-9
+
+
+class WorldStates():
+
+    '''The transitions between the states of a world (an LsWorld.World object), as in
+       World.next_stimulus but with the probabilities of all outcomes instead of a random one.
+
+       A state is a tuple (phase index, line label, stayed, line count, response count, previous
+       response, end count). The line label is None before the first stimulus of a phase.
+       stayed is whether the previous step was on the same line, and then the counts and the
+       previous response are those of the line (PhaseLine.consec_linecnt, consec_respcnt and
+       prev_response), otherwise None. They are also None if the conditions of the line do not
+       use them, and the counts are capped at the largest count that the conditions compare
+       with, so that states that only differ in these are the same state. The end count is a
+       tuple for a compound end condition.'''
+
+    def __init__(self, world):
+        self.phases = world.phases
+
+        # Keys are (phase index, line label), values are the largest line count and response
+        # count that the conditions of the line compare with, or None if they do not
+        self.count_limits = dict()
+        for phase_ind, phase in enumerate(self.phases):
+            for label, line in phase.phase_lines.items():
+                conditions = [c for c in line.conditions.conditions if c.count is not None]
+                self.count_limits[(phase_ind, label)] = (
+                    max([c.count for c in conditions if c.response is None], default=None),
+                    max([c.count for c in conditions if c.response is not None], default=None))
+
+        # Keys are (state, response), values are the outputs of next
+        self.transitions = dict()
+
+    def start(self, phase_ind=0):
+        '''The state before the first stimulus of the phase with index phase_ind.'''
+        phase = self.phases[phase_ind]
+        end = (0,) * len(phase.end_limits) if phase.is_compound_end else 0
+        return (phase_ind, None, False, None, None, None, end)
+
+    def stimulus(self, state):
+        '''The stimulus of the line of state, or None before the first stimulus.'''
+        phase_ind, label = state[0], state[1]
+        if label is None:
+            return None
+        return self.phases[phase_ind].phase_lines[label].stimulus
+
+    def next(self, state, response):
+        '''The list of (probability, next state, stimulus) after response in state. Empty if
+           the world has no more stimuli.'''
+        key = (state, response)
+        out = self.transitions.get(key)
+        if out is None:
+            out = self._next(state, response)
+            self.transitions[key] = out
+        return out
+
+    def _next(self, state, response):
+        phase_ind, label, stayed, linecnt, respcnt, prev_response, end = state
+        phase = self.phases[phase_ind]
+        if phase.is_compound_end:
+            ended = any(count >= limit for count, limit in zip(end, phase.end_limits))
+        else:
+            ended = (end >= phase.end_limit)
+        if ended:
+            if phase_ind + 1 >= len(self.phases):
+                return []
+            return self._next(self.start(phase_ind + 1), response)
+
+        if label is None:
+            rows = [(1, phase.first_label)]
+            linecnt = respcnt = None
+        else:
+            # As in PhaseLine.next_row
+            max_linecnt, max_respcnt = self.count_limits[(phase_ind, label)]
+            if max_linecnt is not None:
+                linecnt = min(linecnt + 1, max_linecnt) if stayed else 1
+            if max_respcnt is not None:
+                if stayed and prev_response == response:
+                    respcnt = min(respcnt + 1, max_respcnt)
+                else:
+                    respcnt = 1
+            rows = self._next_rows(phase.phase_lines[label], response, linecnt, respcnt)
+
+        out = list()
+        for prob, next_label in rows:
+            if next_label == label:
+                next_prev_response = None if respcnt is None else response
+                next_state = (phase_ind, next_label, True, linecnt, respcnt, next_prev_response,
+                              self._next_end(phase, end, next_label, response))
+            else:
+                next_state = (phase_ind, next_label, False, None, None, None,
+                              self._next_end(phase, end, next_label, response))
+            out.append((prob, next_state, phase.phase_lines[next_label].stimulus))
+        return out
+
+    @staticmethod
+    def _next_rows(line, response, linecnt, respcnt):
+        '''The list of (probability, line label) of the next line, as in
+           PhaseLineConditions.next_row.'''
+        rows = list()
+        prob_left = 1
+        for condition in line.conditions.conditions:
+            if condition.holds(response, linecnt, respcnt):
+                for prob, label in condition.goto:
+                    rows.append((prob_left * prob, label))
+                prob_left *= 1 - condition.goto_prob_cumsum[-1]
+                if prob_left < MIN_PROB:
+                    return rows
+        raise Exception("No condition in '{0}' was met for response '{1}'.".
+                        format(line.conditions.conditions_str, response))
+
+    @staticmethod
+    def _next_end(phase, end, label, response):
+        '''The end count after the line label is shown after response, as in
+           PhaseWorld.next_stimulus.'''
+        if phase.is_compound_end:
+            end = [count + inc for count, inc in zip(end, phase.line_end_inc[label])]
+            if response is not None and response in phase.response_end_inc:
+                end = [count + inc for count, inc in zip(end, phase.response_end_inc[response])]
+            return tuple(end)
+        end += phase.line_end_inc[label]
+        if response is not None:
+            end += phase.response_end_inc.get(response, 0)
+        return end
+
+
+def run(script_run, progress=None):
+    '''Propagates the expected v and w of the ScriptRun object script_run, and returns a
+       RunOutput object with them as its single subject.
+
+       If progress (a Progress object) is given, it is updated after each step and the
+       propagation stops after the current step if progress is cancelled.'''
+    mechanism = copy.deepcopy(script_run.mechanism_obj)
+    mechanism.subject_reset()
+    world_states = WorldStates(script_run.world)
+    schedule = script_run.schedule
+    out = start_output(script_run, mechanism)
+
+    # Keys are (world state, last response), values are the probabilities of the subjects
+    # that are still running
+    dist = {(world_states.start(), None): 1}
+    step = 0
+    next_record_step = schedule.next_step(0) if schedule is not None else None
+    while True:
+        # Keys are (previous stimulus, response, stimulus), values are probabilities
+        learning = dict()
+        # Keys are (next world state, stimulus), values are probabilities
+        shown = dict()
+        p_ended = 0
+        for (state, response), prob in dist.items():
+            outcomes = world_states.next(state, response)
+            if len(outcomes) == 0:
+                p_ended += prob
+                continue
+            prev_stimulus = world_states.stimulus(state)
+            for p, next_state, stimulus in outcomes:
+                p *= prob
+                shown[(next_state, stimulus)] = shown.get((next_state, stimulus), 0) + p
+                if prev_stimulus is not None:
+                    key = (prev_stimulus, response, stimulus)
+                    learning[key] = learning.get(key, 0) + p
+        p_running = sum(shown.values())
+
+        if step > 0 or len(learning) > 0:
+            step += 1
+            learn_expected(mechanism, learning, p_running + p_ended)
+            if p_running < MIN_PROB:
+                break
+            if schedule is None:
+                for prev_stimulus, response in {key[0:2] for key in learning}:
+                    if script_run.has_w:
+                        out.write_w(0, prev_stimulus, step, mechanism)
+                    out.write_v(0, prev_stimulus, response, step, mechanism)
+            elif step == next_record_step:
+                out.write_all(0, step, mechanism)
+                next_record_step = schedule.next_step(step)
+        elif p_running < MIN_PROB:
+            break
+
+        # Respond with the expected v
+        dist = dict()
+        response_probs = dict()
+        for (state, stimulus), prob in shown.items():
+            probs = response_probs.get(stimulus)
+            if probs is None:
+                probs = response_probabilities(mechanism, stimulus)
+                response_probs[stimulus] = probs
+            for response, p in probs:
+                p *= prob / p_running
+                if p >= MIN_PROB:
+                    dist[(state, response)] = dist.get((state, response), 0) + p
+
+        if progress is not None:
+            progress.n_steps += 1
+            if progress.cancelled:
+                break
+
+    out.write_all(0, step, mechanism)
+    out.write_step(0, "last", step)
+    if progress is not None:
+        progress.n_subjects_done += 1
+    return out
+
+
+def start_output(script_run, mechanism):
+    '''A RunOutput object with one subject without history, with the start values written.'''
+    out = LsOutput.RunOutput(1, mechanism.stimulus_req, script_run.record,
+                             script_run.schedule is not None, list(), mechanism.start_v)
+    for element in mechanism.stimulus_elements:
+        if script_run.has_w:
+            out.write_w(0, (element,), 0, mechanism)
+        for behavior in mechanism.stimulus_req[element]:
+            out.write_v(0, (element,), behavior, 0, mechanism)
+    out.write_step(0, script_run.world.phases[0].label, 0)
+    return out
+
+
+def response_probabilities(mechanism, stimulus):
+    '''The list of (response, probability) of the feasible responses to stimulus.'''
+    x, feasible_behaviors = support_vector_static(stimulus, mechanism.behaviors,
+                                                  mechanism.stimulus_req, mechanism.beta,
+                                                  mechanism.v)
+    sum_x = sum(x)
+    return [(behavior, x_i / sum_x) for behavior, x_i in zip(feasible_behaviors, x)]
+
+
+def learn_expected(mechanism, learning, p_total):
+    '''Changes v and w of mechanism by the expected change of learn_step. learning is a dict
+       with keys (previous stimulus, response, stimulus) and values their probabilities, which
+       are divided by p_total.'''
+    v, w = mechanism.v, mechanism.w
+    dv = dict()
+    dw = dict()
+    for (prev_stimulus, response, stimulus), prob in learning.items():
+        # learn_step only changes v and w of the elements of the previous stimulus
+        v_keys = [(element, response) for element in prev_stimulus]
+        v_old = [(key in v, v[key]) for key in v_keys]
+        w_old = [w[element] for element in prev_stimulus]
+        mechanism.prev_stimulus = prev_stimulus
+        mechanism.response = response
+        mechanism.learn_step(stimulus)
+        for key, (is_stored, value) in zip(v_keys, v_old):
+            dv[key] = dv.get(key, 0) + prob * (v[key] - value)
+            if is_stored:
+                v[key] = value
+            elif key in v:
+                del v[key]
+        for element, value in zip(prev_stimulus, w_old):
+            dw[element] = dw.get(element, 0) + prob * (w[element] - value)
+            w[element] = value
+    for key, change in dv.items():
+        v[key] += change / p_total
+    for element, change in dw.items():
+        w[element] += change / p_total
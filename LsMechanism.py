@@ -1,7 +1,9 @@
 from LsExceptions import LsParseException
+from LsKernel import KernelWriter, no_learning
 import LsConstants
 import LsUtil
 
+import copy
 from math import exp
 from random import seed, random
 seed()
@@ -36,6 +38,22 @@ DEFAULT_U_VALUE = 0
 DEFAULT_C_VALUE = 0
 
 
+class SparseTable(dict):
+    '''A dict of values for (stimulus element, behavior) pairs, where pairs that are not
+       stored have the value default. Used for v and alpha_v, so that only the pairs that have
+       a value of their own, or that are learned, take memory.'''
+
+    def __init__(self, values, default):
+        super().__init__(values)
+        self.default = default
+
+    def __missing__(self, key):
+        return self.default
+
+    def copy(self):
+        return SparseTable(self, self.default)
+
+
 def get_default(key):
     DEFAULTS = {START_V: {DEFAULT: 0},
                 U: {DEFAULT: 0},
@@ -52,33 +70,45 @@ def get_default(key):
 # -------------------------------------------------------------------------
 
 
-class Mechanism():
-    '''Base class for mechanisms'''
+class MechanismConfig():
+    '''The validated parameters of a mechanism, in the form the mechanisms use them. A config
+       is made once for a set of parameters and can be shared by any number of Mechanism
+       objects (see Mechanism.from_config), which only read it. It cannot be changed after it
+       is made.'''
 
-    def __init__(self, **kwargs):
-        for p in kwargs:
+    # The attributes that are given to each Mechanism object
+    FIELDS = ('behaviors', 'stimulus_elements', 'start_v', 'start_v_pairs', 'alpha_v',
+              'alpha_v_all', 'alpha_w', 'alpha_w_all', 'beta', 'omit_learning',
+              'set_omit_learning', 'response_req', 'stimulus_req', 'u', 'c')
+
+    def __init__(self, parameters):
+        for p in parameters:
             if p not in ALL_PARAMETER_NAMES:
                 raise LsParseException("Unknown parameter '{}'".format(p))
 
         # Required
         for required in [BEHAVIORS, STIMULUS_ELEMENTS]:
-            if required not in kwargs:
+            if required not in parameters:
                 raise LsParseException("The parameter '" + required + "' is required.")
-        self.behaviors = kwargs[BEHAVIORS]
-        self.stimulus_elements = kwargs[STIMULUS_ELEMENTS]
+        self.behaviors = parameters[BEHAVIORS]
+        self.stimulus_elements = parameters[STIMULUS_ELEMENTS]
+
+        # For validation in constant time per key
+        element_set = set(self.stimulus_elements)
+        behavior_set = set(self.behaviors)
 
         # Optional
-        self.start_v = kwargs.get(START_V, get_default(START_V))
-        self.alpha_v = kwargs.get(ALPHA_V, get_default(ALPHA_V))
-        self.alpha_w = kwargs.get(ALPHA_W, get_default(ALPHA_W))
-        self.beta = kwargs.get(BETA, get_default(BETA))
-        self.omit_learning = kwargs.get(OMIT_LEARNING, get_default(OMIT_LEARNING))
+        self.start_v = parameters.get(START_V, get_default(START_V))
+        self.alpha_v = parameters.get(ALPHA_V, get_default(ALPHA_V))
+        self.alpha_w = parameters.get(ALPHA_W, get_default(ALPHA_W))
+        self.beta = parameters.get(BETA, get_default(BETA))
+        self.omit_learning = parameters.get(OMIT_LEARNING, get_default(OMIT_LEARNING))
         self.set_omit_learning = set(self.omit_learning)
-        self.response_req = kwargs.get(RR, get_default(RR))
+        self.response_req = parameters.get(RR, get_default(RR))
 
         # Needs to be copies since they are input and they are altered (in initialize_uc)
-        self.u = dict(kwargs.get(U, get_default(U)))
-        self.c = dict(kwargs.get(C, get_default(C)))
+        self.u = dict(parameters.get(U, get_default(U)))
+        self.c = dict(parameters.get(C, get_default(C)))
 
         # Be nice - if DEFAULT not given, assume it is DEFAULT_{UC}_VALUE
         if DEFAULT not in self.u:
@@ -92,12 +122,11 @@ class Mechanism():
                     raise LsParseException("Keys in {0} must be tuples or '{1}'.".format(START_V, DEFAULT))
                 if len(key) != 2:
                     raise LsParseException("Keys in {0} must be tuples of length two or {1}.".format(START_V, DEFAULT))
-                if (key[0] not in self.stimulus_elements):
+                if (key[0] not in element_set):
                     raise LsParseException("Unknown stimulus element '{0}' in '{1}'".format(key[0], START_V))
-                if (key[1] not in self.behaviors):
+                if (key[1] not in behavior_set):
                     raise LsParseException("Unknown behavior '{0}' in '{1}'".format(key[1], START_V))
 
-        self.alpha_v_all = dict()
         alpha_v_type = type(self.alpha_v)
         if alpha_v_type is dict:
             for key in self.alpha_v:
@@ -106,9 +135,9 @@ class Mechanism():
                         raise LsParseException("Keys in {0} must be tuples or '{1}'.".format(ALPHA_V, DEFAULT))
                     if len(key) != 2:
                         raise LsParseException("Keys in {0} must be tuples of length two or {1}.".format(ALPHA_V, DEFAULT))
-                    if (key[0] not in self.stimulus_elements):
+                    if (key[0] not in element_set):
                         raise LsParseException("Unknown stimulus element '{0}' in '{1}'".format(key[0], ALPHA_V))
-                    if (key[1] not in self.behaviors):
+                    if (key[1] not in behavior_set):
                         raise LsParseException("Unknown behavior '{0}' in '{1}'".format(key[1], ALPHA_V))
             if DEFAULT not in self.alpha_v:
                 raise LsParseException("The parameter {0} must have the key '{1}'.".format(ALPHA_V, DEFAULT))
@@ -116,14 +145,13 @@ class Mechanism():
             raise LsParseException("Invalid value {0} for '{1}'".format(self.alpha_v, ALPHA_V))
         self._initialize_alpha_v_all()
 
-        self.alpha_w_all = dict()
         alpha_w_type = type(self.alpha_w)
         if alpha_w_type is dict:
             for key in self.alpha_w:
                 if (key != DEFAULT):
                     if type(key) is not str:
                         raise LsParseException("Keys in {0} must be stimulus elements or '{1}'.".format(ALPHA_W, DEFAULT))
-                    if key not in self.stimulus_elements:
+                    if key not in element_set:
                         raise LsParseException("Keys in {0} must be stimulus elements or '{1}'.".format(ALPHA_W, DEFAULT))
             if DEFAULT not in self.alpha_w:
                 raise LsParseException("The parameter {0} must have the key '{1}'.".format(ALPHA_W, DEFAULT))
@@ -135,29 +163,34 @@ class Mechanism():
         if DEFAULT not in self.start_v:
             raise LsParseException("The parameter {0} must have the key '{1}'.".format(START_V, DEFAULT))
 
+        # The start values of the pairs that do not have the default start value. Each subject
+        # starts with a copy of these, and the other pairs are stored when first learned.
+        self.start_v_pairs = {key: value for key, value in self.start_v.items()
+                              if key != DEFAULT}
+
         for key in self.u:
-            if (key != DEFAULT) and (key not in self.stimulus_elements):
+            if (key != DEFAULT) and (key not in element_set):
                 raise LsParseException("Unknown stimulus element '{0}' in '{1}'".format(key, U))
-        if (DEFAULT not in self.u) and (set(self.stimulus_elements) != set(self.u.keys())):
+        if (DEFAULT not in self.u) and (element_set != set(self.u.keys())):
                 raise LsParseException("The parameter {0} must have the key '{1}' or be exhaustive.".format(U, DEFAULT))
 
         for key in self.c:
-            if (key != DEFAULT) and (key not in self.behaviors):
+            if (key != DEFAULT) and (key not in behavior_set):
                 raise LsParseException("Unknown behavior '{0}' in '{1}'".format(key, C))
-        if (DEFAULT not in self.c) and (set(self.behaviors) != set(self.c.keys())):
+        if (DEFAULT not in self.c) and (behavior_set != set(self.c.keys())):
             raise LsParseException("The parameter {0} must have the key '{1}' or be exhaustive.".format(C, DEFAULT))
 
         if type(self.response_req) is not dict:
             raise LsParseException("{0} must be a dict.".format(RR))
         for key, val in self.response_req.items():
-            if key not in self.behaviors:
+            if key not in behavior_set:
                 raise LsParseException("Unknown behavior '{0}' in {1}.".format(key, RR))
             if type(val) is str:
-                if val not in self.stimulus_elements:
+                if val not in element_set:
                     raise LsParseException("Unknown stimulus element {0} in {1}.".format(val, RR))
             elif type(val) is list:
                 for e in val:
-                    if e not in self.stimulus_elements:
+                    if e not in element_set:
                         raise LsParseException("Unknown stimulus element {0} in {1}.".format(val, RR))
             else:
                 raise LsParseException("Value for {0} in {1} must be a string or a list of strings.".format(key, RR))
@@ -170,32 +203,90 @@ class Mechanism():
         self.stimulus_req = LsUtil.dict_inv(self.response_req)
 
         # Check that all stimulus elements has at least one feasible response
-        if set(self.stimulus_req) != set(self.stimulus_elements):
-            elements_without_response = set(self.stimulus_elements) - set(self.stimulus_req)
+        if set(self.stimulus_req) != element_set:
+            elements_without_response = element_set - set(self.stimulus_req)
             raise LsParseException("Invalid response_requirements: Stimulus elements {} has no possible responses.".format(elements_without_response))
 
         self._initialize_uc()
-        self.subject_reset()
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError("A MechanismConfig cannot be changed.")
+        super().__setattr__(name, value)
 
     def _initialize_alpha_v_all(self):
-        type_alpha_v = type(self.alpha_v)
-        self.alpha_v_all = dict()
-        for element in self.stimulus_elements:
-            for behavior in self.behaviors:
-                key = (element, behavior)
-                if type_alpha_v is dict:
-                    self.alpha_v_all[key] = self.alpha_v.get(key, self.alpha_v[DEFAULT])
-                else:  # Scalar (int or float)
-                    self.alpha_v_all[key] = self.alpha_v
+        if type(self.alpha_v) is dict:
+            self.alpha_v_all = SparseTable({key: value for key, value in self.alpha_v.items()
+                                            if key != DEFAULT}, self.alpha_v[DEFAULT])
+        else:  # Scalar (int or float)
+            self.alpha_v_all = SparseTable(dict(), self.alpha_v)
 
     def _initialize_alpha_w_all(self):
-        type_alpha_w = type(self.alpha_w)
-        self.alpha_w_all = dict()
+        if type(self.alpha_w) is dict:
+            default = self.alpha_w[DEFAULT]
+            self.alpha_w_all = {element: self.alpha_w.get(element, default)
+                                for element in self.stimulus_elements}
+        else:  # Scalar (int or float)
+            self.alpha_w_all = dict.fromkeys(self.stimulus_elements, self.alpha_w)
+
+    def _initialize_uc(self):
+        # u
         for element in self.stimulus_elements:
-            if type_alpha_w is dict:
-                self.alpha_w_all[element] = self.alpha_w.get(element, self.alpha_w[DEFAULT])
-            else:  # Scalar (int or float)
-                self.alpha_w_all[element] = self.alpha_w
+            if element not in self.u:
+                self.u[element] = self.u[DEFAULT]
+        if DEFAULT in self.u:
+            self.u.pop(DEFAULT)
+
+        # c
+        for behavior in self.behaviors:
+            if behavior not in self.c:
+                self.c[behavior] = self.c[DEFAULT]
+        if DEFAULT in self.c:
+            self.c.pop(DEFAULT)
+
+
+class Mechanism():
+    '''Base class for mechanisms'''
+
+    # Whether learn_and_respond uses kernels compiled by write_kernel instead of learn
+    use_kernels = True
+
+    def __init__(self, **kwargs):
+        self._use_config(MechanismConfig(kwargs))
+        self.subject_reset()
+
+    @classmethod
+    def from_config(cls, config):
+        '''A new Mechanism object with the MechanismConfig object config, which is shared, not
+           copied or validated again.'''
+        mechanism = cls.__new__(cls)
+        mechanism._use_config(config)
+        mechanism.subject_reset()
+        return mechanism
+
+    def _use_config(self, config):
+        self.config = config
+        for name in MechanismConfig.FIELDS:
+            setattr(self, name, getattr(config, name))
+
+        # Keys are (prev_stimulus, stimulus, response), values are kernels (see LsKernel).
+        # Shared by the copies of the mechanism, and kept between subjects.
+        self.kernels = dict()
+
+    def __deepcopy__(self, memo):
+        # The config is shared, only the state of the subject is copied
+        mechanism = copy.copy(self)
+        mechanism.v = self.v.copy()
+        mechanism.w = dict(self.w)
+        mechanism.kernels = self.kernels
+        return mechanism
+
+    def __getstate__(self):
+        # Compiled kernels cannot be pickled, they are compiled again when needed
+        state = dict(self.__dict__)
+        state['kernels'] = dict()
+        return state
 
     def subject_reset(self):
         self._initialize_v()
@@ -205,19 +296,59 @@ class Mechanism():
 
     def learn_and_respond(self, stimulus):
         ''' stimulus is a tuple. '''
-        element_in_omit = False
-        for e in stimulus:
-            if e in self.omit_learning:
-                element_in_omit = True
-                break
-        if self.prev_stimulus is not None and not element_in_omit:  # (self.set_omit_learning & set(stimulus)):
-            '''Do not update if first time or if any stimulus element is in omit'''
-            self.learn(stimulus)
+        if self.prev_stimulus is not None:  # Do not update if first time
+            self.learn_step(stimulus)
 
         self.response = self._get_response(stimulus)
         self.prev_stimulus = stimulus
         return self.response
 
+    def learn_step(self, stimulus):
+        '''Updates v and w for stimulus after prev_stimulus and response.'''
+        if self.use_kernels:
+            key = (self.prev_stimulus, stimulus, self.response)
+            kernel = self.kernels.get(key)
+            if kernel is None:
+                kernel = self._make_kernel(stimulus)
+            if kernel is None:
+                self.learn(stimulus)
+            else:
+                kernel(self.v, self.w)
+        else:
+            element_in_omit = False
+            for e in stimulus:
+                if e in self.omit_learning:
+                    element_in_omit = True
+                    break
+            if not element_in_omit:  # (self.set_omit_learning & set(stimulus)):
+                '''Do not update if any stimulus element is in omit'''
+                self.learn(stimulus)
+
+    def _make_kernel(self, stimulus):
+        '''Compiles and caches the kernel for stimulus after prev_stimulus and response.
+           Returns None, and stops using kernels, if the mechanism cannot write it.'''
+        if any(e in self.omit_learning for e in stimulus):
+            kernel = no_learning
+        else:
+            writer = KernelWriter()
+            if not self.write_kernel(writer, self.prev_stimulus, stimulus, self.response):
+                self.use_kernels = False
+                return None
+            kernel = writer.compile()
+        self.kernels[(self.prev_stimulus, stimulus, self.response)] = kernel
+        return kernel
+
+    def write_kernel(self, writer, prev_stimulus, stimulus, response):
+        '''Writes to the KernelWriter writer the statements of learn(stimulus) after
+           prev_stimulus and response. Returns False if learn() is not written as a kernel.'''
+        return False
+
+    def _usum(self, stimulus):
+        usum = 0
+        for element in stimulus:
+            usum += self.u[element]
+        return usum
+
     def _get_response(self, stimulus):
         x, feasible_behaviors = self._support_vector(stimulus)
         q = random() * sum(x)
@@ -238,27 +369,12 @@ class Mechanism():
         #     vector.append(value)
         # return vector
 
-    def _initialize_uc(self):
-        # u
-        for element in self.stimulus_elements:
-            if element not in self.u:
-                self.u[element] = self.u[DEFAULT]
-        if DEFAULT in self.u:
-            self.u.pop(DEFAULT)
-
-        # c
-        for behavior in self.behaviors:
-            if behavior not in self.c:
-                self.c[behavior] = self.c[DEFAULT]
-        if DEFAULT in self.c:
-            self.c.pop(DEFAULT)
-
     def _initialize_v(self):
-        self.v = dict()
-        for element in self.stimulus_elements:
-            for behavior in self.behaviors:
-                key = (element, behavior)
-                self.v[key] = self.start_v.get(key, self.start_v[DEFAULT])
+        self.v = SparseTable(self.start_v_pairs, self.start_v[DEFAULT])
+
+    def start_value(self, key):
+        '''The start value of v for the (stimulus element, behavior) pair key.'''
+        return self.start_v.get(key, self.start_v[DEFAULT])
 
     def _initialize_w(self):
         self.w = dict()
@@ -328,6 +444,19 @@ class RescorlaWagner(Mechanism):
             self.v[(element, self.response)] += self.alpha_v * \
                 (usum - vsum - self.c[self.response])
 
+    def write_kernel(self, writer, prev_stimulus, stimulus, response):
+        if type(self.alpha_v) is dict:
+            return False
+        const = writer.const
+        keys = [const((element, response)) for element in prev_stimulus]
+        writer.add("vsum = " + writer.sum("v[{}]".format(key) for key in keys))
+        writer.add("delta = {} * ({} - vsum - {})".format(const(self.alpha_v),
+                                                          const(self._usum(stimulus)),
+                                                          const(self.c[response])))
+        for key in keys:
+            writer.add("v[{}] += delta".format(key))
+        return True
+
 
 # class SARSA(Mechanism):
 #     def __init__(self, **kwargs):
@@ -374,6 +503,30 @@ class EXP_SARSA(Mechanism):
             delta = alpha_v * (usum + E - self.c[self.response] - vsum_prev)
             self.v[(element, self.response)] += delta
 
+    def write_kernel(self, writer, prev_stimulus, stimulus, response):
+        const = writer.const
+        beta = const(self.beta)
+        expected_values = list()
+        for i, element in enumerate(stimulus):
+            feasible_behaviors = get_feasible_behaviors((element,), self.behaviors,
+                                                        self.stimulus_req)
+            keys = [const((element, b)) for b in feasible_behaviors]
+            for j, key in enumerate(keys):
+                writer.add("x{} = exp(0 + {} * v[{}])".format(j, beta, key))
+            writer.add("sum_x = " + writer.sum("x{}".format(j) for j in range(len(keys))))
+            writer.add("ev{} = ".format(i) + writer.sum("x{} / sum_x * v[{}]".format(j, key)
+                                                      for j, key in enumerate(keys)))
+            expected_values.append("ev{}".format(i))
+        writer.add("E = " + writer.sum(expected_values))
+        writer.add("vsum_prev = " + writer.sum("v[{}]".format(const((element, response)))
+                                               for element in prev_stimulus))
+        writer.add("d = {} + E - {} - vsum_prev".format(const(self._usum(stimulus)),
+                                                         const(self.c[response])))
+        for element in prev_stimulus:
+            writer.add("v[{}] += {} * d".format(const((element, response)),
+                                                const(self.alpha_v_all[(element, response)])))
+        return True
+
 
 class Qlearning(Mechanism):
     def __init__(self, **kwargs):
@@ -403,6 +556,29 @@ class Qlearning(Mechanism):
             delta = alpha_v * (usum + maxvsum_future - self.c[self.response] - vsum_prev)
             self.v[(element, self.response)] += delta
 
+    def write_kernel(self, writer, prev_stimulus, stimulus, response):
+        const = writer.const
+        if len(stimulus) == 0:
+            writer.add("m = 0")
+        for index, element in enumerate(stimulus):
+            feasible_behaviors = get_feasible_behaviors((element,), self.behaviors,
+                                                        self.stimulus_req)
+            vsum_future = writer.sum("v[{}]".format(const((element, b)))
+                                     for b in feasible_behaviors)
+            if index == 0:
+                writer.add("m = " + vsum_future)
+            else:
+                writer.add("f = " + vsum_future)
+                writer.add("if f > m: m = f")
+        writer.add("vsum_prev = " + writer.sum("v[{}]".format(const((element, response)))
+                                               for element in prev_stimulus))
+        writer.add("d = {} + m - {} - vsum_prev".format(const(self._usum(stimulus)),
+                                                         const(self.c[response])))
+        for element in prev_stimulus:
+            writer.add("v[{}] += {} * d".format(const((element, response)),
+                                                const(self.alpha_v_all[(element, response)])))
+        return True
+
 
 '''class ActorCritic(Mechanism):
     def __init__(self, **kwargs):
@@ -451,6 +627,23 @@ class ActorCritic(Mechanism):
         for element in self.prev_stimulus:
             self.w[element] += delta
 
+    def write_kernel(self, writer, prev_stimulus, stimulus, response):
+        if type(self.alpha_v) is dict or type(self.alpha_w) is dict:
+            return False
+        const = writer.const
+        writer.add("wsum_prev = " + writer.sum("w[{}]".format(const(element))
+                                               for element in prev_stimulus))
+        writer.add("wsum = " + writer.sum("w[{}]".format(const(element)) for element in stimulus))
+        writer.add("d = {} + wsum - {} - wsum_prev".format(const(self._usum(stimulus)),
+                                                            const(self.c[response])))
+        writer.add("delta = {} * d".format(const(self.alpha_v)))
+        for element in prev_stimulus:
+            writer.add("v[{}] += delta".format(const((element, response))))
+        writer.add("delta = {} * d".format(const(self.alpha_w)))
+        for element in prev_stimulus:
+            writer.add("w[{}] += delta".format(const(element)))
+        return True
+
 
 class Enquist(Mechanism):
     def __init__(self, **kwargs):
@@ -473,3 +666,21 @@ class Enquist(Mechanism):
         for element in self.prev_stimulus:
             delta = self.alpha_w_all[element] * (usum + wsum - self.c[self.response] - wsum_prev)
             self.w[element] += delta
+
+    def write_kernel(self, writer, prev_stimulus, stimulus, response):
+        const = writer.const
+        writer.add("vsum_prev = " + writer.sum("v[{}]".format(const((element, response)))
+                                               for element in prev_stimulus))
+        writer.add("wsum_prev = " + writer.sum("w[{}]".format(const(element))
+                                               for element in prev_stimulus))
+        writer.add("wsum = " + writer.sum("w[{}]".format(const(element)) for element in stimulus))
+        usum_c = "{} + wsum - {}".format(const(self._usum(stimulus)), const(self.c[response]))
+        writer.add("dv = {} - vsum_prev".format(usum_c))
+        writer.add("dw = {} - wsum_prev".format(usum_c))
+        for element in prev_stimulus:
+            writer.add("v[{}] += {} * dv".format(const((element, response)),
+                                                 const(self.alpha_v_all[(element, response)])))
+        for element in prev_stimulus:
+            writer.add("w[{}] += {} * dw".format(const(element),
+                                                 const(self.alpha_w_all[element])))
+        return True
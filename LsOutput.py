@@ -1,14 +1,21 @@
 import LsUtil
 import LsMechanism
+from LsHistory import PatternCounter, new_history
 from LsExceptions import LsEvalException
 from LsConstants import *
 
+from bisect import bisect_left, bisect_right
+
 
 class ScriptOutput():
     def __init__(self, run_outputs):
         # A dict with RunOutput objects, keys are run-labels
         self.run_outputs = run_outputs
 
+        # An EvalCache object with the planned evaluations of the post commands while they are
+        # run, otherwise None
+        self.eval_cache = None
+
     def write_v(self, run_label, subject_ind, stimulus, response, step, mechanism):
         '''stimulus is a tuple.'''
         self.run_outputs[run_label].write_v(subject_ind, stimulus, response, step, mechanism)
@@ -19,8 +26,12 @@ class ScriptOutput():
 
     def vwpn_eval(self, vwph, er, evalprops):
         evalprops = self._evalparse(evalprops)
-        run_label = evalprops[EVAL_RUNLABEL]
-        return self.run_outputs[run_label].vwpn_eval(vwph, er, evalprops)
+        run_output = self.run_outputs[evalprops[EVAL_RUNLABEL]]
+        cache = self.eval_cache
+        if cache is None:
+            return run_output.vwpn_eval(vwph, er, evalprops)
+        return cache.get(EvalCache.eval_key(vwph, er, evalprops),
+                         lambda: run_output.vwpn_eval(vwph, er, evalprops, cache))
 
     def printout(self):
         for run_label, run_output in self.run_outputs.items():
@@ -101,13 +112,79 @@ class ScriptOutput():
         return evalprops
 
 
+class EvalCache():
+    '''Sub-evaluations shared by several evaluations of a ScriptOutput: the history in some
+       phases, the matches of a pattern in it, the v or w value of a subject at each step, p
+       of a subject, and whole evaluations that are made more than once.
+
+       plan is first called with each evaluation that is to be made, and counts the uses of
+       each sub-evaluation. When the evaluations are then made, a sub-evaluation that is used
+       more than once is computed at its first use and kept until its last use. Kept values are
+       shared by their users, and must not be modified.
+    '''
+
+    def __init__(self):
+        # Keys are sub-evaluation keys, values are their number of (remaining) uses
+        self.uses = dict()
+
+        # Keys are sub-evaluation keys, values are computed values kept for later uses
+        self.values = dict()
+
+    def plan(self, script_output, vwpn, arg, evalprops):
+        '''Counts the sub-evaluations of script_output.vwpn_eval(vwpn, arg, evalprops).'''
+        try:
+            evalprops = script_output._evalparse(dict(evalprops))
+        except LsEvalException:
+            return  # Raised when the evaluation is made
+        if not self.use(EvalCache.eval_key(vwpn, arg, evalprops)):
+            return
+        run_output = script_output.run_outputs[evalprops[EVAL_RUNLABEL]]
+        subject_ind = evalprops[EVAL_SUBJECT]
+        if subject_ind == EVAL_AVERAGE or subject_ind == EVAL_ALL:
+            subjects = run_output.output_subjects
+        else:
+            subjects = [run_output.output_subjects[subject_ind]]
+        for output_subject in subjects:
+            output_subject.plan_eval(self, vwpn, arg, evalprops)
+
+    def use(self, key):
+        '''Counts a use of the sub-evaluation key. Returns True for its first use.'''
+        uses = self.uses.get(key, 0)
+        self.uses[key] = uses + 1
+        return uses == 0
+
+    def get(self, key, fun):
+        '''Returns the value of the sub-evaluation key, computed with fun() if not kept.'''
+        uses = self.uses.pop(key, 0)
+        if key in self.values:
+            value = self.values.pop(key)
+        else:
+            value = fun()
+        if uses > 1:
+            self.uses[key] = uses - 1
+            self.values[key] = value
+        return value
+
+    @staticmethod
+    def eval_key(vwpn, arg, evalprops):
+        props = sorted((prop, value) for prop, value in evalprops.items()
+                       if prop != EVAL_FILENAME)
+        return ('eval', vwpn, repr(arg), repr(props))
+
+
 class RunOutput():
-    def __init__(self, n_subjects, stimulus_req):
+    def __init__(self, n_subjects, stimulus_req, record=RECORD_ALL, sampled=False,
+                 patterns=None, start_v=None, history_coding=None):
         # A list of RunOutputSubject objects
         self.output_subjects = list()
         self.n_subjects = n_subjects
         for _ in range(n_subjects):
-            self.output_subjects.append(RunOutputSubject(stimulus_req))
+            self.output_subjects.append(RunOutputSubject(stimulus_req, record, sampled,
+                                                         patterns, start_v, history_coding))
+
+        # For a run with an adaptive number of subjects, a dict with the achieved standard
+        # error and the number of subjects used (see LsAdaptive.run), otherwise None
+        self.precision = None
 
     def write_v(self, subject_ind, stimulus, response, step, mechanism):
         '''stimulus is a tuple.'''
@@ -117,27 +194,41 @@ class RunOutput():
         '''stimulus is a tuple.'''
         self.output_subjects[subject_ind].write_w(stimulus, step, mechanism)
 
+    def write_all(self, subject_ind, step, mechanism):
+        self.output_subjects[subject_ind].write_all(step, mechanism)
+
     def write_history(self, subject_ind, stimulus, response):
         self.output_subjects[subject_ind].write_history(stimulus, response)
 
     def write_step(self, subject_ind, phase_label, step):
         self.output_subjects[subject_ind].write_step(phase_label, step)
 
-    def vwpn_eval(self, vwpn, er, evalprops):
+    def vwpn_eval(self, vwpn, er, evalprops, cache=None):
         '''er is a (element, response) tuple'''
         subject_ind = evalprops[EVAL_SUBJECT]
         if subject_ind == EVAL_AVERAGE:
             eval_subjects = list()
             for i in range(self.n_subjects):
-                eval_subjects.append(self.output_subjects[i].vwpn_eval(vwpn, er, evalprops))
+                eval_subjects.append(self.output_subjects[i].vwpn_eval(vwpn, er, evalprops,
+                                                                       cache))
+            if isinstance(eval_subjects[0], Series):
+                x, y = LsUtil.eval_average_xy([s.x for s in eval_subjects], eval_subjects)
+                return Series(y, x)
             return LsUtil.eval_average(eval_subjects)
         elif subject_ind == EVAL_ALL:
             eval_subjects = list()
             for i in range(self.n_subjects):
-                eval_subjects.append(self.output_subjects[i].vwpn_eval(vwpn, er, evalprops))
+                eval_subjects.append(self.output_subjects[i].vwpn_eval(vwpn, er, evalprops,
+                                                                       cache))
+            if len(eval_subjects) > 0 and isinstance(eval_subjects[0], Series):
+                # Use the same x for all subjects, so that row i is the same step for all
+                x = sorted(set().union(*[s.x for s in eval_subjects]))
+                eval_subjects = [Series(LsUtil.hold_resample(s.x, s, x), x) for s in eval_subjects]
+                for s in eval_subjects:
+                    del s.x[len(s):]
             return eval_subjects
         else:
-            return self.output_subjects[subject_ind].vwpn_eval(vwpn, er, evalprops)
+            return self.output_subjects[subject_ind].vwpn_eval(vwpn, er, evalprops, cache)
 
     def printout(self):
         i = 0
@@ -148,39 +239,98 @@ class RunOutput():
 
 
 class RunOutputSubject():
-    def __init__(self, stimulus_req):
+    def __init__(self, stimulus_req, record=RECORD_ALL, sampled=False, patterns=None,
+                 start_v=None, history_coding=None):
         self.stimulus_req = stimulus_req
 
+        # The start_v parameter of the mechanism. v of a pair that is not in v (neither a
+        # possible response to the element nor learned) has its start value at all steps.
+        self.start_v = start_v
+
+        # If True, v and w are recorded for all keys at some steps only (see write_all), and
+        # evaluation of v, w and p returns Series objects with the recorded steps as x
+        self.sampled = sampled
+
+        # The class of the Val objects in v and w
+        if record == RECORD_CHANGES:
+            self.val_class = DeltaVal
+        else:
+            self.val_class = Val
+
         # Keys are 2-tuples (stimulus_element,response), values are Val objects
         self.v = dict()
 
         # Keys are stimulus elements (strings), values are Val objects
         self.w = dict()
 
-        # History of stimulus and responses [S1,R1,S2,R2,...]
-        self.history = list()
+        # History of stimulus and responses [S1,R1,S2,R2,...], or None if not kept. A list, or
+        # a LsHistory.CodedHistory or RunLengthHistory if history_coding is HISTORY_CODED or
+        # HISTORY_RUN_LENGTH.
+        self.history = new_history(history_coding) if patterns is None else None
+
+        # If the history is not kept, a PatternCounter that finds the (pattern,
+        # use_exact_match) in the list patterns while the history is written
+        self.counter = None if patterns is None else PatternCounter(patterns)
 
         # Tuple where first index is list of phase labels, second is list of step numbers for
-        # first step in each phase
+        # first step in each phase. A phase that is repeated after another phase has an item
+        # for each time. The last item is 'last' with the number of steps.
         self.first_step_phase = (list(), list())
 
+        # Keys are phase labels, values are lists of (first step, end step) of each time the
+        # phase occurs. Made from first_step_phase when first needed (see phase_index).
+        self._phase_index = None
+
+        # The file with the data, if the subject is memory-mapped from a file written by
+        # LsStore.save_subject
+        self.spill_file = None
+
+        # The shared memory block with the data, if the subject was sent from another process
+        # by LsStore.to_shared_memory. Deleted after v, w and history, which are views into it.
+        self.shared_memory = None
+
+    def __getstate__(self):
+        # A memory-mapped subject is pickled as its file name, and mapped again when unpickled
+        if self.spill_file is not None:
+            return {'spill_file': self.spill_file}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if state.get('spill_file') is not None and len(state) == 1:
+            import LsStore
+            spill_file = state['spill_file']
+            state = LsStore.load_subject(spill_file).__dict__
+            state['spill_file'] = spill_file
+        self.__dict__.update(state)
+
     def write_history(self, stimulus, response):
         assert(type(stimulus) is tuple)
         if len(stimulus) == 1:
-            self.history.append(stimulus[0])
+            stimulus = stimulus[0]
+        history = self.history
+        if history is None:
+            self.counter.write(stimulus)
+            self.counter.write(response)
+        elif type(history) is list:
+            history.append(stimulus)
+            history.append(response)
         else:
-            self.history.append(stimulus)
-        self.history.append(response)
+            history.write(stimulus, response)
 
     def write_step(self, phase_label, step):
-        if phase_label not in self.first_step_phase[0]:
-            self.first_step_phase[0].append(phase_label)
+        phase_labels = self.first_step_phase[0]
+        if len(phase_labels) == 0 or phase_labels[-1] != phase_label:
+            phase_labels.append(phase_label)
             self.first_step_phase[1].append(step)
+            self._phase_index = None
+            if self.counter is not None:
+                self.counter.boundary(2 * step)
 
-    def vwpn_eval(self, vwpn, arg, evalprops):
+    def vwpn_eval(self, vwpn, arg, evalprops, cache=None):
+        if cache is None:
+            cache = EvalCache()
         if vwpn == 'n':
-            _, history = self.phasefilter(None, evalprops)
-            return RunOutputSubject.n_eval(arg, history, evalprops)
+            return self.n_eval(arg, evalprops, cache)
         else:
             switcher = {
                 'v': self.v_eval,
@@ -188,34 +338,139 @@ class RunOutputSubject():
                 'p': self.p_eval,
             }
             fun = switcher[vwpn]
-            funout = fun(arg, evalprops)
-            funout, history = self.phasefilter(funout, evalprops)
-            return self.stepsfilter(funout, history, evalprops)
+            funout = fun(arg, evalprops, cache)
+            funout = self.phasefilter(funout, evalprops)
+            return self.stepsfilter(funout, evalprops, cache)
 
-    def phasefilter(self, evalout, evalprops):
+    def plan_eval(self, cache, vwpn, arg, evalprops):
+        '''Counts the sub-evaluations of vwpn_eval(vwpn, arg, evalprops) in the EvalCache
+           object cache.'''
+        if vwpn == 'n':
+            seqs = arg if type(arg) is tuple else (arg, None)
+            exact_n = (evalprops[EVAL_EXACTN] == EVAL_ON)
+            for seq in seqs:
+                if seq is not None:
+                    self._plan_match(cache, seq, exact_n, evalprops)
+        elif not self.sampled:
+            if vwpn == 'v' or vwpn == 'w':
+                cache.use((self, vwpn, arg))
+            elif vwpn == 'p' and cache.use(self._p_key(arg, evalprops)):
+                for er in self._p_v_keys(arg, self.behaviors()):
+                    cache.use((self, 'v', er))
+        if evalprops[EVAL_STEPS] != EVAL_ALL:
+            exact_steps = (evalprops[EVAL_EXACTSTEPS] == EVAL_ON)
+            self._plan_match(cache, evalprops[EVAL_STEPS], exact_steps, evalprops)
+
+    def _plan_match(self, cache, pattern, use_exact_match, evalprops):
+        if cache.use(self._match_key(pattern, use_exact_match, evalprops)):
+            phases = RunOutputSubject.eval_phases(evalprops)
+            if phases is not None and self.history is not None:
+                cache.use((self, 'history', phases))
+
+    def _match_key(self, pattern, use_exact_match, evalprops):
+        return (self, 'match', RunOutputSubject.eval_phases(evalprops), repr(pattern),
+                use_exact_match)
+
+    def _p_v_keys(self, sr, behaviors):
+        '''The keys of v that p of the tuple (S,R) sr depends on.'''
+        feasible_behaviors = LsMechanism.get_feasible_behaviors(sr[0], behaviors,
+                                                                self.stimulus_req)
+        return [(element, behavior) for element in sr[0] for behavior in feasible_behaviors]
+
+    def _p_key(self, sr, evalprops):
+        return (self, 'p', repr(sr), evalprops.get(BETA))
+
+    @staticmethod
+    def eval_phases(evalprops):
+        '''The tuple of phase labels in evalprops, or None for all phases.'''
         if EVAL_PHASE not in evalprops:
-            return evalout, self.history
+            return None
+        phases = evalprops[EVAL_PHASE]
+        if type(phases) is not tuple:
+            phases = (phases,)
+        return phases
+
+    def phase_index(self):
+        '''A dict with phase labels as keys and lists of (first step, end step) of each time
+           the phase occurs as values.'''
+        if self._phase_index is None:
+            phase_labels, first_steps = self.first_step_phase
+            index = dict()
+            for i in range(len(phase_labels) - 1):
+                index.setdefault(phase_labels[i], list()).append((first_steps[i],
+                                                                  first_steps[i + 1]))
+            self._phase_index = index
+        return self._phase_index
+
+    def phase_ranges(self, phases):
+        '''The list of (first step, end step) of the phase labels in phases, in the order of
+           phases. Adjacent ranges are joined.'''
+        index = self.phase_index()
+        for phase in phases:
+            if phase not in index:
+                raise LsEvalException("Invalid phase label {}.".format(phase))
+        ranges = list()
+        for phase in phases:
+            for start, end in index[phase]:
+                if len(ranges) > 0 and ranges[-1][1] == start:
+                    ranges[-1] = (ranges[-1][0], end)
+                else:
+                    ranges.append((start, end))
+        return ranges
+
+    def history_ranges(self, phases):
+        '''The list of (start, end) history indices of the phase labels in phases, or of the
+           whole history if phases is None.'''
+        if phases is None:
+            if self.history is None:
+                return [(0, self.counter.n_items)]
+            return [(0, len(self.history))]
+        return [(2 * phase_startind, 2 * phase_endind)
+                for phase_startind, phase_endind in self.phase_ranges(phases)]
+
+    def phase_history(self, evalprops, cache):
+        '''The history in the phases of evalprops.'''
+        phases = RunOutputSubject.eval_phases(evalprops)
+        if phases is None:
+            return self.history
+
+        return cache.get((self, 'history', phases),
+                         lambda: select_ranges(self.history, self.history_ranges(phases)))
+
+    def find_and_cumsum(self, pattern, use_exact_match, evalprops, cache):
+        '''LsUtil.find_and_cumsum on the history in the phases of evalprops.'''
+        if self.history is None:
+            ranges = self.history_ranges(RunOutputSubject.eval_phases(evalprops))
+            return cache.get(self._match_key(pattern, use_exact_match, evalprops),
+                             lambda: self.counter.find_and_cumsum(pattern, use_exact_match,
+                                                                  ranges))
+        return cache.get(self._match_key(pattern, use_exact_match, evalprops),
+                         lambda: LsUtil.find_and_cumsum(self.phase_history(evalprops, cache),
+                                                        pattern, use_exact_match))
+
+    def phasefilter(self, evalout, evalprops):
+        phases = RunOutputSubject.eval_phases(evalprops)
+        if phases is None:
+            return evalout
+        elif isinstance(evalout, Series):
+            return self.phasefilter_series(evalout, phases)
         else:
-            out = list()
-            history_out = list()
-            phases = evalprops[EVAL_PHASE]
-            if type(phases) is not tuple:
-                phases = (phases,)
-            for phase in phases:
-                if phase not in self.first_step_phase[0]:
-                    raise LsEvalException("Invalid phase label {}.".format(phase))
-            for phase in phases:
-                fsp_index = self.first_step_phase[0].index(phase)
-                phase_startind = self.first_step_phase[1][fsp_index]
-                phase_endind = self.first_step_phase[1][fsp_index + 1]  # - 1
-                for j in range(phase_startind, phase_endind):
-                    history_out.append(self.history[2 * j])
-                    history_out.append(self.history[2 * j + 1])
-                    if evalout is not None:
-                        out.append(evalout[j])
-            return out, history_out
-
-    def stepsfilter(self, evalout, history, evalprops):
+            return select_ranges(evalout, self.phase_ranges(phases))
+
+    def phasefilter_series(self, evalout, phases):
+        '''phasefilter for a Series. The x of the output is the step in the filtered history.'''
+        out = list()
+        x_out = list()
+        offset = 0
+        for phase_startind, phase_endind in self.phase_ranges(phases):
+            for i in range(bisect_left(evalout.x, phase_startind),
+                           bisect_left(evalout.x, phase_endind)):
+                out.append(evalout[i])
+                x_out.append(offset + evalout.x[i] - phase_startind)
+            offset += phase_endind - phase_startind
+        return Series(out, x_out)
+
+    def stepsfilter(self, evalout, evalprops, cache):
         eval_steps = evalprops[EVAL_STEPS]
         if eval_steps == EVAL_ALL:
             return evalout
@@ -223,13 +478,17 @@ class RunOutputSubject():
             pattern = eval_steps
             pattern_len = RunOutputSubject.compute_patternlen(pattern)
             use_exact_match = (evalprops[EVAL_EXACTSTEPS] == EVAL_ON)
-            findind, cumsum = LsUtil.find_and_cumsum(history, pattern, use_exact_match)
+            findind, cumsum = self.find_and_cumsum(pattern, use_exact_match, evalprops, cache)
             n_matches = cumsum[-1]
             out = [None] * n_matches
             out_ind = 0
+            is_series = isinstance(evalout, Series)
             for history_ind, zero_or_one in enumerate(findind):
                 if zero_or_one == 1:
                     evalout_ind = RunOutputSubject.historyind2stepind(history_ind, pattern_len)
+                    if is_series:
+                        # The last recorded value at or before the step
+                        evalout_ind = max(bisect_right(evalout.x, evalout_ind) - 1, 0)
                     out[out_ind] = evalout[evalout_ind]
                     out_ind += 1
             return out
@@ -247,24 +506,60 @@ class RunOutputSubject():
             pattern_len = 1
         return pattern_len
 
-    def v_eval(self, er, evalprops):
-        return self.v[er].evaluate(evalprops)
+    def v_eval(self, er, evalprops, cache):
+        if self.sampled:
+            return self.v_val(er).samples()
+        return cache.get((self, 'v', er), lambda: self.v_val(er).evaluate(evalprops))
+
+    def v_val(self, er):
+        '''The Val object of v for the (element, response) tuple er.'''
+        val = self.v.get(er)
+        if val is not None:
+            return val
+        if (self.start_v is None or len(self.v) == 0 or er[0] not in self.stimulus_req or
+                er[1] not in self.behaviors()):
+            raise LsEvalException("v{} is not recorded.".format(er))
+
+        # A pair that was never learned has its start value at the steps of the other pairs
+        start = self.start_v.get(er, self.start_v[LsMechanism.DEFAULT])
+        steps = next(iter(self.v.values())).steps
+        val = Val()
+        if self.sampled:
+            val.steps = list(steps)
+            val.values = [start] * len(steps)
+        else:
+            val.steps = [0, steps[-1]]
+            val.values = [start, start]
+        return val
+
+    def behaviors(self):
+        '''The behaviors in the keys of v, in order of appearance.'''
+        behaviors = list()
+        for _, behavior in self.v:
+            if behavior not in behaviors:
+                behaviors.append(behavior)
+        return behaviors
 
-    def w_eval(self, element, evalprops):
-        return self.w[element].evaluate(evalprops)
+    def w_eval(self, element, evalprops, cache):
+        if self.sampled:
+            return self.w[element].samples()
+        return cache.get((self, 'w', element), lambda: self.w[element].evaluate(evalprops))
 
-    def p_eval(self, sr, evalprops):
+    def p_eval(self, sr, evalprops, cache):
         '''sr is a tuple (S,R) where S=(E1,E2,...).'''
-        v_val = dict(self.v)
-        behaviors = list()
+        if self.sampled:
+            return self._p_eval(sr, evalprops, cache)
+        return cache.get(self._p_key(sr, evalprops),
+                         lambda: self._p_eval(sr, evalprops, cache))
+
+    def _p_eval(self, sr, evalprops, cache):
+        behaviors = self.behaviors()
+        v_val = dict()
         nval = 0
-        for er, _ in v_val.items():
-            v_val[er] = self.v_eval(er, evalprops)
+        for er in self._p_v_keys(sr, behaviors):
+            v_val[er] = self.v_eval(er, evalprops, cache)
             if nval == 0:
                 nval = len(v_val[er])
-            behavior = er[1]
-            if behavior not in behaviors:
-                behaviors.append(behavior)
 
         out = [None] * nval
         for i in range(nval):
@@ -272,10 +567,11 @@ class RunOutputSubject():
             out[i] = LsMechanism.probability_of_response(sr[0], sr[1], behaviors,
                                                          self.stimulus_req, evalprops[BETA],
                                                          v_local)
+        if self.sampled:
+            return Series(out, v_val[er].x)
         return out
 
-    @staticmethod
-    def n_eval(seqs, history, evalprops):
+    def n_eval(self, seqs, evalprops, cache):
         seqstype = type(seqs)
         if seqstype is not tuple:
             seqs = (seqs, None)
@@ -283,21 +579,22 @@ class RunOutputSubject():
         seqref = seqs[1]
         exact_n = (evalprops[EVAL_EXACTN] == EVAL_ON)
         cumulative = (evalprops[EVAL_CUMULATIVE] == EVAL_ON)
-        findind_seq, cumsum_seq = LsUtil.find_and_cumsum(history, seq, exact_n)
+        findind_seq, cumsum_seq = self.find_and_cumsum(seq, exact_n, evalprops, cache)
 
         steps = evalprops[EVAL_STEPS]
         all_steps = (steps == EVAL_ALL)
         findind_steps = None
         if not all_steps:
             exact_steps = (evalprops[EVAL_EXACTSTEPS] == EVAL_ON)
-            findind_steps, _ = LsUtil.find_and_cumsum(history, steps, exact_steps)
+            findind_steps, _ = self.find_and_cumsum(steps, exact_steps, evalprops, cache)
 
         args = [findind_steps, cumulative, all_steps]
         out_seq = RunOutputSubject.n_eval_out(findind_seq, cumsum_seq, *args)
         if seqref is None:
             out = out_seq
         else:
-            findind_seqref, cumsum_seqref = LsUtil.find_and_cumsum(history, seqref, exact_n)
+            findind_seqref, cumsum_seqref = self.find_and_cumsum(seqref, exact_n, evalprops,
+                                                                 cache)
             out_seqref = RunOutputSubject.n_eval_out(findind_seqref, cumsum_seqref, *args)
             out = LsUtil.arraydivide(out_seq, out_seqref)
         return [0] + out
@@ -320,16 +617,38 @@ class RunOutputSubject():
         for element in stimulus:
             key = (element, response)
             if key not in self.v:
-                self.v[key] = Val()
+                self._add_v(key, step, mechanism)
             self.v[key].write(mechanism.v[key], step)
 
+    def _add_v(self, key, step, mechanism):
+        '''Adds the Val object of a v key that is first written at step. It gets the start
+           value at the steps before, at which it was not learned.'''
+        val = self.val_class()
+        if step > 0:
+            start = mechanism.start_value(key)
+            steps = next(iter(self.v.values())).steps if self.sampled else [0]
+            for prev_step in steps:
+                val.write(start, prev_step)
+        self.v[key] = val
+
     def write_w(self, stimulus, step, mechanism):
         for element in stimulus:
             key = element
             if key not in self.w:
-                self.w[key] = Val()
+                self.w[key] = self.val_class()
             self.w[key].write(mechanism.w[key], step)
 
+    def write_all(self, step, mechanism):
+        '''Writes the current value of all keys in v and w, and of the v keys the mechanism
+           has learned that are not yet in v.'''
+        for key in mechanism.v:
+            if key not in self.v:
+                self._add_v(key, step, mechanism)
+        for key, val in self.v.items():
+            val.write(mechanism.v[key], step)
+        for key, val in self.w.items():
+            val.write(mechanism.w[key], step)
+
     def printout(self):
         for key, val in self.v.items():
             print("v({0}) = {1})".format(key, val))
@@ -339,6 +658,23 @@ class RunOutputSubject():
         print(self.history)
 
 
+def select_ranges(seq, ranges):
+    '''The items of the list or coded history (LsHistory.CodedHistory or RunLengthHistory) seq
+       in the (start, end) ranges. seq itself if the only range covers it, otherwise one slice
+       per range.'''
+    if hasattr(seq, 'select'):
+        return seq.select(ranges)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        if start == 0 and end >= len(seq):
+            return seq
+        return seq[start:end]
+    out = list()
+    for start, end in ranges:
+        out += seq[start:end]
+    return out
+
+
 class Val():
     def __init__(self):
         # List of float values
@@ -380,6 +716,40 @@ class Val():
         #     out.append(self.values[curr_ind])
         # return out
 
+    def samples(self):
+        '''Returns the values as a Series with the steps as x.'''
+        return Series(self.values, self.steps)
+
     def printout(self):
         print("values: {} floats".format(len(self.values)))
         print("steps: {} ints".format(len(self.steps)))
+
+
+class DeltaVal(Val):
+    '''A Val that only stores a value when it differs from the previous one.
+
+       A write of an unchanged value stores at most one extra point: the first unchanged
+       write is appended, and later ones move its step forward. Thus steps[-1] is always the
+       last written step, and evaluate gives the same result as for a Val with all writes.
+       A value is only unchanged if it also has the same type, so that an int start value
+       and an equal float are both kept (and exported as written).
+    '''
+
+    def write(self, value, step):
+        values = self.values
+        if len(values) >= 2 and values[-1] == value and values[-2] == value:
+            value_type = type(value)
+            if type(values[-1]) is value_type and type(values[-2]) is value_type:
+                self.steps[-1] = step
+                return
+        values.append(value)
+        self.steps.append(step)
+
+
+class Series(list):
+    '''A list of evaluated values (y) with the step (x) of each value, for evaluations of
+       runs where v and w are not recorded in every step.'''
+
+    def __init__(self, y, x):
+        super().__init__(y)
+        self.x = list(x)
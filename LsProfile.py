@@ -0,0 +1,260 @@
+import LsWorld
+import LsMechanism
+import LsOutput
+
+import cProfile
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Stage names
+PARSE = "parse"
+SIMULATION = "simulation"
+NEXT_STIMULUS = "World.next_stimulus"
+LEARN_AND_RESPOND = "Mechanism.learn_and_respond"
+WRITE_V = "RunOutput.write_v"
+WRITE_W = "RunOutput.write_w"
+WRITE_ALL = "RunOutput.write_all"
+WRITE_HISTORY = "RunOutput.write_history"
+WRITE_STEP = "RunOutput.write_step"
+POSTPROCESSING = "postprocessing"
+VWPN_EVAL = "ScriptOutput.vwpn_eval"
+
+# The stages nested in SIMULATION and POSTPROCESSING, respectively
+SIMULATION_STAGES = [NEXT_STIMULUS, LEARN_AND_RESPOND, WRITE_V, WRITE_W, WRITE_ALL,
+                     WRITE_HISTORY, WRITE_STEP]
+POSTPROCESSING_STAGES = [VWPN_EVAL]
+
+# The methods that are timed, as (class, method name, stage)
+TIMED_METHODS = [(LsWorld.World, 'next_stimulus', NEXT_STIMULUS),
+                 (LsMechanism.Mechanism, 'learn_and_respond', LEARN_AND_RESPOND),
+                 (LsOutput.RunOutput, 'write_v', WRITE_V),
+                 (LsOutput.RunOutput, 'write_w', WRITE_W),
+                 (LsOutput.RunOutput, 'write_all', WRITE_ALL),
+                 (LsOutput.RunOutput, 'write_history', WRITE_HISTORY),
+                 (LsOutput.RunOutput, 'write_step', WRITE_STEP),
+                 (LsOutput.ScriptOutput, 'vwpn_eval', VWPN_EVAL)]
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+def stage(profiler, name):
+    '''Context manager timing the stage name, or doing nothing if profiler is None.'''
+    if profiler is None:
+        return nullcontext()
+    else:
+        return profiler.stage(name)
+
+
+class StageTimer():
+    '''Accumulated wall-clock time and number of calls for a stage.'''
+
+    def __init__(self):
+        self.time = 0
+        self.calls = 0
+        self.active = False  # To not count recursive calls twice
+
+
+class Profiler():
+    '''Times the stages of lesim runs.
+
+       The methods in TIMED_METHODS are wrapped with timers while the profiler is started, so
+       nothing is added to the simulation loop when profiling is off. Optionally, a cProfile
+       dump and/or a file with sampled stacks in the "folded" format used by flame graph tools
+       (one "frame;frame;frame count" per line) are written when the profiler is stopped.
+    '''
+
+    def __init__(self, cprofile_file=None, stacks_file=None,
+                 sample_interval=DEFAULT_SAMPLE_INTERVAL):
+        self.cprofile_file = cprofile_file
+        self.stacks_file = stacks_file
+        self.sample_interval = sample_interval
+
+        # Keys are stage names, values are StageTimer objects
+        self.timers = dict()
+
+        # List of (label, StageTimer) for each post command, in order of execution
+        self.postcmd_timers = list()
+
+        self.wall_time = 0
+        self._start_time = None
+        self._originals = list()
+        self._cprofile = None
+        self._sampler = None
+
+    def start(self):
+        for cls, method_name, stage_name in TIMED_METHODS:
+            method = cls.__dict__[method_name]
+            self._originals.append((cls, method_name, method))
+            setattr(cls, method_name, self._timed(stage_name, method))
+        if self.cprofile_file is not None:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        if self.stacks_file is not None:
+            self._sampler = StackSampler(threading.current_thread().ident,
+                                         self.sample_interval)
+            self._sampler.start()
+        self._start_time = time.perf_counter()
+
+    def stop(self):
+        self.wall_time += time.perf_counter() - self._start_time
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler.write(self.stacks_file)
+            self._sampler = None
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_file)
+            self._cprofile = None
+        for cls, method_name, method in self._originals:
+            setattr(cls, method_name, method)
+        self._originals = list()
+
+    @contextmanager
+    def stage(self, name):
+        timer = self._timer(name)
+        t0 = time.perf_counter()
+        try:
+            yield timer
+        finally:
+            timer.time += time.perf_counter() - t0
+            timer.calls += 1
+
+    def instrument_postcmds(self, postcmds):
+        '''Wraps the run method of each command in the PostCmds object postcmds with a timer.'''
+        for cmd in postcmds.cmds:
+            timer = StageTimer()
+            self.postcmd_timers.append((postcmd_label(cmd), timer))
+            cmd.run = self._timed_call(timer, cmd.run)
+
+    def report(self):
+        lines = list()
+        lines.append("Profile (wall time {:.3f} s)".format(self.wall_time))
+        lines.append(self._header("Stage"))
+        for name in [PARSE, SIMULATION]:
+            lines.append(self._row(name, self.timers.get(name)))
+        other = self._time(SIMULATION)
+        for name in SIMULATION_STAGES:
+            lines.append(self._row("  " + name, self.timers.get(name)))
+            other -= self._time(name)
+        if SIMULATION in self.timers:
+            lines.append(self._row("  (other)", None, max(other, 0)))
+        lines.append(self._row(POSTPROCESSING, self.timers.get(POSTPROCESSING)))
+        for name in POSTPROCESSING_STAGES:
+            lines.append(self._row("  " + name, self.timers.get(name)))
+
+        if len(self.postcmd_timers) > 0:
+            lines.append("")
+            lines.append(self._header("Post command"))
+            for label, timer in self.postcmd_timers:
+                lines.append(self._row(label, timer))
+
+        if self.cprofile_file is not None:
+            lines.append("")
+            lines.append("cProfile data written to {}".format(self.cprofile_file))
+        if self.stacks_file is not None:
+            lines.append("Sampled stacks written to {}".format(self.stacks_file))
+        return "\n".join(lines)
+
+    def _timer(self, name):
+        if name not in self.timers:
+            self.timers[name] = StageTimer()
+        return self.timers[name]
+
+    def _time(self, name):
+        if name in self.timers:
+            return self.timers[name].time
+        return 0
+
+    def _timed(self, name, method):
+        timer = self._timer(name)
+
+        def timed_method(*args, **kwargs):
+            if timer.active:
+                return method(*args, **kwargs)
+            timer.active = True
+            t0 = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                timer.time += time.perf_counter() - t0
+                timer.calls += 1
+                timer.active = False
+        return timed_method
+
+    def _timed_call(self, timer, fun):
+        def timed_fun(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fun(*args, **kwargs)
+            finally:
+                timer.time += time.perf_counter() - t0
+                timer.calls += 1
+        return timed_fun
+
+    @staticmethod
+    def _header(title):
+        return "{0:<50} {1:>10} {2:>10} {3:>12} {4:>7}".format(title, "calls", "total (s)",
+                                                             "per call (us)", "%")
+
+    def _row(self, label, timer, total=None):
+        if timer is not None:
+            total = timer.time
+            calls = timer.calls
+        else:
+            calls = 0
+        if total is None:
+            total = 0
+        per_call = (1e6 * total / calls) if calls > 0 else 0
+        percent = (100 * total / self.wall_time) if self.wall_time > 0 else 0
+        calls_str = str(calls) if calls > 0 else ""
+        return "{0:<50} {1:>10} {2:>10.4f} {3:>12.2f} {4:>7.1f}".format(label[:50], calls_str,
+                                                                      total, per_call, percent)
+
+
+class StackSampler():
+    '''Samples the call stack of a thread at a fixed interval and counts the unique stacks.'''
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stack_counts = dict()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            for stack, count in sorted(self.stack_counts.items()):
+                f.write("{0} {1}\n".format(stack, count))
+
+    def _sample(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            frames = list()
+            while frame is not None:
+                code = frame.f_code
+                frames.append("{0}:{1}".format(code.co_filename.split('/')[-1], code.co_name))
+                frame = frame.f_back
+            stack = ";".join(reversed(frames))
+            self.stack_counts[stack] = self.stack_counts.get(stack, 0) + 1
+
+
+def postcmd_label(cmd):
+    '''A label for a post command object, for example "@vplot ('S1', 'R1')". Commands without
+       an expression (@hexport and @export) are labelled with their properties.'''
+    if hasattr(cmd, 'cmd'):
+        if getattr(cmd, 'expr', None) is None:
+            return "{0} {1}".format(cmd.cmd, cmd.eval_prop)
+        return "{0} {1}".format(cmd.cmd, cmd.expr)
+    else:
+        return "@" + type(cmd).__name__.replace("Cmd", "").lower()
@@ -1,15 +1,22 @@
 import LsUtil
 import LsWorld
 import LsMechanism
-from LsOutput import ScriptOutput
-from LsSimulation import ScriptRun
+import LsStore
+import LsAdaptive
+import LsMeanField
+from LsOutput import ScriptOutput, EvalCache
+from LsSimulation import ScriptRun, RecordSchedule, group_runs, run_parallel
 from LsExceptions import LsParseException
 from LsConstants import *
 
 import copy
 import ast
 import csv
-import matplotlib.pyplot as plt
+import os
+import re
+
+# matplotlib is imported in the functions that plot, so that scripts without plot commands
+# (and the command line tool) do not pay for importing it
 
 PLOT_PROPS = {'runlabel', 'subject', 'steps', 'exact_steps', 'phase'}
 EXPORT_ADD = {'filename'}
@@ -24,7 +31,22 @@ VALID_PROPS = {VPLOT: PLOT_PROPS,
                WEXPORT: PLOT_PROPS | EXPORT_ADD,
                PEXPORT: PLOT_PROPS | EXPORT_ADD | P_ADD,
                NEXPORT: PLOT_PROPS | EXPORT_ADD | N_ADD,
-               HEXPORT: {'filename', 'runlabel'}}
+               HEXPORT: {'filename', 'runlabel'},
+               EXPORT: PLOT_PROPS | EXPORT_ADD | N_ADD | P_ADD}
+
+# The evaluation ('v', 'w', 'p' or 'n') made by each plot and export command
+CMD_EVAL = {VPLOT: 'v', WPLOT: 'w', PPLOT: 'p', NPLOT: 'n',
+            VEXPORT: 'v', WEXPORT: 'w', PEXPORT: 'p', NEXPORT: 'n'}
+
+# The export command of each series in the content of @export
+GROUPED_EXPORT = {'v': VEXPORT, 'w': WEXPORT, 'p': PEXPORT, 'n': NEXPORT}
+
+# Series longer than this many points per horizontal pixel of the axes are decimated before
+# plotting
+PLOT_POINTS_PER_PIXEL = 2
+
+# Supported file formats for headless plotting
+FIGURE_FORMATS = ('png', 'svg', 'pdf')
 
 
 class LsScript():
@@ -52,7 +74,11 @@ class LsScript():
             kw, _ = LsUtil.split1_strip(first_row)
             if kw not in ALL_KEYWORDS:
                 raise LsParseException("Unknown keyword '{}'".format(kw))
-            if kw in ALL_POSTCMDS:
+            if kw == EXPORT:
+                _, cmdarg = LsUtil.split1_strip(first_row)
+                _, content = LsUtil.split1_strip(block, '\n')
+                self.postcmds.add(parse_grouped_export(cmdarg, content, self.parameters))
+            elif kw in ALL_POSTCMDS:
                 postcmd, cmdarg = LsUtil.split1_strip(first_row)
                 postcmd_obj = parse_postcmd(postcmd, cmdarg, self.parameters)
                 self.postcmds.add(postcmd_obj)
@@ -78,17 +104,115 @@ class LsScript():
                     mechanism_obj = self.parameters.make_mechanism_obj()
                     run_label = scriptblock.pvdict.get(LABEL, self._next_unnamed_run())
                     n_subjects = self.parameters.parameters.get(SUBJECTS, 1)
-                    self.runs.add(run_label, world, mechanism_obj, n_subjects)
+                    record, schedule = parse_record(scriptblock.pvdict)
+                    history = scriptblock.pvdict.get(HISTORY, EVAL_ON)
+                    if history not in (EVAL_ON, EVAL_OFF, HISTORY_CODED, HISTORY_RUN_LENGTH):
+                        raise LsParseException("The property '{0}' must be '{1}', '{2}', '{3}' "
+                                               "or '{4}'.".format(HISTORY, EVAL_ON, EVAL_OFF,
+                                                                  HISTORY_CODED,
+                                                                  HISTORY_RUN_LENGTH))
+                    history_coding = None
+                    if history in (HISTORY_CODED, HISTORY_RUN_LENGTH):
+                        history_coding = history
+                    target = parse_target(scriptblock.pvdict)
+                    engine = parse_engine(scriptblock.pvdict, target)
+                    self.runs.add(run_label, world, mechanism_obj, n_subjects,
+                                  dict(self.parameters.parameters),
+                                  self.phases.phase_sources(phases_to_use), record, schedule,
+                                  history != EVAL_OFF, target, engine, history_coding)
                 else:
                     raise LsParseException("Unknown keyword '{}'".format(kw))
-
-    def run(self):
-        return self.runs.run()
-
-    def postproc(self, simulation_data, block=True):
+        self._count_patterns()
+        self._find_targets()
+        self._check_mean_field()
+
+    def _count_patterns(self):
+        '''Gives the runs that do not keep the history the patterns that the post commands
+           match in it.'''
+        patterns = self.postcmds.patterns()
+        for run in self.runs.runs.values():
+            run.patterns = patterns
+        for cmd in self.postcmds.flattened():
+            if getattr(cmd, 'cmd', None) == HEXPORT:
+                run_label = cmd.eval_prop.get(EVAL_RUNLABEL)
+                for run in self.runs.runs.values():
+                    if not run.history and run_label in (None, run.runlabel):
+                        raise LsParseException("{0} needs the history of the run '{1}', which "
+                                               "has '{2}':'{3}'.".format(HEXPORT, run.runlabel,
+                                                                         HISTORY, EVAL_OFF))
+
+    def _find_targets(self):
+        '''Gives the runs with an adaptive number of subjects the averages that the post
+           commands evaluate.'''
+        single_run = (len(self.runs.runs) == 1)
+        for run in self.runs.runs.values():
+            if run.target is None:
+                continue
+            run.target.quantities = self.postcmds.averaged(run.runlabel, single_run)
+            if len(run.target.quantities) == 0:
+                raise LsParseException("The run '{0}' has '{1}', but no plot or export command "
+                                       "averages over its subjects.".format(run.runlabel,
+                                                                            TARGET_SE))
+
+    def _check_mean_field(self):
+        '''Checks that the post commands only evaluate the runs with 'engine':'meanfield' for
+           the average of v, w or p over all steps, which is all that LsMeanField computes.'''
+        for run in self.runs.runs.values():
+            if run.engine != ENGINE_MEAN_FIELD:
+                continue
+            for cmd in self.postcmds.flattened():
+                cmd_name = getattr(cmd, 'cmd', None)
+                if cmd_name not in CMD_EVAL and cmd_name != HEXPORT:
+                    continue
+                if cmd.eval_prop.get(EVAL_RUNLABEL) not in (None, run.runlabel):
+                    continue
+                if cmd_name == HEXPORT or CMD_EVAL[cmd_name] == 'n':
+                    unsupported = cmd_name
+                elif cmd.eval_prop.get(EVAL_SUBJECT, EVAL_AVERAGE) != EVAL_AVERAGE:
+                    unsupported = "'{0}':{1!r}".format(EVAL_SUBJECT, cmd.eval_prop[EVAL_SUBJECT])
+                elif cmd.eval_prop.get(EVAL_STEPS, EVAL_ALL) != EVAL_ALL:
+                    unsupported = "'{}'".format(EVAL_STEPS)
+                elif EVAL_PHASE in cmd.eval_prop:
+                    unsupported = "'{}'".format(EVAL_PHASE)
+                else:
+                    continue
+                raise LsParseException("The run '{0}' has '{1}':'{2}', which only gives the "
+                                       "average of v, w and p over all steps, not {3}.".
+                                       format(run.runlabel, ENGINE, ENGINE_MEAN_FIELD,
+                                              unsupported))
+
+    def run(self, progress=None, jobs=1, seed=None, share_prefix=False, memory_budget=None,
+            scratch_dir=None):
+        '''Simulates the runs and returns a ScriptOutput object (see Runs.run). If memory_budget
+           (in bytes) is given, finished subjects that do not fit in it are moved to
+           memory-mapped files in a directory created in scratch_dir.'''
+        spill = None
+        if memory_budget is not None:
+            spill = LsStore.SpillStore(memory_budget, scratch_dir)
+        return self.runs.run(progress, jobs, seed, share_prefix, spill)
+
+    def postproc(self, simulation_data, block=True, figure_dir=None, figure_format='png'):
+        '''Runs the post commands. If figure_dir is given, the figures are rendered without an
+           interactive backend and saved to files in figure_dir instead of being shown, and the
+           list of saved files is returned.'''
         # self.postcmds.set_output(self.script_output)
-        self.postcmds.run(simulation_data)
-        plt.show(block)
+        if figure_dir is None:
+            self.postcmds.run(simulation_data)
+            if self.postcmds.has_plots():
+                import matplotlib.pyplot as plt
+                plt.show(block=block)
+            return None
+        else:
+            if figure_format not in FIGURE_FORMATS:
+                raise LsParseException("Invalid figure format '{0}'. Must be one of {1}.".
+                                       format(figure_format, ", ".join(FIGURE_FORMATS)))
+            if not self.postcmds.has_plots():
+                self.postcmds.run(simulation_data)
+                return []
+            import matplotlib.pyplot as plt
+            plt.switch_backend('Agg')
+            self.postcmds.run(simulation_data)
+            return save_figures(figure_dir, figure_format)
 
     def _next_unnamed_run(self):
         run_label = "run{}".format(self.unnamed_run_cnt)
@@ -104,14 +228,80 @@ class LsScript():
 class PostCmds():
 
     def __init__(self):
-        self.cmds = list()  # List of PlotCmd or ExportCmd objects
+        self.cmds = list()  # List of PlotCmd, ExportCmd or GroupedExportCmd objects
 
     def add(self, cmd):
         self.cmds.append(cmd)
 
+    def flattened(self):
+        '''The commands, with each GroupedExportCmd replaced by the ExportCmd objects of its
+           series.'''
+        cmds = list()
+        for cmd in self.cmds:
+            if isinstance(cmd, GroupedExportCmd):
+                cmds.extend(cmd.items)
+            else:
+                cmds.append(cmd)
+        return cmds
+
     def run(self, simulation_data):
+        simulation_data.eval_cache = self.plan(simulation_data)
+        try:
+            for cmd in self.cmds:
+                cmd.run(simulation_data)
+        finally:
+            simulation_data.eval_cache = None
+
+    def plan(self, simulation_data):
+        '''Returns an EvalCache object with the evaluations of all commands, so that what they
+           have in common (phase filtering, pattern matching, v values at each step, p, and
+           repeated evaluations) is computed once.'''
+        cache = EvalCache()
+        for cmd in self.flattened():
+            if getattr(cmd, 'cmd', None) in CMD_EVAL:
+                cache.plan(simulation_data, CMD_EVAL[cmd.cmd], cmd.expr, cmd.eval_prop)
+        return cache
+
+    def patterns(self):
+        '''The list of (pattern, use_exact_match) that the commands find in the history.'''
+        patterns = list()
+        for cmd in self.flattened():
+            vwpn = CMD_EVAL.get(getattr(cmd, 'cmd', None))
+            if vwpn is None:
+                continue
+            used = list()
+            if vwpn == 'n':
+                seqs = cmd.expr if type(cmd.expr) is tuple else (cmd.expr, None)
+                exact_n = (cmd.eval_prop.get(EVAL_EXACTN, EVAL_OFF) == EVAL_ON)
+                used.extend((seq, exact_n) for seq in seqs if seq is not None)
+            steps = cmd.eval_prop.get(EVAL_STEPS, EVAL_ALL)
+            if steps != EVAL_ALL:
+                used.append((steps, cmd.eval_prop.get(EVAL_EXACTSTEPS, EVAL_OFF) == EVAL_ON))
+            for pattern in used:
+                if pattern not in patterns:
+                    patterns.append(pattern)
+        return patterns
+
+    def averaged(self, run_label, single_run):
+        '''The list of (vwpn, expression, evaluation properties) of the commands that average
+           over the subjects of the run run_label. Commands without 'runlabel' apply to the run
+           if single_run is True.'''
+        quantities = list()
+        for cmd in self.flattened():
+            vwpn = CMD_EVAL.get(getattr(cmd, 'cmd', None))
+            if vwpn is None or cmd.eval_prop.get(EVAL_SUBJECT, EVAL_AVERAGE) != EVAL_AVERAGE:
+                continue
+            cmd_run_label = cmd.eval_prop.get(EVAL_RUNLABEL)
+            if cmd_run_label == run_label or (cmd_run_label is None and single_run):
+                quantities.append((vwpn, cmd.expr, cmd.eval_prop))
+        return quantities
+
+    def has_plots(self):
+        '''Whether any of the commands uses matplotlib.'''
         for cmd in self.cmds:
-            cmd.run(simulation_data)
+            if not isinstance(cmd, (ExportCmd, GroupedExportCmd)):
+                return True
+        return False
 
 
 class PlotCmd():
@@ -126,6 +316,7 @@ class PlotCmd():
         parse_eval_prop(cmd, expr, eval_prop, VALID_PROPS[cmd])
 
     def run(self, simulation_data):
+        import matplotlib.pyplot as plt
         label_expr = beautify_expr_for_label(self.expr)
         if self.cmd == VPLOT:
             ydata = simulation_data.vwpn_eval('v', self.expr, self.eval_prop)
@@ -147,11 +338,23 @@ class PlotCmd():
                 subject_legend_labels.append(subject_legend_label)
             for i, subject_ydata in enumerate(ydata):
                 subject_legend_label = subject_legend_labels[i]
-                plt.plot(subject_ydata, label=subject_legend_label, **self.plot_prop)
+                self._plot(subject_ydata, subject_legend_label)
         else:
-            plt.plot(ydata, label=legend_label, **self.plot_prop)
+            self._plot(ydata, legend_label)
         plt.grid(True)
 
+    def _plot(self, ydata, legend_label):
+        import matplotlib.pyplot as plt
+        max_points = PLOT_POINTS_PER_PIXEL * axes_width_pixels()
+        xdata = getattr(ydata, 'x', None)  # Steps of the values, if not all steps are recorded
+        if len(ydata) > max_points:
+            xdata, ydata = LsUtil.decimate(xdata, ydata, max_points // 2)
+            plt.plot(xdata, ydata, label=legend_label, **self.plot_prop)
+        elif xdata is not None:
+            plt.plot(xdata, ydata, label=legend_label, **self.plot_prop)
+        else:
+            plt.plot(ydata, label=legend_label, **self.plot_prop)
+
 
 class ExportCmd():
 
@@ -161,14 +364,12 @@ class ExportCmd():
         self.eval_prop = eval_prop
         parse_eval_prop(cmd, expr, eval_prop, VALID_PROPS[cmd])
 
+    def filename(self):
+        '''The name of the exported file, with the extension .csv.'''
+        return export_filename(self.cmd, self.eval_prop)
+
     def run(self, simulation_data):
-        if EVAL_FILENAME not in self.eval_prop:
-            raise LsParseException(
-                "Property {0} to {1} is mandatory.".format(EVAL_FILENAME, self.cmd))
-        filename = self.eval_prop[EVAL_FILENAME]
-        if not filename.endswith(".csv"):
-            filename = filename + ".csv"
-        file = open(filename, 'w', newline='')
+        file = open(self.filename(), 'w', newline='')
 
         if self.cmd == HEXPORT:
             self._h_export(file, simulation_data)
@@ -191,20 +392,18 @@ class ExportCmd():
             # Write headers
             w.writerow(['step'] + subject_legend_labels)
 
-            # Write data
-            maxlen = 0
-
-            for i in range(n_subjects):
-                len_history_i = len(simulation_data.run_outputs[run_label].output_subjects[i].history)
-                if len_history_i > maxlen:
-                    maxlen = len_history_i
+            # Write data. The histories are read in order, which is fast also for a coded
+            # history (see LsHistory).
+            histories = [output_subject.history for output_subject in
+                         simulation_data.run_outputs[run_label].output_subjects]
+            maxlen = max([len(history) for history in histories], default=0)
+            history_iters = [iter(history) for history in histories]
             for histind in range(0, maxlen, 2):
                 datarow = [histind // 2]
-                for i in range(n_subjects):
-                    history = simulation_data.run_outputs[run_label].output_subjects[i].history
+                for history, history_iter in zip(histories, history_iters):
                     if histind < len(history):
-                        stimulus = history[histind]
-                        response = history[histind + 1]
+                        stimulus = next(history_iter)
+                        response = next(history_iter)
                         datarow.append(stimulus)
                         datarow.append(response)
                     else:
@@ -219,20 +418,15 @@ class ExportCmd():
             #         datarow = [row, ydata[row]]
             #         w.writerow(datarow)
 
+    def evaluate(self, simulation_data):
+        '''The evaluated series (a list of series for 'subject':'all') and its label in the
+           header of the exported file.'''
+        vwpn = CMD_EVAL[self.cmd]
+        ydata = simulation_data.vwpn_eval(vwpn, self.expr, self.eval_prop)
+        return ydata, "{0}{1}".format(vwpn, beautify_expr_for_label(self.expr))
+
     def _vwpn_export(self, file, simulation_data):
-        label_expr = beautify_expr_for_label(self.expr)
-        if self.cmd == VEXPORT:
-            ydata = simulation_data.vwpn_eval('v', self.expr, self.eval_prop)
-            legend_label = "v{}".format(label_expr)
-        elif self.cmd == WEXPORT:
-            ydata = simulation_data.vwpn_eval('w', self.expr, self.eval_prop)
-            legend_label = "w{}".format(label_expr)
-        elif self.cmd == PEXPORT:
-            ydata = simulation_data.vwpn_eval('p', self.expr, self.eval_prop)
-            legend_label = "p{}".format(label_expr)
-        elif self.cmd == NEXPORT:
-            ydata = simulation_data.vwpn_eval('n', self.expr, self.eval_prop)
-            legend_label = "n{}".format(label_expr)
+        ydata, legend_label = self.evaluate(simulation_data)
 
         n_ydata = len(ydata)
 
@@ -250,12 +444,14 @@ class ExportCmd():
 
                 # Write data
                 maxlen = 0
+                xdata = None
                 for i in range(n_ydata):
                     len_ydata_i = len(ydata[i])
                     if len_ydata_i > maxlen:
                         maxlen = len_ydata_i
+                        xdata = getattr(ydata[i], 'x', None)
                 for row in range(maxlen):
-                    datarow = [row]
+                    datarow = [row if xdata is None else xdata[row]]
                     for i in range(n_ydata):
                         if row < len(ydata[i]):
                             datarow.append(ydata[i][row])
@@ -267,11 +463,71 @@ class ExportCmd():
                 w.writerow(['x', legend_label])
 
                 # Write data
+                xdata = getattr(ydata, 'x', None)
                 for row in range(len(ydata)):
-                    datarow = [row, ydata[row]]
+                    datarow = [row if xdata is None else xdata[row], ydata[row]]
                     w.writerow(datarow)
 
 
+class GroupedExportCmd():
+    '''@export: several v, w, p and n series, written as the columns of one file with a common
+       x column. The series are ExportCmd objects that are planned in the EvalCache of the post
+       commands together with the other commands, so their shared sub-evaluations are made
+       once.'''
+
+    def __init__(self, eval_prop, items):
+        self.cmd = EXPORT
+        self.eval_prop = eval_prop
+        self.items = items  # List of ExportCmd objects
+        parse_eval_prop(EXPORT, None, eval_prop, VALID_PROPS[EXPORT])
+
+    def filename(self):
+        '''The name of the exported file, with the extension .csv.'''
+        return export_filename(self.cmd, self.eval_prop)
+
+    def run(self, simulation_data):
+        labels = list()
+        columns = list()
+        for item in self.items:
+            ydata, legend_label = item.evaluate(simulation_data)
+            if item.eval_prop.get(EVAL_SUBJECT) == EVAL_ALL:
+                for i, subject_ydata in enumerate(ydata):
+                    labels.append("{0} subject {1}".format(legend_label, i))
+                    columns.append(subject_ydata)
+            else:
+                labels.append(legend_label)
+                columns.append(ydata)
+
+        # The x values of each column, and all x values in order. Columns without a value at
+        # an x are padded with ' '
+        column_x = [list(getattr(ydata, 'x', None) or range(len(ydata))) for ydata in columns]
+        if all(x == column_x[0] for x in column_x[1:]):
+            xdata = column_x[0] if len(columns) > 0 else list()
+            rows = [[x] + [ydata[row] if row < len(ydata) else ' ' for ydata in columns]
+                    for row, x in enumerate(xdata)]
+        else:
+            xdata = sorted(set().union(*column_x))
+            values = [dict(zip(x, ydata)) for x, ydata in zip(column_x, columns)]
+            rows = [[x] + [value.get(x, ' ') for value in values] for x in xdata]
+
+        with open(self.filename(), 'w', newline='') as csvfile:
+            w = csv.writer(csvfile, quotechar='"', quoting=csv.QUOTE_NONNUMERIC, escapechar=None)
+            w.writerow(['x'] + labels)
+            w.writerows(rows)
+
+
+def export_filename(cmd, eval_prop):
+    '''The name of the file exported by the command cmd with the properties eval_prop: the
+       mandatory property 'filename', with the extension .csv.'''
+    if EVAL_FILENAME not in eval_prop:
+        raise LsParseException(
+            "Property {0} to {1} is mandatory.".format(EVAL_FILENAME, cmd))
+    filename = eval_prop[EVAL_FILENAME]
+    if not filename.endswith(".csv"):
+        filename = filename + ".csv"
+    return filename
+
+
 def beautify_expr_for_label(expr0):
     expr = expr0[:]
     expr_type = type(expr)
@@ -300,9 +556,11 @@ class FigureCmd():
         self.mpl_prop = mpl_prop
 
     def run(self, simulation_data):
+        import matplotlib.pyplot as plt
         f = plt.figure(**self.mpl_prop)
         if self.title is not None:
             f.suptitle(self.title)  # Figure title
+            f.set_label(self.title)  # Used as file name when figures are saved
 
 
 class SubplotCmd():
@@ -312,6 +570,7 @@ class SubplotCmd():
         self.mpl_prop = mpl_prop
 
     def run(self, simulation_data):
+        import matplotlib.pyplot as plt
         plt.subplot(self.spec, **self.mpl_prop)
 
 
@@ -322,6 +581,7 @@ class LegendCmd():
         self.mpl_prop = mpl_prop
 
     def run(self, simulation_data):
+        import matplotlib.pyplot as plt
         if self.labels is not None:
             plt.legend(self.labels, **self.mpl_prop)
         else:
@@ -351,6 +611,10 @@ class Parameters():
     def __init__(self):
         self.parameters = dict()
 
+        # Validated LsMechanism.MechanismConfig objects, so that runs with the same parameters
+        # share one. Keys are made by _config_key.
+        self.mechanism_configs = dict()
+
     def get(self, parameter_name):
         if parameter_name not in self.parameters:
             errmsg = "The parameter '{0}' is not set in {1}".format(parameter_name, PARAMETERS)
@@ -369,20 +633,31 @@ class Parameters():
             raise LsParseException("The parameter {0} is required.".format(MECHANISM))
         mechanism_name = self.parameters[MECHANISM].lower()
         if mechanism_name == RESCORLA_WAGNER or mechanism_name == "sr":  # XXX sr is alias
-            mechanism_obj = LsMechanism.RescorlaWagner(**self.parameters)
+            mechanism_class = LsMechanism.RescorlaWagner
         elif mechanism_name == Q_LEARNING:
-            mechanism_obj = LsMechanism.Qlearning(**self.parameters)
+            mechanism_class = LsMechanism.Qlearning
         # elif mechanism_name == SARSA:
-        #     mechanism_obj = LsMechanism.SARSA(**self.parameters)
+        #     mechanism_class = LsMechanism.SARSA
         elif mechanism_name == EXP_SARSA:
-            mechanism_obj = LsMechanism.EXP_SARSA(**self.parameters)
+            mechanism_class = LsMechanism.EXP_SARSA
         elif mechanism_name == ACTOR_CRITIC:
-            mechanism_obj = LsMechanism.ActorCritic(**self.parameters)
+            mechanism_class = LsMechanism.ActorCritic
         elif mechanism_name == ENQUIST:
-            mechanism_obj = LsMechanism.Enquist(**self.parameters)
+            mechanism_class = LsMechanism.Enquist
         else:
             raise Exception('Unknown mechanism "' + mechanism_name + '".')
-        return mechanism_obj
+
+        key = self._config_key()
+        config = self.mechanism_configs.get(key)
+        if config is None:
+            config = LsMechanism.MechanismConfig(self.parameters)
+            self.mechanism_configs[key] = config
+        return mechanism_class.from_config(config)
+
+    def _config_key(self):
+        '''The parameters that the mechanism config depends on, as a string.'''
+        return repr(sorted((name, value) for name, value in self.parameters.items()
+                           if name not in (SUBJECTS, MECHANISM)))
 
 
 class Phases():
@@ -421,6 +696,12 @@ class Phases():
             phase_worlds.append(phase_obj)
         return LsWorld.World(phase_worlds)
 
+    def phase_sources(self, phases_to_use):
+        '''The PhaseWorld objects that the phases of make_world(phases_to_use) are copies of.'''
+        if len(phases_to_use) == 0:
+            phases_to_use = self.phases[0]
+        return [self.phases[2][self.phases[0].index(lbl)] for lbl in phases_to_use]
+
 
 class Phase():
     '''A number or rows of text and a parameters dict.'''
@@ -446,20 +727,104 @@ class Runs():
         # A dict with ScriptRun objects. Keys are run labels.
         self.runs = dict()
 
-    def add(self, label, world, mechanism_obj, n_subjects):
+    def add(self, label, world, mechanism_obj, n_subjects, parameters=None,
+            phase_sources=None, record=RECORD_ALL, schedule=None, history=True, target=None,
+            engine=ENGINE_MONTE_CARLO, history_coding=None):
         if label in self.runs:
             raise LsParseException("Run label " + label + " is duplicated.")
-        self.runs[label] = ScriptRun(label, world, mechanism_obj, n_subjects)
-
-    def run(self):
+        self.runs[label] = ScriptRun(label, world, mechanism_obj, n_subjects, parameters,
+                                     phase_sources, record, schedule, history, target, engine,
+                                     history_coding)
+
+    def run(self, progress=None, jobs=1, seed=None, share_prefix=False, spill=None):
+        '''Simulates the runs and returns a ScriptOutput object. If jobs is not 1, the runs
+           (and the subjects within them) are simulated in parallel in jobs processes (None
+           for the number of CPUs). With the same seed, the output does not depend on jobs.
+
+           If share_prefix is True, runs with the same parameters that start with the same
+           phases simulate these phases once per subject and continue from a copy of the
+           state after them (see LsSimulation.RunGroup).
+
+           spill is an LsStore.SpillStore object, or None to keep all output in memory.
+
+           Runs with an adaptive number of subjects are simulated last, one at a time (see
+           LsAdaptive.run), and runs with 'engine':'meanfield' are propagated in this process
+           (see LsMeanField.run).'''
+        adaptive_runs = [run for run in self.runs.values() if run.target is not None]
+        mean_field_runs = [run for run in self.runs.values() if run.engine == ENGINE_MEAN_FIELD]
+        simulated_runs = [run for run in self.runs.values()
+                          if run.target is None and run.engine != ENGINE_MEAN_FIELD]
+        if progress is not None:
+            progress.n_subjects = (sum(run.n_subjects for run in simulated_runs) +
+                                   sum(run.target.max_subjects for run in adaptive_runs) +
+                                   len(mean_field_runs))
+        groups = group_runs(simulated_runs, share_prefix)
+        run_outputs = dict()
+        if jobs != 1:
+            group_outputs = run_parallel(groups, jobs, seed, progress, spill)
+            group_runs_done = [run for group in groups for run in group.script_runs]
+            for run, run_output in zip(group_runs_done, group_outputs):
+                run_outputs[run.runlabel] = run_output
+        else:
+            for group in groups:
+                group_outputs = group.run(progress, seed=seed, spill=spill)
+                for run, run_output in zip(group.script_runs, group_outputs):
+                    run_outputs[run.runlabel] = run_output
+                if progress is not None and progress.cancelled:
+                    break
+        for run in adaptive_runs:
+            if progress is not None and progress.cancelled:
+                break
+            run_outputs[run.runlabel] = LsAdaptive.run(run, jobs, seed, progress, spill)
+        for run in mean_field_runs:
+            if progress is not None and progress.cancelled:
+                break
+            run_outputs[run.runlabel] = LsMeanField.run(run, progress)
+
+        # In the order of the @run statements
         out = dict()
-        for label, run in self.runs.items():
-            out[label] = run.run()
+        for label in self.runs:
+            if label in run_outputs:
+                out[label] = run_outputs[label]
         return ScriptOutput(out)
 
 
 # ---------------------- Static methods ----------------------
 
+def axes_width_pixels():
+    '''The width in pixels of the current axes.'''
+    import matplotlib.pyplot as plt
+    ax = plt.gca()
+    return max(int(ax.bbox.width), 1)
+
+
+def save_figures(figure_dir, figure_format):
+    '''Saves all open figures to files in figure_dir and closes them. The files are named by
+       the title given in @figure, or "figure<number>" for untitled figures.'''
+    import matplotlib.pyplot as plt
+    os.makedirs(figure_dir, exist_ok=True)
+    used_names = set()
+    filenames = list()
+    for num in plt.get_fignums():
+        f = plt.figure(num)
+        name = f.get_label()
+        if name:
+            name = re.sub(r'[^\w\-. ]', '_', name).strip()
+        if not name:
+            name = "figure{}".format(num)
+        unique_name = name
+        cnt = 2
+        while unique_name in used_names:
+            unique_name = "{0}_{1}".format(name, cnt)
+            cnt += 1
+        used_names.add(unique_name)
+        filename = os.path.join(figure_dir, "{0}.{1}".format(unique_name, figure_format))
+        f.savefig(filename, format=figure_format)
+        filenames.append(filename)
+    plt.close('all')
+    return filenames
+
+
 def clean_script(script):
     # Replace each tab with a space
     script = script.replace("\t", " ")
@@ -488,6 +853,76 @@ def parse_block(block):
     return ScriptBlock(keyword, pvdict, content)
 
 
+def parse_record(pvdict):
+    '''Returns the recording mode and the RecordSchedule (or None) of a @run property dict.'''
+    record = pvdict.get(RECORD, RECORD_ALL)
+    if record not in (RECORD_ALL, RECORD_CHANGES):
+        raise LsParseException("The property '{0}' must be '{1}' or '{2}'.".
+                               format(RECORD, RECORD_ALL, RECORD_CHANGES))
+    every = pvdict.get(RECORD_EVERY)
+    steps = pvdict.get(RECORD_STEPS)
+    if every is None and steps is None:
+        return record, None
+    if every is not None and steps is not None:
+        raise LsParseException("The properties '{0}' and '{1}' cannot both be used.".
+                               format(RECORD_EVERY, RECORD_STEPS))
+    if record == RECORD_CHANGES:
+        raise LsParseException("The property '{0}' cannot be '{1}' with '{2}' or '{3}'.".
+                               format(RECORD, RECORD_CHANGES, RECORD_EVERY, RECORD_STEPS))
+    if every is not None:
+        if type(every) is not int or every < 1:
+            raise LsParseException("The property '{}' must be a positive integer.".
+                                   format(RECORD_EVERY))
+    else:
+        if type(steps) not in (list, tuple) or not all(type(s) is int and s >= 0
+                                                       for s in steps):
+            raise LsParseException("The property '{}' must be a list of non-negative integers.".
+                                   format(RECORD_STEPS))
+    return record, RecordSchedule(every, steps)
+
+
+def parse_target(pvdict):
+    '''Returns the LsAdaptive.Target object of a @run property dict, or None if the number of
+       subjects is not adaptive.'''
+    target_se = pvdict.get(TARGET_SE)
+    if target_se is None:
+        for prop in (MAX_SUBJECTS, SE_AT):
+            if prop in pvdict:
+                raise LsParseException("The property '{0}' requires '{1}'.".
+                                       format(prop, TARGET_SE))
+        return None
+    if type(target_se) not in (int, float) or target_se <= 0:
+        raise LsParseException("The property '{}' must be a positive number.".
+                               format(TARGET_SE))
+    max_subjects = pvdict.get(MAX_SUBJECTS, LsAdaptive.DEFAULT_MAX_SUBJECTS)
+    if type(max_subjects) is not int or max_subjects < 2:
+        raise LsParseException("The property '{}' must be an integer larger than 1.".
+                               format(MAX_SUBJECTS))
+    se_at = pvdict.get(SE_AT)
+    if se_at is not None:
+        if type(se_at) is int:
+            se_at = [se_at]
+        if (type(se_at) not in (list, tuple) or len(se_at) == 0 or
+                not all(type(i) is int and i >= 0 for i in se_at)):
+            raise LsParseException("The property '{}' must be a non-negative integer or a list "
+                                   "of non-negative integers.".format(SE_AT))
+        se_at = list(se_at)
+    return LsAdaptive.Target(target_se, max_subjects, se_at)
+
+
+def parse_engine(pvdict, target):
+    '''Returns the engine of a @run property dict with the LsAdaptive.Target object (or None)
+       target.'''
+    engine = pvdict.get(ENGINE, ENGINE_MONTE_CARLO)
+    if engine not in (ENGINE_MONTE_CARLO, ENGINE_MEAN_FIELD):
+        raise LsParseException("The property '{0}' must be '{1}' or '{2}'.".
+                               format(ENGINE, ENGINE_MONTE_CARLO, ENGINE_MEAN_FIELD))
+    if engine == ENGINE_MEAN_FIELD and target is not None:
+        raise LsParseException("The property '{0}' cannot be used with '{1}':'{2}'.".
+                               format(TARGET_SE, ENGINE, ENGINE_MEAN_FIELD))
+    return engine
+
+
 def parse_postcmd(cmd, cmdarg, simulation_parameters):
     if cmdarg is not None:
         args = LsUtil.parse_sso(cmdarg)
@@ -679,6 +1114,42 @@ def parse_postcmd(cmd, cmdarg, simulation_parameters):
         return ExportCmd(cmd, expr=None, eval_prop=eval_prop)
 
 
+def parse_grouped_export(cmdarg, content, simulation_parameters):
+    '''Parses @export with the properties cmdarg and the series in content, one per line: 'v',
+       'w', 'p' or 'n' followed by the arguments of @vexport, @wexport, @pexport or @nexport
+       (without 'filename'). The series get the properties of @export that are valid for them,
+       unless they give them.'''
+    eval_prop = dict()
+    if cmdarg is not None:
+        args = LsUtil.parse_sso(cmdarg)
+        if args is None or len(args) != 1 or type(args[0]) is not dict:
+            raise LsParseException("The argument to {} must be a dict.".format(EXPORT))
+        eval_prop = args[0]
+    if content is None:
+        raise LsParseException("No series given to {}.".format(EXPORT))
+
+    items = list()
+    for line in content.splitlines():
+        vwpn, itemarg = LsUtil.split1_strip(line)
+        if vwpn not in GROUPED_EXPORT:
+            raise LsParseException("Invalid series '{0}' to {1}. Expected a line starting with "
+                                   "'v', 'w', 'p' or 'n'.".format(line, EXPORT))
+        cmd = GROUPED_EXPORT[vwpn]
+        parameters = simulation_parameters
+        if BETA in eval_prop:
+            parameters = {BETA: eval_prop[BETA]}
+        item = parse_postcmd(cmd, itemarg, parameters)
+        if EVAL_FILENAME in item.eval_prop:
+            raise LsParseException("Invalid property '{0}' to a series of {1}.".
+                                   format(EVAL_FILENAME, EXPORT))
+        item_prop = {prop: value for prop, value in eval_prop.items()
+                     if prop in VALID_PROPS[cmd] and prop != EVAL_FILENAME}
+        item_prop.update(item.eval_prop)
+        item.eval_prop = item_prop
+        items.append(item)
+    return GroupedExportCmd(eval_prop, items)
+
+
 def parse_eval_prop(cmd, expr, eval_prop, valid_prop):
     # if type(expr) is not str:
     #     raise LsParseException("First input to {} must be a string, got {}".format(cmd, expr))
@@ -0,0 +1,209 @@
+'''A long-lived simulation server and its client.
+
+The server ("lesim.py serve") listens on a localhost port or a Unix socket. Each connection
+sends requests as JSON objects, one per line, and gets one JSON object per line back. A run
+request is simulated in a pool of worker processes that are started once, with the Ls modules
+and matplotlib already imported and a cache of parsed scripts, so a request does not pay for
+interpreter start, imports or parsing of a script it has seen before.
+
+Requests:
+    {"op": "run", "script": text} or {"op": "run", "file": path}, optionally with
+        "cwd": directory in which relative paths in the script and request are resolved
+        "save": file to save the simulation results in (see LsStore)
+        "figures": directory to save the figures in, "format": figure file format
+    {"op": "ping"}
+    {"op": "shutdown"}
+
+Responses have "ok" set to true or false. A failed request has an "error" message. A
+successful run has "exports" (the files written by the export commands), "figures", "save",
+"cached" (true if the parsed script was reused) and "time" (seconds in the worker).
+'''
+import LsScript
+import LsStore
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+DEFAULT_ADDRESS = "localhost:7735"
+
+# Maximum number of parsed scripts kept in each worker
+SCRIPT_CACHE_SIZE = 32
+
+OP_RUN = "run"
+OP_PING = "ping"
+OP_SHUTDOWN = "shutdown"
+
+# Cache of parsed scripts in a worker process. Keys are script texts, values are LsScript
+# objects.
+_script_cache = OrderedDict()
+
+
+def parse_address(address):
+    '''Returns (socket family, address) for an address string. Addresses containing a "/" or
+       ending with ".sock" are Unix socket paths, other addresses are "host:port" or "port".'''
+    address = str(address)
+    if ('/' in address) or address.endswith(".sock"):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise Exception("Unix sockets are not supported on this platform.")
+        return socket.AF_UNIX, address
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+    else:
+        host, port = "localhost", address
+    try:
+        port = int(port)
+    except ValueError:
+        raise Exception("Invalid server address '{}'.".format(address))
+    return socket.AF_INET, (host, port)
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _get_script(script):
+    '''Returns (LsScript object, cached) for the script text.'''
+    if script in _script_cache:
+        _script_cache.move_to_end(script)
+        return _script_cache[script], True
+    script_obj = LsScript.LsScript(script)
+    _script_cache[script] = script_obj
+    if len(_script_cache) > SCRIPT_CACHE_SIZE:
+        _script_cache.popitem(last=False)
+    return script_obj, False
+
+
+def run_request(request):
+    '''Simulates and postprocesses the script in a run request, and returns the response.
+       Runs in a worker process.'''
+    import matplotlib.pyplot as plt
+
+    t0 = time.perf_counter()
+    # Restored after the request, so that the next request in this worker does not resolve its
+    # files against this request's "cwd"
+    cwd = os.getcwd()
+    try:
+        if "cwd" in request:
+            os.chdir(request["cwd"])
+        if "script" in request:
+            script = request["script"]
+        elif "file" in request:
+            with open(request["file"], "r") as f:
+                script = f.read()
+        else:
+            raise Exception("Run request without 'script' or 'file'.")
+
+        script_obj, cached = _get_script(script)
+        simulation_data = script_obj.run()
+        response = {'ok': True, 'cached': cached, 'save': None, 'figures': []}
+        if request.get("save") is not None:
+            LsStore.save(simulation_data, request["save"])
+            response['save'] = os.path.abspath(request["save"])
+        if request.get("figures") is not None:
+            figures = script_obj.postproc(simulation_data, False, request["figures"],
+                                          request.get("format", "png"))
+            response['figures'] = [os.path.abspath(figure) for figure in figures]
+        else:
+            script_obj.postcmds.run(simulation_data)
+        response['exports'] = [os.path.abspath(cmd.filename()) for cmd in script_obj.postcmds.cmds
+                               if isinstance(cmd, (LsScript.ExportCmd,
+                                                   LsScript.GroupedExportCmd))]
+    except Exception as ex:
+        response = {'ok': False, 'error': "{0}: {1}".format(type(ex).__name__, ex)}
+    finally:
+        plt.close('all')
+        os.chdir(cwd)
+    response['time'] = time.perf_counter() - t0
+    return response
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = self.server.lesim_server.handle_request(request)
+            except ValueError as ex:
+                response = {'ok': False, 'error': "Invalid request: {}".format(ex)}
+            self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+            self.wfile.flush()
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+class Server():
+    '''The simulation server, with jobs worker processes (default: number of CPUs).'''
+
+    def __init__(self, address=DEFAULT_ADDRESS, jobs=None):
+        family, self.socket_address = parse_address(address)
+        self.pool = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker)
+        if family == socket.AF_INET:
+            self.server = _TCPServer(self.socket_address, _RequestHandler)
+            host, port = self.server.server_address[:2]
+            self.address = "{0}:{1}".format(host, port)
+        else:
+            if os.path.exists(self.socket_address):
+                os.remove(self.socket_address)  # Stale socket from a previous server
+            self.server = _UnixServer(self.socket_address, _RequestHandler)
+            self.address = self.socket_address
+        self.server.lesim_server = self
+        self.unix_socket = (family != socket.AF_INET)
+
+    def handle_request(self, request):
+        op = request.get("op", OP_RUN)
+        if op == OP_RUN:
+            return self.pool.submit(run_request, request).result()
+        elif op == OP_PING:
+            return {'ok': True}
+        elif op == OP_SHUTDOWN:
+            threading.Thread(target=self.server.shutdown).start()
+            return {'ok': True}
+        else:
+            return {'ok': False, 'error': "Unknown request '{}'.".format(op)}
+
+    def serve_forever(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def close(self):
+        self.server.server_close()
+        self.pool.shutdown()
+        if self.unix_socket and os.path.exists(self.socket_address):
+            os.remove(self.socket_address)
+
+
+def submit(request, address=DEFAULT_ADDRESS):
+    '''Sends a request to the server at address and returns the response.'''
+    family, socket_address = parse_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_address)
+        with sock.makefile('rwb') as f:
+            f.write((json.dumps(request) + "\n").encode('utf-8'))
+            f.flush()
+            line = f.readline()
+    if not line:
+        raise Exception("No response from the server at {}.".format(address))
+    return json.loads(line.decode('utf-8'))
@@ -0,0 +1,182 @@
+'''Sharded simulation through a spool directory on a shared filesystem.
+
+"lesim.py shard" splits the subjects of each run of a script into work units and writes them
+to a spool directory. Any number of "lesim.py worker" processes, on any machine that sees the
+directory, claim units by renaming them from todo/ to claimed/ (a rename is atomic, so each
+unit is claimed by one worker), simulate them and write a result file (see LsStore) to
+done/. "lesim.py merge" combines the result files into one ScriptOutput. Each subject is
+seeded with LsSimulation.subject_seed from the seed of the spool, so the merged output is the
+same as from "lesim.py run --seed seed", regardless of how the units are spread over workers.
+
+Spool directory layout:
+    spool.json          The seed, the run labels and the number of units
+    script.txt          The script
+    todo/unit-N.json    Units not yet claimed: {"unit": N, "run": label, "subjects": [start, stop]}
+    claimed/unit-N.json Units being simulated. Units of a worker that died can be moved back
+                        to todo/ by hand.
+    failed/unit-N.json  Units whose simulation failed, with the error in unit-N.txt. They can be
+                        moved back to todo/ to be retried.
+    done/unit-N.lsr     Results of finished units
+'''
+import LsScript
+import LsStore
+from LsOutput import ScriptOutput, RunOutput
+from LsSimulation import subject_chunks
+from LsConstants import TARGET_SE, ENGINE, ENGINE_MEAN_FIELD
+
+import json
+import os
+import random
+import socket
+import time
+
+SPOOL_VERSION = 1
+SPOOL_FILE = "spool.json"
+SCRIPT_FILE = "script.txt"
+TODO = "todo"
+CLAIMED = "claimed"
+FAILED = "failed"
+DONE = "done"
+
+
+def unit_name(unit):
+    return "unit-{:05d}".format(unit)
+
+
+def create_spool(script, spool_dir, n_shards, seed=None):
+    '''Writes the work units of the script (text) to the new directory spool_dir, splitting
+       the subjects such that there are at least n_shards units, if possible. Returns the
+       number of units.'''
+    script_obj = LsScript.LsScript(script)  # Check the script before writing anything
+    if os.path.isdir(spool_dir) and len(os.listdir(spool_dir)) > 0:
+        raise Exception("The spool directory '{}' is not empty.".format(spool_dir))
+    if seed is None:
+        seed = random.getrandbits(64)
+
+    for subdir in [TODO, CLAIMED, FAILED, DONE]:
+        os.makedirs(os.path.join(spool_dir, subdir), exist_ok=True)
+    with open(os.path.join(spool_dir, SCRIPT_FILE), "w") as f:
+        f.write(script)
+
+    script_runs = list(script_obj.runs.runs.values())
+    for script_run in script_runs:
+        if script_run.target is not None:
+            raise Exception("The run '{0}' has an adaptive number of subjects ('{1}'), which "
+                            "cannot be sharded.".format(script_run.runlabel, TARGET_SE))
+        if script_run.engine == ENGINE_MEAN_FIELD:
+            raise Exception("The run '{0}' has '{1}':'{2}', which is not simulated in subjects "
+                            "and cannot be sharded.".format(script_run.runlabel, ENGINE,
+                                                            ENGINE_MEAN_FIELD))
+    chunks = subject_chunks([run.n_subjects for run in script_runs], n_shards)
+    for unit, (run_ind, subjects) in enumerate(chunks):
+        _write_json(os.path.join(spool_dir, TODO, unit_name(unit) + ".json"),
+                    {'unit': unit, 'run': script_runs[run_ind].runlabel,
+                     'subjects': [subjects.start, subjects.stop]})
+
+    # Written last, so that workers only see complete spool directories
+    _write_json(os.path.join(spool_dir, SPOOL_FILE),
+                {'version': SPOOL_VERSION, 'seed': str(seed),
+                 'runs': [run.runlabel for run in script_runs], 'n_units': len(chunks)})
+    return len(chunks)
+
+
+def read_spool(spool_dir):
+    '''Returns the contents of spool.json and the script of the spool directory spool_dir.'''
+    spool_file = os.path.join(spool_dir, SPOOL_FILE)
+    if not os.path.isfile(spool_file):
+        raise Exception("'{}' is not a spool directory.".format(spool_dir))
+    with open(spool_file, "r") as f:
+        spool = json.load(f)
+    if spool['version'] != SPOOL_VERSION:
+        raise Exception("Unsupported spool version {}.".format(spool['version']))
+    with open(os.path.join(spool_dir, SCRIPT_FILE), "r") as f:
+        script = f.read()
+    return spool, script
+
+
+def claim(spool_dir):
+    '''Claims a unit in spool_dir. Returns (unit, file name of the claimed unit), or None if
+       there are no units left to claim.'''
+    todo_dir = os.path.join(spool_dir, TODO)
+    for filename in sorted(os.listdir(todo_dir)):
+        if not filename.endswith(".json"):
+            continue
+        claimed_file = os.path.join(spool_dir, CLAIMED, filename)
+        try:
+            os.rename(os.path.join(todo_dir, filename), claimed_file)
+        except FileNotFoundError:
+            continue  # Claimed by another worker
+        with open(claimed_file, "r") as f:
+            return json.load(f), claimed_file
+    return None
+
+
+def work(spool_dir, max_units=None, log=None):
+    '''Claims and simulates units in spool_dir until there are none left, or max_units units
+       are done. log, if given, is called with a message for each unit. Returns (number of
+       units done, number of units failed).'''
+    spool, script = read_spool(spool_dir)
+    script_obj = LsScript.LsScript(script)
+    worker_id = "{0}-{1}".format(socket.gethostname(), os.getpid())
+    n_done = 0
+    n_failed = 0
+    while max_units is None or n_done + n_failed < max_units:
+        claimed = claim(spool_dir)
+        if claimed is None:
+            break
+        unit, claimed_file = claimed
+        name = unit_name(unit['unit'])
+        description = "{0}: run '{1}' subjects {2}-{3}".format(name, unit['run'],
+                                                               unit['subjects'][0],
+                                                               unit['subjects'][1] - 1)
+        t0 = time.perf_counter()
+        try:
+            script_run = script_obj.runs.runs[unit['run']]
+            run_output = script_run.run(subjects=range(*unit['subjects']), seed=spool['seed'])
+            result_file = os.path.join(spool_dir, DONE, name + ".lsr")
+            tmp_file = "{0}.{1}.tmp".format(result_file, worker_id)
+            LsStore.save(ScriptOutput({unit['run']: run_output}), tmp_file)
+            os.replace(tmp_file, result_file)
+            os.remove(claimed_file)
+        except Exception as ex:
+            with open(os.path.join(spool_dir, FAILED, name + ".txt"), "w") as f:
+                f.write("{0}: {1}: {2}\n".format(worker_id, type(ex).__name__, ex))
+            os.replace(claimed_file, os.path.join(spool_dir, FAILED, name + ".json"))
+            n_failed += 1
+            if log is not None:
+                log("{0} failed: {1}".format(description, ex))
+            continue
+        n_done += 1
+        if log is not None:
+            log("{0} done ({1:.2f} s)".format(description, time.perf_counter() - t0))
+    return n_done, n_failed
+
+
+def merge(spool_dir):
+    '''Combines the results of all units in spool_dir and returns a ScriptOutput object.'''
+    spool, _ = read_spool(spool_dir)
+    run_outputs = dict()
+    for label in spool['runs']:
+        run_outputs[label] = RunOutput(0, None)
+    missing = list()
+    for unit in range(spool['n_units']):
+        result_file = os.path.join(spool_dir, DONE, unit_name(unit) + ".lsr")
+        if not os.path.isfile(result_file):
+            missing.append(unit_name(unit))
+            continue
+        for label, unit_output in LsStore.load(result_file).run_outputs.items():
+            run_outputs[label].output_subjects.extend(unit_output.output_subjects)
+    if len(missing) > 0:
+        raise Exception("{0} of {1} units are not done: {2}".format(
+            len(missing), spool['n_units'], ", ".join(missing)))
+    for run_output in run_outputs.values():
+        run_output.n_subjects = len(run_output.output_subjects)
+    return ScriptOutput(run_outputs)
+
+
+def _write_json(filename, obj):
+    '''Writes obj to filename, which appears complete or not at all.'''
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_file, filename)
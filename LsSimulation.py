@@ -1,71 +1,453 @@
 import LsOutput
+import LsStore
+import LsWorld
+from LsConstants import *
+
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import copy
+import math
+import os
+import random
+import threading
+import time
 
 
 class ScriptRun():
 
     '''A class for a script run.'''
 
-    def __init__(self, runlabel, world, mechanism_obj, n_subjects):
+    def __init__(self, runlabel, world, mechanism_obj, n_subjects, parameters=None,
+                 phase_sources=None, record=RECORD_ALL, schedule=None, history=True,
+                 target=None, engine=ENGINE_MONTE_CARLO, history_coding=None):
         self.runlabel = runlabel
         self.world = world
         self.mechanism_obj = mechanism_obj
         self.has_w = hasattr(mechanism_obj, 'w')
         self.n_subjects = n_subjects
+        self.record = record
+
+        # A RecordSchedule object if v and w are only recorded at some steps, otherwise None
+        self.schedule = schedule
+
+        # If history is False, the history is not kept and the (pattern, use_exact_match) in
+        # patterns are counted during the simulation instead (see LsHistory.PatternCounter)
+        self.history = history
+        self.patterns = list()
+
+        # If the history is kept, None to keep it as a list, or HISTORY_CODED or
+        # HISTORY_RUN_LENGTH to keep it compressed (see LsHistory.new_history)
+        self.history_coding = history_coding
+
+        # An LsAdaptive.Target object if the number of subjects is adaptive (n_subjects is
+        # then the batch size), otherwise None
+        self.target = target
+
+        # ENGINE_MEAN_FIELD if the run propagates expected values instead of simulating
+        # subjects (see LsMeanField)
+        self.engine = engine
+
+        # The @parameters in effect for the run, and the PhaseWorld objects that the phases of
+        # the world are copies of. Used to find runs with a common phase prefix.
+        self.parameters = parameters
+        self.phase_sources = phase_sources
+
+    def run(self, progress=None, subjects=None, seed=None, spill=None):
+        '''Simulates all subjects, or the subjects in the range subjects, and returns a
+           RunOutput object.
+
+           If seed is given, the random number generator is seeded with subject_seed(seed, ...)
+           before each subject, so that a subject is simulated the same way regardless of which
+           other subjects are simulated in the same process.
+
+           If spill (an LsStore.SpillStore object) is given, it is called with each finished
+           subject, which it moves to disk if it does not fit in its memory budget.
 
-    def run(self):
+           If progress (a Progress object) is given, it is updated after each step and the
+           simulation stops after the current step if progress is cancelled. The output then
+           contains the subjects simulated so far, the last one up to the cancelled step.
+        '''
+        if subjects is None:
+            subjects = range(self.n_subjects)
+        out = self.start_output(len(subjects))
+
+        # The actual simulation
+        for subject_ind, subject in enumerate(subjects):
+            if seed is not None:
+                random.seed(subject_seed(seed, self.runlabel, subject))
+            state = SubjectState(self.schedule)
+            cancelled = self.simulate(out, subject_ind, self.world, self.mechanism_obj, state,
+                                      progress)
+            self.finish_subject(out, subject_ind, self.mechanism_obj, state)
+            if spill is not None:
+                spill.subject_done(out, subject_ind)
+
+            # Reset mechanism and world for the next subject
+            self.mechanism_obj.subject_reset()
+            self.world.subject_reset()
+
+            if progress is not None:
+                progress.n_subjects_done += 1
+            if cancelled:
+                del out.output_subjects[subject_ind + 1:]
+                out.n_subjects = subject_ind + 1
+                break
+
+        return out
+
+    def start_output(self, n_subjects):
+        '''Returns a RunOutput object for n_subjects subjects, with the start values written.'''
         # LsMechanism.feasible_behaviors_cache = dict()
-        out = LsOutput.RunOutput(self.n_subjects, self.mechanism_obj.stimulus_req)
+        out = LsOutput.RunOutput(n_subjects, self.mechanism_obj.stimulus_req, self.record,
+                                 self.schedule is not None,
+                                 None if self.history else self.patterns,
+                                 self.mechanism_obj.start_v, self.history_coding)
 
-        # Initialize output with start values
+        # Initialize output with start values. Only v of the possible responses to each
+        # element is written, other pairs are added when they are learned (in a compound
+        # stimulus).
         # first_phase_label = self.world.phases[0].label
-        for subject_ind in range(self.n_subjects):
+        stimulus_req = self.mechanism_obj.stimulus_req
+        for subject_ind in range(n_subjects):
             for element in self.mechanism_obj.stimulus_elements:
                 if self.has_w:
                     out.write_w(subject_ind, (element,), 0, self.mechanism_obj)
-                for behavior in self.mechanism_obj.behaviors:
+                for behavior in stimulus_req[element]:
                     out.write_v(subject_ind, (element,), behavior, 0, self.mechanism_obj)
             out.write_step(subject_ind, self.world.phases[0].label, 0)
+        return out
 
-        # The actual simulation
-        for subject_ind in range(self.n_subjects):
-            step = 1
-            subject_done = False
-            response = None
-            while not subject_done:
-                stimulus, phase_label = self.world.next_stimulus(response)
-                subject_done = (stimulus is None)
-                if not subject_done:
-                    prev_stimulus = self.mechanism_obj.prev_stimulus
-                    prev_response = self.mechanism_obj.response
-                    response = self.mechanism_obj.learn_and_respond(stimulus)
-
-                    if prev_stimulus is not None:
-                        if self.has_w:
-                            out.write_w(subject_ind, prev_stimulus, step, self.mechanism_obj)
-                        out.write_v(subject_ind, prev_stimulus, prev_response, step,
-                                    self.mechanism_obj)
-                        out.write_history(subject_ind, prev_stimulus, prev_response)
-                        out.write_step(subject_ind, phase_label, step)
-                        step += 1
-                    last_stimulus = stimulus
-                    last_response = response
-                else:
-                    # Write last step to all variables (except the ones that were written in
-                    # the last step)
+    def simulate(self, out, subject_ind, world, mechanism_obj, state, progress=None):
+        '''Simulates the subject until world returns no more stimuli. Returns True if stopped
+           because progress is cancelled.'''
+        while True:
+            stimulus, phase_label = world.next_stimulus(state.response)
+            if stimulus is None:
+                return False
+            prev_stimulus = mechanism_obj.prev_stimulus
+            prev_response = mechanism_obj.response
+            state.response = mechanism_obj.learn_and_respond(stimulus)
+
+            if prev_stimulus is not None:
+                if self.schedule is None:
                     if self.has_w:
-                        for element in self.mechanism_obj.stimulus_elements:
-                            if True:  # element not in last_stimulus:
-                                out.write_w(subject_ind, (element,), step, self.mechanism_obj)
-                    for element in self.mechanism_obj.stimulus_elements:
-                        for behavior in self.mechanism_obj.behaviors:
-                            if True: #(element not in last_stimulus) or (behavior!=last_response):
-                                out.write_v(subject_ind, (element,), behavior, step,
-                                            self.mechanism_obj)
-                    out.write_history(subject_ind, last_stimulus, last_response)
-                    out.write_step(subject_ind, "last", step)
-
-                    # Reset mechanism and world for the next subject
-                    self.mechanism_obj.subject_reset()
-                    self.world.subject_reset()
+                        out.write_w(subject_ind, prev_stimulus, state.step, mechanism_obj)
+                    out.write_v(subject_ind, prev_stimulus, prev_response, state.step,
+                                mechanism_obj)
+                elif state.step == state.next_record_step:
+                    out.write_all(subject_ind, state.step, mechanism_obj)
+                    state.next_record_step = self.schedule.next_step(state.step)
+                out.write_history(subject_ind, prev_stimulus, prev_response)
+                out.write_step(subject_ind, phase_label, state.step)
+                state.step += 1
+            state.last_stimulus = stimulus
+            state.last_response = state.response
+            if progress is not None:
+                progress.n_steps += 1
+                if progress.cancelled:
+                    return True
 
-        return out
+    def finish_subject(self, out, subject_ind, mechanism_obj, state):
+        # Write last step to all variables (except the ones that were written in
+        # the last step)
+        out.write_all(subject_ind, state.step, mechanism_obj)
+        out.write_history(subject_ind, state.last_stimulus, state.last_response)
+        out.write_step(subject_ind, "last", state.step)
+
+
+class SubjectState():
+
+    '''The state of the simulation loop of a subject, besides the world and mechanism.'''
+
+    def __init__(self, schedule=None):
+        self.step = 1
+        self.response = None
+        self.last_stimulus = None
+        self.last_response = None
+
+        # The next step to record v and w in, if only recorded at some steps
+        self.next_record_step = None
+        if schedule is not None:
+            self.next_record_step = schedule.next_step(0)
+
+
+class RecordSchedule():
+
+    '''The steps at which v and w are recorded: every every:th step, or the steps in the list
+       steps. Step 0 and the last step are always recorded.'''
+
+    def __init__(self, every=None, steps=None):
+        self.every = every
+        self.steps = sorted(set(steps)) if steps is not None else None
+
+    def next_step(self, step):
+        '''The first step after step to record, or None if there is none.'''
+        if self.every is not None:
+            return (step // self.every + 1) * self.every
+        ind = bisect_right(self.steps, step)
+        if ind < len(self.steps):
+            return self.steps[ind]
+        return None
+
+    def __eq__(self, other):
+        return (isinstance(other, RecordSchedule) and self.every == other.every and
+                self.steps == other.steps)
+
+
+class RunGroup():
+
+    '''Runs that are simulated together: script runs with the same parameters whose first
+       n_shared phases are the same phases. The shared phases are simulated once per subject,
+       and the state after them (mechanism, world position, loop state, random number
+       generator and output so far) is copied into each run, which continues with its
+       remaining phases.
+
+       A group with one run and n_shared=0 is simulated as the run itself.'''
+
+    def __init__(self, script_runs, n_shared=0):
+        self.script_runs = script_runs
+        self.n_shared = n_shared
+        self.n_subjects = script_runs[0].n_subjects
+
+    def run(self, progress=None, subjects=None, seed=None, spill=None):
+        '''Simulates the runs and returns a list of their RunOutput objects. seed and the
+           random numbers of the shared phases are those of the first run.'''
+        first = self.script_runs[0]
+        if self.n_shared == 0:
+            return [first.run(progress, subjects, seed, spill)]
+
+        if subjects is None:
+            subjects = range(self.n_subjects)
+        outs = [script_run.start_output(len(subjects)) for script_run in self.script_runs]
+        prefix_world = LsWorld.World(first.world.phases[:self.n_shared])
+
+        n_done = 0
+        for subject_ind, subject in enumerate(subjects):
+            if seed is not None:
+                random.seed(subject_seed(seed, first.runlabel, subject))
+            state = SubjectState(first.schedule)
+            cancelled = first.simulate(outs[0], subject_ind, prefix_world, first.mechanism_obj,
+                                       state, progress)
+            if not cancelled:
+                mechanism_obj = copy.deepcopy(first.mechanism_obj)
+                output_subject = copy.deepcopy(outs[0].output_subjects[subject_ind])
+                random_state = random.getstate()
+
+                # The other runs continue from copies of the state after the shared phases, the
+                # first run from the state itself
+                for script_run, out in reversed(list(zip(self.script_runs, outs))):
+                    if script_run is first:
+                        run_mechanism_obj = first.mechanism_obj
+                        run_state = state
+                    else:
+                        out.output_subjects[subject_ind] = copy.deepcopy(output_subject)
+                        run_mechanism_obj = copy.deepcopy(mechanism_obj)
+                        run_state = copy.copy(state)
+                    random.setstate(random_state)
+                    world = script_run.world
+                    world.curr_phaseind = self.n_shared
+                    if self.n_shared < world.nphases:
+                        cancelled = script_run.simulate(out, subject_ind, world,
+                                                        run_mechanism_obj, run_state, progress)
+                    if cancelled:
+                        break
+                    script_run.finish_subject(out, subject_ind, run_mechanism_obj, run_state)
+                    world.subject_reset()
+                    if spill is not None:
+                        spill.subject_done(out, subject_ind)
+            prefix_world.subject_reset()
+            first.mechanism_obj.subject_reset()
+
+            if cancelled:
+                break
+            n_done += 1
+            if progress is not None:
+                progress.n_subjects_done += len(self.script_runs)
+
+        # A subject interrupted by cancellation is left out of all runs
+        for out in outs:
+            del out.output_subjects[n_done:]
+            out.n_subjects = n_done
+        return outs
+
+
+def group_runs(script_runs, share_prefix=False):
+    '''Returns a list of RunGroup objects for the ScriptRun objects in script_runs. If
+       share_prefix is False, each run is its own group. Otherwise, runs with the same
+       parameters, number of subjects and recording that start with the same phase are put in
+       the same group, sharing their longest common prefix of phases.'''
+    groups = list()
+    for script_run in script_runs:
+        if not share_prefix:
+            groups.append(RunGroup([script_run]))
+            continue
+        for group in groups:
+            first = group.script_runs[0]
+            if first.parameters is None or first.parameters != script_run.parameters:
+                continue
+            if first.n_subjects != script_run.n_subjects or first.record != script_run.record:
+                continue
+            if first.schedule != script_run.schedule or first.history != script_run.history:
+                continue
+            if first.history_coding != script_run.history_coding:
+                continue
+            n_shared = common_prefix_len(first.phase_sources, script_run.phase_sources)
+            n_shared = min(n_shared, group.n_shared) if len(group.script_runs) > 1 else n_shared
+            if n_shared > 0:
+                group.script_runs.append(script_run)
+                group.n_shared = n_shared
+                break
+        else:
+            groups.append(RunGroup([script_run]))
+    return groups
+
+
+def common_prefix_len(phases1, phases2):
+    '''The number of leading phases that are the same objects in the lists phases1 and
+       phases2.'''
+    if phases1 is None or phases2 is None:
+        return 0
+    n = 0
+    for phase1, phase2 in zip(phases1, phases2):
+        if phase1 is not phase2:
+            break
+        n += 1
+    return n
+
+
+def run_parallel(groups, jobs=None, seed=None, progress=None, spill=None, subjects=None):
+    '''Simulates the RunGroup objects in the list groups in a pool of jobs processes
+       (default: number of CPUs) and returns a list of the RunOutput objects of their runs, in
+       the same order.
+
+       All groups share the pool, and the subjects of a group are split into chunks when
+       there are fewer groups than processes. Each subject is seeded with subject_seed (from
+       seed, or a random seed if seed is None), so the output is the same as from
+       group.run(seed=seed) for each group in turn.
+
+       If progress is given, n_subjects_done is updated as chunks finish. If progress is
+       cancelled, the chunks not yet started are cancelled and the output has the runs of the
+       groups before the first unfinished group.
+
+       If spill (an LsStore.SpillStore object) is given, each chunk gets an equal share of its
+       memory budget. Spilled subjects are sent back as file names.
+
+       If subjects (a range) is given, only these subjects of each group are simulated.
+
+       The output of each chunk is sent back in shared memory (see LsStore.to_shared_memory),
+       and the output subjects have views into it.
+    '''
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if seed is None:
+        seed = random.getrandbits(64)
+
+    if subjects is None:
+        chunks = subject_chunks([group.n_subjects for group in groups], jobs)
+    else:
+        chunks = [(group_ind, subjects[chunk.start:chunk.stop]) for group_ind, chunk in
+                  subject_chunks([len(subjects)] * len(groups), jobs)]
+    LsStore.prepare_shared_memory()
+    pool = ProcessPoolExecutor(max_workers=jobs)
+    receiver = _ChunkReceiver()
+    futures = list()
+    try:
+        for group_ind, subjects in chunks:
+            chunk_spill = spill.share(len(chunks)) if spill is not None else None
+            future = pool.submit(_run_chunk, groups[group_ind], subjects, seed, chunk_spill)
+            future.add_done_callback(receiver.done)
+            futures.append(future)
+        chunk_sizes = {future: len(subjects) * len(groups[group_ind].script_runs)
+                       for future, (group_ind, subjects) in zip(futures, chunks)}
+        for future in as_completed(futures):
+            future.result()  # Raise any exception from the worker
+            if progress is not None:
+                progress.n_subjects_done += chunk_sizes[future]
+                if progress.cancelled:
+                    break
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    out = list()
+    for group_ind in range(len(groups)):
+        group_futures = [future for future, (chunk_group_ind, _) in zip(futures, chunks)
+                         if chunk_group_ind == group_ind]
+        if not all(future.done() and not future.cancelled() for future in group_futures):
+            break
+        run_outputs = receiver.receive(group_futures[0])
+        for future in group_futures[1:]:
+            for run_output, chunk_output in zip(run_outputs, receiver.receive(future)):
+                run_output.output_subjects.extend(chunk_output.output_subjects)
+        for run_output in run_outputs:
+            run_output.n_subjects = len(run_output.output_subjects)
+        out.extend(run_outputs)
+    return out
+
+
+def _run_chunk(group, subjects, seed, spill):
+    return LsStore.to_shared_memory(group.run(None, subjects, seed, spill))
+
+
+class _ChunkReceiver():
+    '''Gets the RunOutput objects of the finished chunks of run_parallel from shared memory,
+       once per chunk. done is a done callback of the chunks, so that chunks that finish after
+       a cancel do not leave their shared memory behind.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # Keys are futures, values are lists of RunOutput objects
+        self.run_outputs = dict()
+
+    def receive(self, future):
+        with self.lock:
+            if future not in self.run_outputs:
+                self.run_outputs[future] = LsStore.from_shared_memory(future.result())
+            return self.run_outputs[future]
+
+    def done(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.receive(future)
+
+
+def subject_chunks(n_subjects, jobs):
+    '''Splits the subjects of groups with n_subjects[i] subjects into a list of (group index,
+       range of subjects) such that there are at least jobs chunks, if possible.'''
+    n_chunks = max(1, math.ceil(jobs / max(len(n_subjects), 1)))
+    chunks = list()
+    for group_ind, n in enumerate(n_subjects):
+        group_chunks = min(n_chunks, n)
+        for i in range(group_chunks):
+            start = (i * n) // group_chunks
+            stop = ((i + 1) * n) // group_chunks
+            chunks.append((group_ind, range(start, stop)))
+        if n == 0:
+            chunks.append((group_ind, range(0)))
+    return chunks
+
+
+def subject_seed(seed, runlabel, subject):
+    '''The random seed for the subject with index subject in the run runlabel.'''
+    return "{0}:{1}:{2}".format(seed, runlabel, subject)
+
+
+class Progress():
+
+    '''Progress of a simulation, written by the simulating thread and read by others.'''
+
+    def __init__(self):
+        self.n_subjects = 0  # Total number of subjects in all runs
+        self.n_subjects_done = 0
+        self.n_steps = 0
+        self.cancelled = False
+        self.start_time = time.perf_counter()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def steps_per_second(self):
+        elapsed = time.perf_counter() - self.start_time
+        if elapsed > 0:
+            return self.n_steps / elapsed
+        else:
+            return 0
@@ -0,0 +1,412 @@
+'''Result store: saves a ScriptOutput to a compact binary file and loads it back.
+
+The file consists of a magic string, the length of a JSON header, the header, and a data
+section with the raw arrays. The header describes each run and subject and where its arrays
+are in the data section. Each array starts at a multiple of 8 bytes. Loading memory-maps the
+file, so the v/w values and steps and the history codes are memoryviews into the map and are
+only read from disk when evaluated. Int values (such as an int start_v) are kept as ints, so
+that the output exports the same as before it was stored.
+
+The same layout is used to send simulation output between processes: to_shared_memory writes
+the arrays to a block of shared memory and from_shared_memory makes RunOutput objects with
+views into it, so only the small header is pickled.
+'''
+from LsOutput import ScriptOutput, RunOutput, RunOutputSubject, Val
+from LsHistory import CodedHistory, PatternCounter, encode
+from LsExceptions import LsEvalException
+
+from array import array
+import ast
+from bisect import bisect_left
+from collections.abc import Sequence
+import atexit
+import copy
+import json
+import mmap
+from multiprocessing import resource_tracker, shared_memory
+import os
+import shutil
+import struct
+import tempfile
+
+MAGIC = b'LSRESULT'
+VERSION = 1
+ALIGNMENT = 8
+
+VALUE_TYPECODE = 'd'
+INT_VALUE_TYPECODE = 'q'  # For v/w traces with only int values (such as an int start_v)
+STEP_TYPECODE = 'q'
+
+# Estimated memory, in bytes, of a recorded v/w point (a float and an int object in lists) and
+# of a history item (a reference) or counted pattern position in a RunOutputSubject in memory.
+# A coded history gives its own size (see LsHistory.CodedHistory.nbytes).
+POINT_MEMORY = 64
+HISTORY_ITEM_MEMORY = 8
+
+
+def _to_json(item):
+    '''History symbols and dict keys may be tuples, which JSON stores as lists.'''
+    if type(item) is tuple:
+        return list(item)
+    return item
+
+
+def _from_json(item):
+    if type(item) is list:
+        return tuple(item)
+    return item
+
+
+class _DataWriter():
+    def __init__(self):
+        self.chunks = list()
+        self.size = 0
+
+    def add(self, arr):
+        '''Adds the array arr to the data section and returns [offset, length, typecode].'''
+        data = arr.tobytes()
+        offset = self.size
+        self.chunks.append(data)
+        self.size += len(data)
+        padding = (-self.size) % ALIGNMENT
+        if padding:
+            self.chunks.append(b'\0' * padding)
+            self.size += padding
+        return [offset, len(arr), arr.typecode]
+
+
+def _val_header(val, writer):
+    '''[values, steps], or [values, steps, int indices] if only some of the values are ints.
+       The int values are kept as ints, so that they are exported as written.'''
+    values = val.values
+    int_indices = [i for i, value in enumerate(values) if type(value) is int]
+    if len(int_indices) == len(values):
+        return [writer.add(array(INT_VALUE_TYPECODE, values)),
+                writer.add(array(STEP_TYPECODE, val.steps))]
+    header = [writer.add(array(VALUE_TYPECODE, values)),
+              writer.add(array(STEP_TYPECODE, val.steps))]
+    if len(int_indices) > 0:
+        header.append(writer.add(array(STEP_TYPECODE, int_indices)))
+    return header
+
+
+class MixedValues(Sequence):
+    '''The values of a loaded Val with both int and float values: a sequence of floats and the
+       increasing indices of the values that are ints, which are returned as ints.'''
+
+    def __init__(self, values, int_indices):
+        self.values = values
+        self.int_indices = int_indices
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, ind):
+        if type(ind) is slice:
+            return [self[i] for i in range(*ind.indices(len(self.values)))]
+        if ind < 0:
+            ind += len(self.values)
+        value = self.values[ind]
+        k = bisect_left(self.int_indices, ind)
+        if k < len(self.int_indices) and self.int_indices[k] == ind:
+            return int(value)
+        return value
+
+    def __iter__(self):
+        int_indices = self.int_indices
+        k = 0
+        for i, value in enumerate(self.values):
+            if k < len(int_indices) and int_indices[k] == i:
+                k += 1
+                yield int(value)
+            else:
+                yield value
+
+
+def _subject_header(output_subject, writer):
+    header = {'v': [[_to_json(key), _val_header(val, writer)]
+                    for key, val in output_subject.v.items()],
+              'w': [[key, _val_header(val, writer)] for key, val in output_subject.w.items()],
+              'sampled': output_subject.sampled,
+              'start_v': None if output_subject.start_v is None else
+              [[_to_json(key), value] for key, value in output_subject.start_v.items()],
+              'first_step_phase': [list(output_subject.first_step_phase[0]),
+                                   list(output_subject.first_step_phase[1])]}
+    if output_subject.history is None:
+        header['counter'] = _counter_header(output_subject.counter, writer)
+    else:
+        codes, symbols = encode(output_subject.history)
+        header['history'] = writer.add(codes)
+        header['symbols'] = [_to_json(symbol) for symbol in symbols]
+    return header
+
+
+def _counter_header(counter, writer):
+    # Patterns are stored with repr, since JSON does not tell lists from tuples
+    return {'patterns': [[repr(pattern), use_exact_match]
+                         for pattern, use_exact_match in counter.patterns],
+            'positions': [writer.add(positions) for positions in counter.positions],
+            'boundary_items': [[index, _to_json(item)]
+                               for index, item in sorted(counter.boundary_items.items())],
+            'n_items': counter.n_items}
+
+
+def save(script_output, filename):
+    '''Writes the ScriptOutput object script_output to the file filename.'''
+    writer = _DataWriter()
+    runs = list()
+    for run_label, run_output in script_output.run_outputs.items():
+        subjects = [_subject_header(output_subject, writer)
+                    for output_subject in run_output.output_subjects]
+        stimulus_req = None
+        if len(run_output.output_subjects) > 0:
+            stimulus_req = run_output.output_subjects[0].stimulus_req
+        runs.append({'label': run_label,
+                     'stimulus_req': stimulus_req,
+                     'precision': run_output.precision,
+                     'subjects': subjects})
+    _write(filename, {'version': VERSION, 'runs': runs}, writer)
+
+
+def load(filename):
+    '''Reads a file written by save and returns a ScriptOutput object whose arrays are
+       memory-mapped from the file.'''
+    header, data = _read(filename)
+    if 'runs' not in header:
+        raise LsEvalException("The file '{}' is not a result file.".format(filename))
+    run_outputs = dict()
+    for run in header['runs']:
+        run_output = RunOutput(0, run['stimulus_req'])
+        for subject in run['subjects']:
+            run_output.output_subjects.append(_load_subject(subject, run['stimulus_req'], data))
+        run_output.n_subjects = len(run_output.output_subjects)
+        run_output.precision = run.get('precision')
+        run_outputs[run['label']] = run_output
+    return ScriptOutput(run_outputs)
+
+
+def save_subject(output_subject, filename):
+    '''Writes the RunOutputSubject object output_subject to the file filename.'''
+    writer = _DataWriter()
+    subject = _subject_header(output_subject, writer)
+    _write(filename, {'version': VERSION, 'stimulus_req': output_subject.stimulus_req,
+                      'subject': subject}, writer)
+
+
+def load_subject(filename):
+    '''Reads a file written by save_subject and returns a RunOutputSubject object whose
+       arrays are memory-mapped from the file.'''
+    header, data = _read(filename)
+    if 'subject' not in header:
+        raise LsEvalException("The file '{}' is not a subject file.".format(filename))
+    return _load_subject(header['subject'], header['stimulus_req'], data)
+
+
+class _SharedBlock(shared_memory.SharedMemory):
+    '''A shared memory block received by from_shared_memory.'''
+
+    def close(self):
+        try:
+            super().close()
+        except BufferError:
+            # Arrays of the subjects are still in use elsewhere. The memory is unmapped when
+            # they are deleted.
+            pass
+
+
+def prepare_shared_memory():
+    '''Starts the tracker of shared memory blocks in this process, before starting the
+       processes that call to_shared_memory. They then share the tracker, so a block created in
+       one of them and unlinked in this process by from_shared_memory is not seen as leaked.'''
+    resource_tracker.ensure_running()
+
+
+def to_shared_memory(run_outputs):
+    '''Writes the arrays of the RunOutput objects in the list run_outputs to a new block of
+       shared memory. Returns (block name, header), which is passed (pickled) to
+       from_shared_memory in another process. Spilled subjects are sent as their file names.'''
+    writer = _DataWriter()
+    runs = list()
+    for run_output in run_outputs:
+        subjects = list()
+        for output_subject in run_output.output_subjects:
+            if output_subject.spill_file is not None:
+                subjects.append({'spill_file': output_subject.spill_file})
+            else:
+                subjects.append(_subject_header(output_subject, writer))
+        stimulus_req = None
+        if len(run_output.output_subjects) > 0:
+            stimulus_req = run_output.output_subjects[0].stimulus_req
+        runs.append({'stimulus_req': stimulus_req, 'subjects': subjects})
+    if writer.size == 0:
+        return None, runs
+
+    block = shared_memory.SharedMemory(create=True, size=writer.size)
+    offset = 0
+    for chunk in writer.chunks:
+        block.buf[offset:(offset + len(chunk))] = chunk
+        offset += len(chunk)
+    block.close()
+    return block.name, runs
+
+
+def from_shared_memory(shared):
+    '''Returns the list of RunOutput objects sent by to_shared_memory, whose arrays are views
+       into the shared memory block. The block is unlinked, and is freed when the subjects are
+       deleted.'''
+    name, runs = shared
+    block = None
+    data = memoryview(b'')
+    if name is not None:
+        block = _SharedBlock(name)
+        block.unlink()
+        data = block.buf
+    run_outputs = list()
+    for run in runs:
+        run_output = RunOutput(0, run['stimulus_req'])
+        for subject in run['subjects']:
+            if 'spill_file' in subject:
+                output_subject = load_subject(subject['spill_file'])
+                output_subject.spill_file = subject['spill_file']
+            else:
+                output_subject = _load_subject(subject, run['stimulus_req'], data)
+                output_subject.shared_memory = block
+            run_output.output_subjects.append(output_subject)
+        run_output.n_subjects = len(run_output.output_subjects)
+        run_outputs.append(run_output)
+    return run_outputs
+
+
+def _write(filename, header, writer):
+    header = json.dumps(header).encode('utf-8')
+    prefix_len = len(MAGIC) + 8 + len(header)
+    header += b' ' * ((-prefix_len) % ALIGNMENT)  # Align the data section
+
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for chunk in writer.chunks:
+            f.write(chunk)
+
+
+def _read(filename):
+    '''Returns the header of the file filename and a memoryview of the memory-mapped data
+       section.'''
+    with open(filename, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise LsEvalException("The file '{}' is not a result file.".format(filename))
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+        if header['version'] != VERSION:
+            raise LsEvalException("Unsupported result file version {}.".format(header['version']))
+        data_start = len(MAGIC) + 8 + header_len
+        f.seek(0, 2)
+        if f.tell() > data_start:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))[data_start:]
+        else:
+            data = memoryview(b'')
+    return header, data
+
+
+def _load_subject(subject, stimulus_req, data):
+    def get_array(spec):
+        offset, length, typecode = spec
+        nbytes = length * array(typecode).itemsize
+        return data[offset:(offset + nbytes)].cast(typecode)
+
+    def get_val(spec):
+        val = Val()
+        val.values = get_array(spec[0])
+        val.steps = get_array(spec[1])
+        if len(spec) > 2:
+            val.values = MixedValues(val.values, get_array(spec[2]))
+        return val
+
+    start_v = subject.get('start_v')
+    if start_v is not None:
+        start_v = {_from_json(key): value for key, value in start_v}
+    output_subject = RunOutputSubject(stimulus_req, sampled=subject.get('sampled', False),
+                                      start_v=start_v)
+    for key, spec in subject['v']:
+        output_subject.v[_from_json(key)] = get_val(spec)
+    for key, spec in subject['w']:
+        output_subject.w[key] = get_val(spec)
+    if 'counter' in subject:
+        header = subject['counter']
+        counter = PatternCounter([(ast.literal_eval(pattern), use_exact_match)
+                                  for pattern, use_exact_match in header['patterns']])
+        counter.positions = [get_array(spec) for spec in header['positions']]
+        counter.boundary_items = {index: _from_json(item)
+                                  for index, item in header['boundary_items']}
+        counter.n_items = header['n_items']
+        output_subject.history = None
+        output_subject.counter = counter
+    else:
+        symbols = [_from_json(symbol) for symbol in subject['symbols']]
+        output_subject.history = CodedHistory(get_array(subject['history']), symbols)
+    output_subject.first_step_phase = tuple(subject['first_step_phase'])
+    return output_subject
+
+
+def estimate_memory(output_subject):
+    '''The estimated memory in bytes used by the RunOutputSubject object output_subject.'''
+    n_points = 0
+    for val in output_subject.v.values():
+        n_points += len(val.values)
+    for val in output_subject.w.values():
+        n_points += len(val.values)
+    history = output_subject.history
+    if history is None:
+        history_memory = HISTORY_ITEM_MEMORY * sum(len(positions) for positions in
+                                                   output_subject.counter.positions)
+    elif type(history) is list:
+        history_memory = HISTORY_ITEM_MEMORY * len(history)
+    else:
+        history_memory = history.nbytes()
+    return n_points * POINT_MEMORY + history_memory
+
+
+class SpillStore():
+    '''Keeps the output of finished subjects in memory up to a memory budget (in bytes), and
+       moves the subjects that do not fit to memory-mapped files in a scratch directory.
+
+       The scratch directory is created in directory (default: the system temporary
+       directory) and removed when the program exits.
+    '''
+
+    def __init__(self, budget, directory=None):
+        self.budget = budget
+        self.directory = tempfile.mkdtemp(prefix="lesim-", dir=directory)
+        atexit.register(shutil.rmtree, self.directory, True)
+
+        # Estimated memory of the subjects kept in memory
+        self.in_memory = 0
+
+        self.n_spilled = 0
+
+    def share(self, n):
+        '''A copy with 1/n of the budget, for one of n processes simulating in parallel.'''
+        spill = copy.copy(self)
+        spill.budget = self.budget // n
+        spill.in_memory = 0
+        spill.n_spilled = 0
+        return spill
+
+    def subject_done(self, run_output, subject_ind):
+        '''Called when a subject is finished. Spills the subject to disk if it does not fit in
+           the budget.'''
+        output_subject = run_output.output_subjects[subject_ind]
+        memory = estimate_memory(output_subject)
+        if self.in_memory + memory <= self.budget:
+            self.in_memory += memory
+            return
+        # A unique name, also when several processes or shares spill to the same directory
+        fd, filename = tempfile.mkstemp(suffix=".lss", dir=self.directory)
+        os.close(fd)
+        save_subject(output_subject, filename)
+        spilled_subject = load_subject(filename)
+        spilled_subject.spill_file = filename
+        run_output.output_subjects[subject_ind] = spilled_subject
+        self.n_spilled += 1
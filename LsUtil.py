@@ -222,6 +222,39 @@ def eval_average(datas):
     return sumpoints
 
 
+def hold_resample(x, y, x_new):
+    '''Returns the values of the piecewise constant series (x, y) at the increasing points
+       x_new that are not after x[-1], where the value at a point is y at the last x before
+       or at it. x is increasing and x_new[0] >= x[0].'''
+    out = list()
+    ind = 0
+    n = len(x)
+    last_x = x[-1]
+    for xi in x_new:
+        if xi > last_x:
+            break
+        while ind + 1 < n and x[ind + 1] <= xi:
+            ind += 1
+        out.append(y[ind])
+    return out
+
+
+def eval_average_xy(xs, ys):
+    '''Like eval_average, but for piecewise constant series (xs[i], ys[i]) with different x.
+       Returns (x, y), where x is the union of xs and y is the average of the series that have
+       not ended at each point.'''
+    x_out = sorted(set().union(*xs))
+    sumpoints = [0] * len(x_out)
+    npoints = [0] * len(x_out)
+    for x, y in zip(xs, ys):
+        for ind, value in enumerate(hold_resample(x, y, x_out)):
+            sumpoints[ind] += value
+            npoints[ind] += 1
+    for ind in range(len(x_out)):
+        sumpoints[ind] /= npoints[ind]
+    return x_out, sumpoints
+
+
 def dict_of_list_ind(d, ind):
     '''d is a dict where all values are lists of equal length. Returns a new dict where each
        value is the ind:th list item for each key.'''
@@ -232,29 +265,20 @@ def dict_of_list_ind(d, ind):
 
 
 def find_and_cumsum(seq, pattern, use_exact_match):
-    '''seq is list of strings and tuples.
+    '''seq is list of strings and tuples, or a history object with a find_and_cumsum method
+       (such as LsHistory.CodedHistory).
        pattern is a string, a tuple of strings or a list of strings and tuples of strings.
        If use_exact_match is false, count also part of tuples as match.'''
 
+    if hasattr(seq, 'find_and_cumsum'):
+        return seq.find_and_cumsum(pattern, use_exact_match)
+
     assert(type(seq) == list)
     for s in seq:
         s_type = type(s)
         assert((s_type is str) or (s_type is tuple))
 
-    pattern_type = type(pattern)
-    assert((pattern_type is list) or (pattern_type is tuple) or (pattern_type is str))
-    pattern_len = 1
-    if pattern_type is tuple:
-        for p in pattern:
-            assert(type(p) is str)
-        pattern_list = [pattern]
-    elif pattern_type is list:
-        pattern_len = len(pattern)
-        for p in pattern:
-            assert((type(p) is str) or (type(p) is tuple))
-        pattern_list = pattern
-    else:
-        pattern_list = [pattern]
+    pattern_list, pattern_len = parse_pattern(pattern)
 
     seq_len = len(seq)
 
@@ -276,6 +300,31 @@ def find_and_cumsum(seq, pattern, use_exact_match):
     return findind, cumsum
 
 
+def parse_pattern(pattern):
+    '''Returns pattern (see find_and_cumsum) as a list with one item per history item, and the
+       length of that list.'''
+    pattern_type = type(pattern)
+    assert((pattern_type is list) or (pattern_type is tuple) or (pattern_type is str))
+    pattern_len = 1
+    if pattern_type is tuple:
+        for p in pattern:
+            assert(type(p) is str)
+        pattern_list = [pattern]
+    elif pattern_type is list:
+        pattern_len = len(pattern)
+        for p in pattern:
+            assert((type(p) is str) or (type(p) is tuple))
+        pattern_list = pattern
+    else:
+        pattern_list = [pattern]
+    return pattern_list, pattern_len
+
+
+def is_match_item(item, pattern_item, use_exact_match):
+    '''Whether the history item matches the pattern item.'''
+    return _is_match_local(item, pattern_item, use_exact_match)
+
+
 def _is_match(seq, pattern, use_exact_match):
     for i in range(len(seq)):
         if not _is_match_local(seq[i], pattern[i], use_exact_match):
@@ -333,6 +382,47 @@ def diff(x, diffind):
     return out
 
 
+def decimate(x, y, n_buckets):
+    '''Reduces the series (x, y) to at most about 2 * n_buckets points, keeping the minimum
+       and maximum of y in each of n_buckets buckets of consecutive points (and the first and
+       last point), so that the envelope of a line plot is unchanged at a resolution of
+       n_buckets pixels. If x is None, x is taken as 0, 1, 2, ...
+       Returns (x, y) as lists. Items in y that are None are not considered minima/maxima.'''
+    ylen = len(y)
+    if x is None:
+        x = range(ylen)
+    if ylen <= 2 * n_buckets + 2:
+        return list(x), list(y)
+
+    x_out = [x[0]]
+    y_out = [y[0]]
+    bucket_size = (ylen - 2) / n_buckets
+    for bucket in range(n_buckets):
+        start = 1 + int(bucket * bucket_size)
+        stop = 1 + int((bucket + 1) * bucket_size)
+        min_ind = None
+        max_ind = None
+        for i in range(start, stop):
+            yi = y[i]
+            if yi is None:
+                continue
+            if min_ind is None:
+                min_ind = i
+                max_ind = i
+            elif yi < y[min_ind]:
+                min_ind = i
+            elif yi > y[max_ind]:
+                max_ind = i
+        if min_ind is None:
+            continue
+        for i in sorted({min_ind, max_ind}):
+            x_out.append(x[i])
+            y_out.append(y[i])
+    x_out.append(x[ylen - 1])
+    y_out.append(y[ylen - 1])
+    return x_out, y_out
+
+
 def arrayind(x, ind):
     assert (len(x) == len(ind)), "x and ind must have equal length."
     out = list()
@@ -360,14 +450,14 @@ def dict_inv(d_in):
             elif len(v) == 0:
                 raise Exception(val_errmsg)
 
-    all_val = set()
+    # In one pass over the values. A key is appended once to each of its values, also if the
+    # value is repeated.
+    d_out = dict()
     for key, val in d.items():
         for v in val:
-            all_val.add(v)
-    d_out = dict()
-    for v in all_val:
-        d_out[v] = list()
-        for key, val in d.items():
-            if v in val:
-                d_out[v].append(key)
+            keys = d_out.get(v)
+            if keys is None:
+                d_out[v] = [key]
+            elif keys[-1] != key:
+                keys.append(key)
     return d_out
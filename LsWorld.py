@@ -2,6 +2,8 @@ from LsConstants import *
 import LsUtil
 from LsExceptions import LsParseException
 
+import re
+
 
 class World():
     '''A world, returning a sequence of stimuli, depending on the incoming sequence of responses.'''
@@ -45,6 +47,7 @@ class PhaseWorld():
         self.stimulus_elements = stimulus_elements
         self.behaviors = behaviors
         self._create(rows)
+        self._compile_endphase()
 
         self.curr_lineobj = None
         self.subject_reset()
@@ -75,9 +78,38 @@ class PhaseWorld():
             self.phase_lines[label] = PhaseLine(label, after_label, self.linelabels,
                                                 self.stimulus_elements, self.behaviors)
 
-    def subject_reset(self):
-        valid_items = self.stimulus_elements + self.behaviors + self.linelabels
+    def _compile_endphase(self):
+        '''Parses the end condition once, and computes how much each line (its label and
+           stimulus) and each response adds to the item count(s) of the end condition.'''
+        valid_items = set(self.stimulus_elements) | set(self.behaviors) | set(self.linelabels)
         self.endphase_obj = EndPhaseCondition(self.endphase_str, valid_items)
+
+        # For a single end condition, the increments are ints and the count is self.end_count.
+        # For compound conditions, the increments are tuples with one int per condition and
+        # the counts are in the list self.end_counts.
+        self.is_compound_end = self.endphase_obj.is_compound()
+        self.end_limit = self.endphase_obj.limit
+        self.end_limits = tuple(self.endphase_obj.limits)
+        self.line_end_inc = dict()
+        for label, line in self.phase_lines.items():
+            inc = [a + b for a, b in zip(self.endphase_obj.contributions(label),
+                                         self.endphase_obj.contributions(line.stimulus))]
+            self.line_end_inc[label] = self._end_inc(inc)
+        self.response_end_inc = dict()
+        for behavior in self.behaviors:
+            inc = self.endphase_obj.contributions(behavior)
+            if any(inc):
+                self.response_end_inc[behavior] = self._end_inc(inc)
+
+    def _end_inc(self, inc):
+        if self.is_compound_end:
+            return tuple(inc)
+        else:
+            return inc[0]
+
+    def subject_reset(self):
+        self.end_count = 0
+        self.end_counts = [0] * len(self.end_limits)
         self._make_current_line(self.first_label)
         self.prev_linelabel = None
         self.first_stimulus = True
@@ -93,13 +125,27 @@ class PhaseWorld():
             self.prev_linelabel = self.curr_lineobj.label
             self._make_current_line(rowlbl)
 
-        if self.endphase_obj.is_met():
+        if self.is_compound_end:
+            return self._next_stimulus_compound_end(stimulus, rowlbl, response)
+
+        if self.end_count >= self.end_limit:
             return None
-        else:
-            self.endphase_obj.update_itemfreq(rowlbl)
-            self.endphase_obj.update_itemfreq(stimulus)
-            if response is not None:
-                self.endphase_obj.update_itemfreq(response)
+        self.end_count += self.line_end_inc[rowlbl]
+        if response is not None:
+            self.end_count += self.response_end_inc.get(response, 0)
+        return stimulus
+
+    def _next_stimulus_compound_end(self, stimulus, rowlbl, response):
+        end_counts = self.end_counts
+        for count, limit in zip(end_counts, self.end_limits):
+            if count >= limit:
+                return None
+        incs = [self.line_end_inc[rowlbl]]
+        if response is not None and response in self.response_end_inc:
+            incs.append(self.response_end_inc[response])
+        for inc in incs:
+            for i, inc_i in enumerate(inc):
+                end_counts[i] += inc_i
         return stimulus
 
     def _make_current_line(self, label):
@@ -181,16 +227,7 @@ class PhaseLineCondition():
         self._parse(condition_str, stimulus_elements, behaviors, all_linelabels)
 
     def is_met(self, response, consec_linecnt, consec_respcnt):
-        # ismet = False
-        if (self.response is not None) and (self.count is not None):
-            ismet = (response == self.response) and (consec_respcnt >= self.count)
-        elif (self.response is None) and (self.count is not None):
-            ismet = (consec_linecnt >= self.count)
-        elif (self.response is not None) and (self.count is None):
-            ismet = (response == self.response)
-        else:  # (self.response is None) and (self.count is None):
-            ismet = True
-
+        ismet = self.holds(response, consec_linecnt, consec_respcnt)
         if ismet:
             label = self._goto_if_met()
             if label is None:  # In "ROW1(0.1),ROW2(0.3)", goto_if_met returns None with prob. 0.6
@@ -199,6 +236,18 @@ class PhaseLineCondition():
             label = None
         return ismet, label
 
+    def holds(self, response, consec_linecnt, consec_respcnt):
+        '''Whether the part before the colon is met, so that the condition goes to one of its
+           line labels (with their probabilities).'''
+        if (self.response is not None) and (self.count is not None):
+            return (response == self.response) and (consec_respcnt >= self.count)
+        elif (self.response is None) and (self.count is not None):
+            return (consec_linecnt >= self.count)
+        elif (self.response is not None) and (self.count is None):
+            return (response == self.response)
+        else:  # (self.response is None) and (self.count is None):
+            return True
+
     def _goto_if_met(self):
         tuple_ind = LsUtil.weighted_choice(self.goto_prob_cumsum)
         if tuple_ind is None:
@@ -280,36 +329,47 @@ class PhaseLineCondition():
 
 
 class EndPhaseCondition():
-    def __init__(self, endcond_str, valid_items):
-        item, number_str = LsUtil.parse_equals(endcond_str)
-        if item not in valid_items:
-            raise LsParseException("Error on condition {0}. Invalid item {1}.".format(endcond_str,
-                                                                                      item))
-        self.item = item
-        isnumber, number = LsUtil.is_posint(number_str)
-        if not isnumber:
-            raise LsParseException("Error on condition {0}. {1} is not an integer.".format(endcond_str, number))
-        self.limit = number
-
-        self.itemfreq = 0
-        #self.itemfreq = dict()
-        #for item in valid_items:
-        #    self.itemfreq[item] = 0
+    '''An end condition "item=limit", or several such joined with "or" (for example
+       "reward=100 or trial=500"). The condition is met when any item has occurred (as line
+       label, stimulus element or response) at least limit times.'''
 
-    def update_itemfreq(self, item):
+    def __init__(self, endcond_str, valid_items):
+        self.items = list()
+        self.limits = list()
+        for condition_str in re.split(r'\s+or\s+', endcond_str.strip()):
+            item, number_str = LsUtil.parse_equals(condition_str)
+            if item not in valid_items:
+                raise LsParseException("Error on condition {0}. Invalid item {1}.".format(endcond_str,
+                                                                                          item))
+            isnumber, number = LsUtil.is_posint(number_str)
+            if not isnumber:
+                raise LsParseException("Error on condition {0}. {1} is not an integer.".format(endcond_str, number_str))
+            self.items.append(item)
+            self.limits.append(number)
+
+        # The first (in most cases the only) condition
+        self.item = self.items[0]
+        self.limit = self.limits[0]
+
+        self.itemfreq = [0] * len(self.items)
+
+    def is_compound(self):
+        return len(self.items) > 1
+
+    def contributions(self, item):
+        '''Returns a list with the number of times item (a string or a tuple of strings)
+           counts towards each condition.'''
         if type(item) is tuple:
-            for element in item:
-                if element == self.item:
-                    self.itemfreq += 1
-                #self.itemfreq[element] += 1
+            return [item.count(cond_item) for cond_item in self.items]
         else:
-            if item == self.item:
-                self.itemfreq += 1
-            #self.itemfreq[item] += 1
+            return [int(item == cond_item) for cond_item in self.items]
+
+    def update_itemfreq(self, item):
+        for i, inc in enumerate(self.contributions(item)):
+            self.itemfreq[i] += inc
 
     def is_met(self):
-        #if self.item not in self.itemfreq:
-        #    return False
-        #else:
-        #return self.itemfreq[self.item] >= self.limit
-        return self.itemfreq >= self.limit
+        for freq, limit in zip(self.itemfreq, self.limits):
+            if freq >= limit:
+                return True
+        return False
@@ -1,12 +1,24 @@
 # import cProfile
 
-import LsGui
 import LsScript
+import LsBench
+import LsProfile
+import LsStore
+import LsServer
+import LsShard
 
+import os
 import sys
 
 GUI = "gui"
 RUN = "run"
+POST = "post"
+BENCH = "bench"
+SERVE = "serve"
+SUBMIT = "submit"
+SHARD = "shard"
+WORKER = "worker"
+MERGE = "merge"
 HELP = "help"
 
 
@@ -19,11 +31,259 @@ def get_man_page():
     python lesim.py gui
         Starts the Learning Simulator gui
 
-    python lesim.py run file1 [file2, file3, ...]
+    python lesim.py run [--jobs N] [--seed seed] [--share-prefix] [--memory-budget size]
+                        [--scratch dir] [--save file] [--figures dir] [--format fmt]
+                        [--profile] [--cprofile file] [--stacks file] [--interval sec]
+                        file1 [file2, file3, ...]
         Run the script files file1, file2, ...
+        --jobs N         Simulate the runs, and the subjects within them, in N parallel
+                         processes (0 for the number of CPUs, default 1)
+        --seed seed      Seed each subject's random numbers from seed, so that the results are
+                         the same for every N
+        --share-prefix   Simulate phases that runs with the same parameters start with once
+                         per subject, and continue each run from a copy of the state after
+                         them
+        --memory-budget size
+                         Keep the simulation output in memory up to size bytes (suffix K, M or
+                         G allowed, e.g. 500M) and move the output of further subjects to
+                         memory-mapped files
+        --scratch dir    Directory for the files of --memory-budget (default: the system
+                         temporary directory)
+        --save file      Save the simulation results to file (only one script file), to be
+                         postprocessed later with "lesim.py post"
+        --figures dir    Render the figures without display and save them in the directory dir,
+                         named by the @figure title
+        --format fmt     File format for --figures: png, svg or pdf (default png)
+        --profile        Time parsing, simulation (World.next_stimulus,
+                         Mechanism.learn_and_respond, output recording) and postprocessing
+                         (evaluation, each post command) and print a breakdown at the end.
+                         The simulation is then made in this process, also with --jobs, so
+                         that its stages are timed
+        --cprofile file  Also write a cProfile dump to file (implies --profile)
+        --stacks file    Also write sampled call stacks in flame graph "folded" format to
+                         file (implies --profile)
+        --interval sec   Sampling interval for --stacks (default {interval})
+
+    python lesim.py post --load file [--figures dir] [--format fmt] script
+        Run the post commands (@plot, @export, etc.) in the script file script on the
+        simulation results saved in file by "lesim.py run --save", without simulating
+        --load file      The saved simulation results
+        --figures dir    As for "lesim.py run"
+        --format fmt     As for "lesim.py run"
+
+    python lesim.py serve [--address address] [--jobs N]
+        Start a simulation server that keeps the modules imported, N worker processes running
+        (default: number of CPUs) and recently parsed scripts cached, and runs scripts
+        submitted with "lesim.py submit"
+        --address address  "host:port", "port" or the path of a Unix socket (default
+                           {address})
+
+    python lesim.py submit [--address address] [--save file] [--figures dir] [--format fmt]
+                           [--shutdown] file1 [file2, file3, ...]
+        Run the script files file1, file2, ... ("-" for standard input) on a server started
+        with "lesim.py serve" and print the names of the exported and saved files
+        --save file      Save the simulation results to file (only one script file)
+        --figures dir    As for "lesim.py run"
+        --format fmt     As for "lesim.py run"
+        --shutdown       Stop the server
+
+    python lesim.py shard [--shards K] [--seed seed] [--spool dir] script
+        Split the subjects of each run in the script file script into work units (at least K
+        in total, default 1) for "lesim.py worker", and write them to a spool directory
+        --shards K   The number of work units
+        --seed seed  Seed for the subjects, as for "lesim.py run" (default: a random seed)
+        --spool dir  The spool directory (default: the script file name with the extension
+                     .spool)
+
+    python lesim.py worker [--max-units N] spool
+        Claim work units in the spool directory spool, simulate them and write the results
+        to the spool directory, until all units are claimed. Any number of workers, on any
+        machines sharing the spool directory, can run at the same time
+        --max-units N  Stop after N units
+
+    python lesim.py merge [--save file] [--figures dir] [--format fmt] spool
+        Combine the results of the work units in the spool directory spool, and run the post
+        commands of the script on them or save them
+        --save file      Save the combined results to file instead of running the post
+                         commands, to be postprocessed later with "lesim.py post"
+        --figures dir    As for "lesim.py run"
+        --format fmt     As for "lesim.py run"
+
+    python lesim.py bench [--scale X] [--repeat N] [--no-memory] [--output file] [workload ...]
+        Run the benchmark suite (or the specified workloads) and print the steps/second, peak
+        memory and postprocessing time of each workload as JSON. The workloads are
+        {workloads}.
+        --scale X      Scale the length of each workload by the factor X (default 1)
+        --repeat N     Time each workload N times and report the fastest (default 1)
+        --no-memory    Skip the (slow) peak memory measurement
+        --output file  Write the JSON to file instead of to standard output
 
     python lesim.py help
-        Display this help and exit"""
+        Display this help and exit""".format(workloads=", ".join(LsBench.ALL_WORKLOADS),
+                            interval=LsProfile.DEFAULT_SAMPLE_INTERVAL,
+                            address=LsServer.DEFAULT_ADDRESS)
+
+
+def parse_options(args, flags, valued):
+    '''Splits args into a dict of options and a list of positional arguments. flags are
+       options without value, valued are options that take one value.'''
+    options = dict()
+    positional = list()
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in flags:
+            options[arg] = True
+        elif arg in valued:
+            if i + 1 >= len(args):
+                raise Exception("Option {} requires a value.".format(arg))
+            options[arg] = args[i + 1]
+            i += 1
+        elif arg.startswith("--"):
+            raise Exception("Invalid option '{}'. Type 'lesim.py help' for the available options.".format(arg))
+        else:
+            positional.append(arg)
+        i += 1
+    return options, positional
+
+
+def parse_size(size):
+    '''Parses a number of bytes with an optional suffix K, M or G, for example "500M".'''
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    number = size.strip().upper().rstrip('B')
+    multiplier = 1
+    if number and number[-1] in multipliers:
+        multiplier = multipliers[number[-1]]
+        number = number[:-1]
+    try:
+        return int(float(number) * multiplier)
+    except ValueError:
+        raise Exception("Invalid size '{}'.".format(size))
+
+
+def run_files(files, options):
+    profiler = None
+    if ("--profile" in options) or ("--cprofile" in options) or ("--stacks" in options):
+        interval = float(options.get("--interval", LsProfile.DEFAULT_SAMPLE_INTERVAL))
+        profiler = LsProfile.Profiler(options.get("--cprofile"), options.get("--stacks"),
+                                      interval)
+        profiler.start()
+
+    figure_dir = options.get("--figures")
+    figure_format = options.get("--format", "png")
+    jobs = int(options.get("--jobs", 1)) or None
+    if profiler is not None and jobs != 1:
+        # The stages are only timed in this process, so they would all be "(other)" if the
+        # subjects were simulated by workers. The output is the same for any number of jobs.
+        print("Profiling simulates in one process, ignoring --jobs.", file=sys.stderr)
+        jobs = 1
+    seed = options.get("--seed")
+    memory_budget = None
+    if "--memory-budget" in options:
+        memory_budget = parse_size(options["--memory-budget"])
+    save_file = options.get("--save")
+    if save_file is not None and len(files) > 1:
+        raise Exception("Option --save can only be used with one script file.")
+
+    nfiles = len(files)
+    for i, file in enumerate(files):
+        file_obj = open(file, "r")
+        script = file_obj.read()
+        with LsProfile.stage(profiler, LsProfile.PARSE):
+            script_obj = LsScript.LsScript(script)
+        with LsProfile.stage(profiler, LsProfile.SIMULATION):
+            simulation_data = script_obj.run(jobs=jobs, seed=seed,
+                                             share_prefix=("--share-prefix" in options),
+                                             memory_budget=memory_budget,
+                                             scratch_dir=options.get("--scratch"))
+        report_precision(simulation_data)
+        if save_file is not None:
+            LsStore.save(simulation_data, save_file)
+        if profiler is None:
+            block = (i == nfiles - 1)
+            script_obj.postproc(simulation_data, block, figure_dir, figure_format)
+        else:
+            profiler.instrument_postcmds(script_obj.postcmds)
+            with LsProfile.stage(profiler, LsProfile.POSTPROCESSING):
+                script_obj.postproc(simulation_data, False, figure_dir, figure_format)
+
+    if profiler is not None:
+        profiler.stop()
+        print(profiler.report())
+        if "matplotlib.pyplot" in sys.modules:  # Only imported if the scripts plot
+            import matplotlib.pyplot as plt
+            if len(plt.get_fignums()) > 0:
+                plt.show()
+
+
+def report_precision(simulation_data):
+    '''Prints the number of subjects and standard error of the runs with 'target_se'.'''
+    for run_label, run_output in simulation_data.run_outputs.items():
+        precision = run_output.precision
+        if precision is None:
+            continue
+        note = "" if precision['converged'] else ", max_subjects reached"
+        print("Run '{0}': {1} subjects, standard error {2:.4g} (target {3:.4g}{4})".format(
+            run_label, precision['n_subjects'], precision['se'], precision['target_se'], note))
+
+
+def post_file(file, options):
+    if "--load" not in options:
+        raise Exception("No results file given to lesim post. Use --load file.")
+    with open(file, "r") as file_obj:
+        script = file_obj.read()
+    script_obj = LsScript.LsScript(script)
+    simulation_data = LsStore.load(options["--load"])
+    script_obj.postproc(simulation_data, True, options.get("--figures"),
+                        options.get("--format", "png"))
+
+
+def shard_file(file, options):
+    with open(file, "r") as file_obj:
+        script = file_obj.read()
+    spool_dir = options.get("--spool", os.path.splitext(file)[0] + ".spool")
+    n_units = LsShard.create_spool(script, spool_dir, int(options.get("--shards", 1)),
+                                   options.get("--seed"))
+    print("Wrote {0} work units to {1}".format(n_units, spool_dir))
+
+
+def merge_spool(spool_dir, options):
+    _, script = LsShard.read_spool(spool_dir)
+    simulation_data = LsShard.merge(spool_dir)
+    if "--save" in options:
+        LsStore.save(simulation_data, options["--save"])
+    else:
+        script_obj = LsScript.LsScript(script)
+        script_obj.postproc(simulation_data, True, options.get("--figures"),
+                            options.get("--format", "png"))
+
+
+def submit_files(files, options):
+    '''Runs the script files on a server. Returns False if any of them failed.'''
+    address = options.get("--address", LsServer.DEFAULT_ADDRESS)
+    if "--save" in options and len(files) > 1:
+        raise Exception("Option --save can only be used with one script file.")
+    all_ok = True
+    for file in files:
+        request = {'op': LsServer.OP_RUN, 'cwd': os.getcwd(),
+                   'save': options.get("--save"), 'figures': options.get("--figures"),
+                   'format': options.get("--format", "png")}
+        if file == "-":
+            request['script'] = sys.stdin.read()
+        else:
+            request['file'] = os.path.abspath(file)
+        response = LsServer.submit(request, address)
+        if response['ok']:
+            for filename in response['exports'] + response['figures']:
+                print(filename)
+            if response['save'] is not None:
+                print(response['save'])
+        else:
+            print("{0}: {1}".format(file, response['error']), file=sys.stderr)
+            all_ok = False
+    if "--shutdown" in options:
+        LsServer.submit({'op': LsServer.OP_SHUTDOWN}, address)
+    return all_ok
 
 
 if __name__ == "__main__":
@@ -33,25 +293,75 @@ if __name__ == "__main__":
     if not getattr(sys, 'frozen', False):
         assert(args[0].endswith("lesim.py"))
     guiObj = None
-    if nargs == 1:
+    if nargs == 1 or args[1] == GUI:
+        import LsGui  # Imports tkinter and matplotlib
         guiObj = LsGui.Gui()
     else:
         arg1 = args[1]
-        if arg1 == GUI:
-            guiObj = LsGui.Gui()
-        elif arg1 == RUN:
-            files = args[2:len(args)]
+        if arg1 == RUN:
+            options, files = parse_options(args[2:], {"--profile", "--share-prefix"},
+                                           {"--cprofile", "--stacks", "--interval", "--figures",
+                                            "--format", "--save", "--jobs", "--seed",
+                                            "--memory-budget", "--scratch"})
             if len(files) == 0:
                 print(
                     "No script file given to lesim run. Type 'lesim.py help' for the available options.".format(arg1))
-            nfiles = len(files)
-            for i, file in enumerate(files):
-                file_obj = open(file, "r")
-                script = file_obj.read()
-                script_obj = LsScript.LsScript(script)
-                simulation_data = script_obj.run()
-                block = (i == nfiles - 1)
-                script_obj.postproc(simulation_data, block)
+            run_files(files, options)
+        elif arg1 == POST:
+            options, files = parse_options(args[2:], set(), {"--load", "--figures", "--format"})
+            if len(files) != 1:
+                print("lesim post takes one script file. Type 'lesim.py help' for the available options.")
+            else:
+                post_file(files[0], options)
+        elif arg1 == SERVE:
+            options, _ = parse_options(args[2:], set(), {"--address", "--jobs"})
+            jobs = int(options["--jobs"]) if "--jobs" in options else None
+            server = LsServer.Server(options.get("--address", LsServer.DEFAULT_ADDRESS), jobs)
+            print("Serving on {}".format(server.address))
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+        elif arg1 == SUBMIT:
+            options, files = parse_options(args[2:], {"--shutdown"},
+                                           {"--address", "--save", "--figures", "--format"})
+            if not submit_files(files, options):
+                sys.exit(1)
+        elif arg1 == SHARD:
+            options, files = parse_options(args[2:], set(), {"--shards", "--seed", "--spool"})
+            if len(files) != 1:
+                print("lesim shard takes one script file. Type 'lesim.py help' for the available options.")
+            else:
+                shard_file(files[0], options)
+        elif arg1 == WORKER:
+            options, spools = parse_options(args[2:], set(), {"--max-units"})
+            if len(spools) != 1:
+                print("lesim worker takes one spool directory. Type 'lesim.py help' for the available options.")
+            else:
+                max_units = int(options["--max-units"]) if "--max-units" in options else None
+                n_done, n_failed = LsShard.work(spools[0], max_units, print)
+                print("{0} units done, {1} failed".format(n_done, n_failed))
+                if n_failed > 0:
+                    sys.exit(1)
+        elif arg1 == MERGE:
+            options, spools = parse_options(args[2:], set(), {"--save", "--figures", "--format"})
+            if len(spools) != 1:
+                print("lesim merge takes one spool directory. Type 'lesim.py help' for the available options.")
+            else:
+                merge_spool(spools[0], options)
+        elif arg1 == BENCH:
+            options, workloads = parse_options(args[2:], {"--no-memory"},
+                                               {"--scale", "--repeat", "--output"})
+            results = LsBench.run_bench(workloads,
+                                        scale=float(options.get("--scale", 1)),
+                                        repeat=int(options.get("--repeat", 1)),
+                                        measure_memory=("--no-memory" not in options))
+            results_json = LsBench.bench_json(results)
+            if "--output" in options:
+                with open(options["--output"], "w") as f:
+                    f.write(results_json + "\n")
+            else:
+                print(results_json)
         elif arg1 == HELP:
             man_page = get_man_page()
             print(man_page)
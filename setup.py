@@ -14,7 +14,6 @@ build_exe_options = {"includes": ["matplotlib.backends.backend_tkagg", "ccplot.a
                                   "ccplot.hdf"],
                      "packages": ["tkinter", "tkinter.filedialog"],
                      "include_files": [(matplotlib.get_data_path(), "mpl-data")],
-                     "excludes": ["collections.abc"],
                      }
 
 cx_Freeze.setup(
@@ -0,0 +1,109 @@
+import math
+import os
+import statistics
+import tempfile
+import unittest
+
+import LsScript
+import LsStore
+from LsExceptions import LsParseException
+from tests.test_parallel import output_data
+
+
+script = '''
+@parameters
+{{
+'subjects'          : 4,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1','R2'],
+'stimulus_elements' : ['S1','S2','reward','new trial'],
+'u'                 : {{'reward':10, 'default': 0}},
+'omit_learning'     : ['new trial']
+}}
+
+@phase {{'label':'train', 'end':'new trial=30'}}
+NEW_TRIAL  'new trial' | STIMULUS(0.5),STIMULUS_2(0.5)
+STIMULUS   ('S1','S2') | R1: REWARD | NEW_TRIAL
+STIMULUS_2 'S2'        | R2: REWARD | NEW_TRIAL
+REWARD     'reward'    | NEW_TRIAL
+
+@run {{'label':'r', {target}}}
+@run {{'label':'fixed'}}
+
+@nplot 'R1' {{'runlabel':'r', 'cumulative':'on'}}
+@vplot ('S1','R1') {{'runlabel':'r', 'subject':'all'}}
+@vplot ('S1','R1') {{'runlabel':'fixed'}}
+'''
+
+TARGET = "'target_se':0.7, 'max_subjects':60, 'se_at':[20, 50]"
+
+
+def standard_error(simulation_data, point):
+    '''The standard error at point of the average of the cumulative n of R1 in run r.'''
+    evalprops = {'runlabel': 'r', 'subject': 'all', 'cumulative': 'on'}
+    curves = simulation_data.vwpn_eval('n', ('R1', None), evalprops)
+    values = [curve[point] for curve in curves if len(curve) > point]
+    return statistics.stdev(values) / math.sqrt(len(values))
+
+
+class TestAdaptive(unittest.TestCase):
+
+    def test_target(self):
+        simulation_data = LsScript.LsScript(script.format(target=TARGET)).run(seed=1)
+        precision = simulation_data.run_outputs['r'].precision
+        n_subjects = len(simulation_data.run_outputs['r'].output_subjects)
+        self.assertTrue(precision['converged'])
+        self.assertEqual(precision['n_subjects'], n_subjects)
+        self.assertTrue(4 < n_subjects < 60)
+        self.assertEqual(n_subjects % 4, 0)
+        self.assertLessEqual(precision['se'], 0.7)
+        self.assertAlmostEqual(precision['se'], max(standard_error(simulation_data, 20),
+                                                    standard_error(simulation_data, 50)))
+
+        # One batch less would not have been enough
+        first_subjects = LsScript.LsScript(script.format(
+            target=TARGET.replace('60', str(n_subjects - 4)))).run(seed=1)
+        self.assertGreater(first_subjects.run_outputs['r'].precision['se'], 0.7)
+
+        self.assertIsNone(simulation_data.run_outputs['fixed'].precision)
+        self.assertEqual(len(simulation_data.run_outputs['fixed'].output_subjects), 4)
+
+    def test_max_subjects(self):
+        target = "'target_se':0.01, 'max_subjects':10"
+        simulation_data = LsScript.LsScript(script.format(target=target)).run(seed=1)
+        precision = simulation_data.run_outputs['r'].precision
+        self.assertFalse(precision['converged'])
+        self.assertEqual(precision['n_subjects'], 10)
+        self.assertEqual(len(simulation_data.run_outputs['r'].output_subjects), 10)
+        self.assertGreater(precision['se'], 0.01)
+
+    def test_parallel(self):
+        script_obj = LsScript.LsScript(script.format(target=TARGET))
+        serial = script_obj.run(seed=3)
+        parallel = script_obj.run(jobs=3, seed=3)
+        self.assertEqual(parallel.run_outputs['r'].precision, serial.run_outputs['r'].precision)
+        self.assertEqual(output_data(parallel), output_data(serial))
+
+    def test_store(self):
+        simulation_data = LsScript.LsScript(script.format(target=TARGET)).run(seed=2)
+        fd, filename = tempfile.mkstemp(suffix='.lsr')
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+        LsStore.save(simulation_data, filename)
+        loaded = LsStore.load(filename)
+        self.assertEqual(loaded.run_outputs['r'].precision,
+                         simulation_data.run_outputs['r'].precision)
+        self.assertIsNone(loaded.run_outputs['fixed'].precision)
+
+    def test_parse_errors(self):
+        for target in ["'target_se':0", "'target_se':'small'", "'max_subjects':10",
+                       "'target_se':0.1, 'max_subjects':1", "'target_se':0.1, 'se_at':[-1]",
+                       "'se_at':[2]"]:
+            with self.assertRaises(LsParseException):
+                LsScript.LsScript(script.format(target=target))
+
+        # No command averages over the subjects of run r
+        no_average = script.format(target=TARGET).replace("'runlabel':'r', 'cumulative'",
+                                                          "'runlabel':'fixed', 'cumulative'")
+        with self.assertRaises(LsParseException):
+            LsScript.LsScript(no_average)
@@ -0,0 +1,28 @@
+import json
+import unittest
+
+import LsBench
+
+
+class TestBench(unittest.TestCase):
+
+    def test_workload_scripts(self):
+        for name in LsBench.ALL_WORKLOADS:
+            result = LsBench.run_workload(name, scale=0.005, measure_memory=False)
+            self.assertEqual(result['name'], name)
+            self.assertGreater(result['steps'], 0)
+            self.assertGreater(result['steps_per_second'], 0)
+            self.assertNotIn('peak_memory', result)
+
+    def test_run_bench(self):
+        results = LsBench.run_bench([LsBench.GA, LsBench.POSTPROCESSING], scale=0.005)
+        results = json.loads(LsBench.bench_json(results))
+        self.assertEqual(len(results['workloads']), 2)
+        postprocessing = results['workloads'][1]
+        self.assertEqual(postprocessing['name'], LsBench.POSTPROCESSING)
+        self.assertGreater(postprocessing['n_postcmds'], 0)
+        self.assertGreater(postprocessing['peak_memory'], 0)
+        self.assertGreaterEqual(postprocessing['postprocessing_time'], 0)
+
+        with self.assertRaises(Exception):
+            LsBench.run_bench(['foo'])
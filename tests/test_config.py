@@ -0,0 +1,97 @@
+import copy
+import time
+import unittest
+
+import LsMechanism
+import LsScript
+from LsExceptions import LsParseException
+
+script = '''
+@parameters
+{
+'subjects'          : 2,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1'],
+'stimulus_elements' : ['S1','reward'],
+'start_v'           : {'default':0, ('S1','R1'):2},
+'u'                 : {'reward':10, 'default': 0}
+}
+
+@phase {'label':'train', 'end':'reward=10'}
+STIMULUS   'S1'     | R1: REWARD | STIMULUS
+REWARD     'reward' | STIMULUS
+
+@run {'label':'r1'}
+@run {'label':'r2'}
+
+@parameters
+{
+'mechanism'         : 'SR',
+'subjects'          : 3
+}
+@run {'label':'r3'}
+
+@parameters
+{
+'beta'              : 2
+}
+@run {'label':'r4'}
+'''
+
+
+class TestMechanismConfig(unittest.TestCase):
+
+    def test_shared(self):
+        runs = LsScript.LsScript(script).runs.runs
+        mechanisms = [runs[label].mechanism_obj for label in ['r1', 'r2', 'r3', 'r4']]
+
+        # Only the number of subjects and the mechanism differ in r1, r2 and r3
+        self.assertIs(mechanisms[0].config, mechanisms[1].config)
+        self.assertIs(mechanisms[0].config, mechanisms[2].config)
+        self.assertIsNot(mechanisms[0].config, mechanisms[3].config)
+        self.assertIsInstance(mechanisms[2], LsMechanism.RescorlaWagner)
+        self.assertEqual(mechanisms[3].beta, 2)
+
+        # Each mechanism has its own state
+        mechanisms[0].v[('S1', 'R1')] += 1
+        mechanisms[0].w['S1'] = 3
+        self.assertEqual(mechanisms[1].v[('S1', 'R1')], 2)
+        self.assertEqual(mechanisms[1].w['S1'], 0)
+
+        clone = copy.deepcopy(mechanisms[0])
+        self.assertIs(clone.config, mechanisms[0].config)
+        self.assertEqual(clone.v, mechanisms[0].v)
+        clone.v[('S1', 'R0')] = 5
+        self.assertEqual(mechanisms[0].v[('S1', 'R0')], 0)
+
+    def test_frozen(self):
+        config = LsMechanism.MechanismConfig({'behaviors': ['R0'], 'stimulus_elements': ['S1']})
+        with self.assertRaises(AttributeError):
+            config.beta = 2
+        mechanism = LsMechanism.Qlearning.from_config(config)
+        self.assertEqual(mechanism.stimulus_req, {'S1': ['R0']})
+        self.assertEqual(mechanism.u, {'S1': 0})
+
+    def test_validation(self):
+        parameters = {'behaviors': ['R0', 'R1'], 'stimulus_elements': ['S1', 'S2']}
+        for invalid in [{'start_v': {'default': 0, ('S3', 'R0'): 1}},
+                        {'alpha_v': {'default': 1, ('S1', 'R2'): 1}},
+                        {'u': {'S3': 1}},
+                        {'behavior_cost': {'R2': 1}},
+                        {'response_requirements': {'R0': ['S1', 'S3']}},
+                        {'response_requirements': {'R0': 'S1', 'R1': 'S1'}}]:
+            with self.assertRaises(LsParseException):
+                LsMechanism.MechanismConfig(dict(parameters, **invalid))
+
+    def test_large(self):
+        elements = ["E{}".format(i) for i in range(5000)]
+        behaviors = ["B{}".format(i) for i in range(500)]
+        t0 = time.perf_counter()
+        mechanism = LsMechanism.Enquist(
+            behaviors=behaviors, stimulus_elements=elements,
+            response_requirements={b: elements[(10 * i):(10 * i + 10)]
+                                   for i, b in enumerate(behaviors)},
+            start_v={'default': 0, **{(e, behaviors[i % 500]): 1
+                                      for i, e in enumerate(elements)}})
+        self.assertLess(time.perf_counter() - t0, 1)
+        self.assertEqual(mechanism.stimulus_req['E15'], ['B1'])
@@ -0,0 +1,106 @@
+import os
+import tempfile
+import unittest
+
+import LsScript
+import LsStore
+from LsExceptions import LsEvalException, LsParseException
+
+script = '''
+@parameters
+{{
+'subjects'          : 3,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1','R2'],
+'stimulus_elements' : ['S1','S2','reward','new trial'],
+'u'                 : {{'reward':10, 'default': 0}},
+'omit_learning'     : ['new trial']
+}}
+
+@phase {{'label':'train', 'end':'reward=15'}}
+NEW_TRIAL  'new trial' | STIMULUS(0.5),STIMULUS_2(0.5)
+STIMULUS   ('S1','S2') | R1: REWARD | NEW_TRIAL
+STIMULUS_2 'S2'        | R2: REWARD | NEW_TRIAL
+REWARD     'reward'    | NEW_TRIAL
+
+@phase {{'label':'short', 'end':'S1=1'}}
+STIMULUS   'S1'        | STIMULUS
+
+@phase {{'label':'test', 'end':'new trial=10'}}
+NEW_TRIAL  'new trial' | STIMULUS
+STIMULUS   ('S1','S2') | NEW_TRIAL
+
+@run {{'label':'r', 'history':'{history}'}}
+
+{postcmds}
+'''
+
+PHASES = [None, 'train', 'test', ('test', 'train'), ('train', 'short', 'test'),
+          ('short', 'train'), ('test', 'short')]
+
+# (seq, seqref) and evaluation properties of the n commands
+N_EVALS = [((['S1', 'R1'], None), {}),
+           (('S1', None), {'cumulative': 'on'}),
+           ((('S1', 'S2'), None), {'exact_n': 'on'}),
+           (([('S1', 'S2'), 'R1', 'reward'], None), {}),
+           ((['R1', 'new trial', 'S1'], None), {'steps': ['R1', 'new trial']}),
+           ((['S1', 'R1'], 'S1'), {'cumulative': 'on', 'steps': 'new trial'}),
+           ((['new trial', ('S1', 'S2')], None), {'steps': ('S1', 'S2'), 'exact_steps': 'on'})]
+
+
+def postcmds():
+    cmds = list()
+    for (seq, seqref), evalprops in N_EVALS:
+        seqs = repr(seq) if seqref is None else "{0} {1}".format(repr(seq), repr(seqref))
+        cmds.append("@nplot {0} {1}".format(seqs, repr(evalprops)))
+    cmds.append("@vplot ('S1','R1') {'steps':['R1', 'new trial']}")
+    return "\n".join(cmds)
+
+
+class TestPatternCounter(unittest.TestCase):
+
+    def setUp(self):
+        self.kept = LsScript.LsScript(script.format(history='on', postcmds=postcmds()))
+        self.counted = LsScript.LsScript(script.format(history='off', postcmds=postcmds()))
+        self.kept_data = self.kept.run(seed=4)
+        self.counted_data = self.counted.run(seed=4)
+
+    def assert_same_n(self, simulation_data):
+        for arg, evalprops in N_EVALS:
+            for phase in PHASES:
+                for subject in ['average', 'all', 1]:
+                    props = dict(evalprops, subject=subject)
+                    if phase is not None:
+                        props['phase'] = phase
+                    self.assertEqual(simulation_data.vwpn_eval('n', arg, dict(props)),
+                                     self.kept_data.vwpn_eval('n', arg, dict(props)),
+                                     (arg, props))
+        props = {'steps': ['R1', 'new trial'], 'phase': ('test', 'train')}
+        self.assertEqual(simulation_data.vwpn_eval('v', ('S1', 'R1'), dict(props)),
+                         self.kept_data.vwpn_eval('v', ('S1', 'R1'), dict(props)))
+
+    def test_same_as_history(self):
+        for output_subject in self.counted_data.run_outputs['r'].output_subjects:
+            self.assertIsNone(output_subject.history)
+        self.assert_same_n(self.counted_data)
+
+    def test_not_counted(self):
+        with self.assertRaises(LsEvalException):
+            self.counted_data.vwpn_eval('n', (['S2', 'R2'], None), {})
+        with self.assertRaises(LsEvalException):
+            self.counted_data.vwpn_eval('n', (['S1', 'R1'], None), {'exact_n': 'on'})
+
+    def test_store_and_parallel(self):
+        fd, filename = tempfile.mkstemp(suffix='.lsr')
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+        LsStore.save(self.counted_data, filename)
+        self.assert_same_n(LsStore.load(filename))
+        self.assert_same_n(self.counted.run(jobs=2, seed=4))
+
+    def test_hexport(self):
+        with self.assertRaises(LsParseException):
+            LsScript.LsScript(script.format(history='off',
+                                            postcmds="@hexport {'filename':'h.csv'}"))
+        with self.assertRaises(LsParseException):
+            LsScript.LsScript(script.format(history='none', postcmds=""))
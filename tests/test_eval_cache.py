@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import LsScript
+import LsUtil
+from LsOutput import EvalCache, Val
+
+script = '''
+@parameters
+{
+'subjects'          : 3,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1','R2'],
+'stimulus_elements' : ['S1','S2','reward','new trial'],
+'u'                 : {'reward':10, 'default': 0},
+'omit_learning'     : ['new trial']
+}
+
+@phase {'label':'train', 'end':'reward=30'}
+NEW_TRIAL  'new trial' | STIMULUS(0.5),STIMULUS_2(0.5)
+STIMULUS   ('S1','S2') | R1: REWARD | NEW_TRIAL
+STIMULUS_2 'S2'        | R2: REWARD | NEW_TRIAL
+REWARD     'reward'    | NEW_TRIAL
+
+@phase {'label':'test', 'end':'new trial=20'}
+NEW_TRIAL  'new trial' | STIMULUS
+STIMULUS   'S1'        | NEW_TRIAL
+
+@run {'label':'r'}
+'''
+
+EVALS = [('n', ['S1', 'R1'], {'steps': 'new trial'}),
+         ('n', ['S1', 'R2'], {'steps': 'new trial'}),
+         ('n', (['S1', 'R1'], 'S1'), {'steps': 'new trial', 'cumulative': 'on'}),
+         ('n', ['S1', 'R1'], {'steps': 'new trial', 'phase': 'train', 'subject': 'all'}),
+         ('n', 'reward', {'phase': 'train', 'subject': 1}),
+         ('p', (('S1',), 'R1'), {'beta': 1}),
+         ('p', (('S1',), 'R2'), {'beta': 1, 'phase': 'test'}),
+         ('p', (('S1',), 'R1'), {'beta': 1, 'steps': 'new trial'}),
+         ('v', ('S1', 'R1'), {}),
+         ('v', ('S1', 'R1'), {'filename': 'v.csv'}),
+         ('v', ('S2', 'R2'), {'phase': ('test', 'train'), 'subject': 'all'}),
+         ('w', 'S1', {'phase': 'train'})]
+
+
+class TestEvalCache(unittest.TestCase):
+
+    def setUp(self):
+        self.simulation_data = LsScript.LsScript(script).run()
+
+    def evaluate(self, plan):
+        cache = None
+        if plan:
+            cache = EvalCache()
+            for vwpn, arg, evalprops in EVALS:
+                cache.plan(self.simulation_data, vwpn, arg, evalprops)
+        self.simulation_data.eval_cache = cache
+        try:
+            return [self.simulation_data.vwpn_eval(vwpn, arg, dict(evalprops))
+                    for vwpn, arg, evalprops in EVALS], cache
+        finally:
+            self.simulation_data.eval_cache = None
+
+    def test_same_as_unplanned(self):
+        planned, cache = self.evaluate(True)
+        unplanned, _ = self.evaluate(False)
+        self.assertEqual(planned, unplanned)
+
+        # Nothing is kept after the last use
+        self.assertEqual(cache.values, {})
+
+    def test_shared_evaluations(self):
+        with mock.patch.object(LsUtil, 'find_and_cumsum', wraps=LsUtil.find_and_cumsum) as fc, \
+                mock.patch.object(Val, 'evaluate', autospec=True,
+                                  side_effect=Val.evaluate) as evaluate:
+            self.evaluate(False)
+            unplanned_matches = fc.call_count
+            unplanned_v = evaluate.call_count
+            fc.reset_mock()
+            evaluate.reset_mock()
+            self.evaluate(True)
+
+            # Per subject: 'new trial', ['S1','R1'], ['S1','R2'] and 'S1' in all phases,
+            # 'new trial', ['S1','R1'] and 'reward' in train
+            self.assertEqual(fc.call_count, 3 * 4 + 3 * 2 + 1)
+            self.assertLess(fc.call_count, unplanned_matches)
+
+            # v of S1 with each response (for p and v), v of (S2, R2) and w of S1 are
+            # expanded once per subject
+            self.assertEqual(evaluate.call_count, 3 * 5)
+            self.assertLess(evaluate.call_count, unplanned_v)
+
+    def test_postcmds(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        script_obj = LsScript.LsScript(script + '''
+        @nexport ['S1','R1'] {{'steps':'new trial', 'filename':'{0}/n1'}}
+        @nexport ['S1','R2'] {{'steps':'new trial', 'filename':'{0}/n2'}}
+        @vexport ('S1','R1') {{'filename':'{0}/v1'}}
+        @vexport ('S1','R1') {{'filename':'{0}/v2'}}
+        '''.format(tmpdir.name))
+        plan = script_obj.postcmds.plan(self.simulation_data)
+        self.assertEqual(plan.uses[EvalCache.eval_key('v', ('S1', 'R1'),
+                                                      {'runlabel': 'r', 'subject': 'average',
+                                                       'cumulative': 'off',
+                                                       'exact_steps': 'off', 'exact_n': 'off',
+                                                       'steps': 'all'})], 2)
+        script_obj.postcmds.run(self.simulation_data)
+        self.assertIsNone(self.simulation_data.eval_cache)
+        with open(os.path.join(tmpdir.name, "v1.csv")) as f1, \
+                open(os.path.join(tmpdir.name, "v2.csv")) as f2:
+            self.assertEqual(f1.read(), f2.read())
@@ -0,0 +1,161 @@
+import csv
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import LsScript
+from LsExceptions import LsParseException
+from LsOutput import RunOutputSubject, Series
+
+script = '''
+@parameters
+{{
+'subjects'          : 3,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1'],
+'stimulus_elements' : ['S1','S2','reward'],
+'u'                 : {{'reward':10, 'default': 0}},
+'beta'              : 1
+}}
+
+@phase {{'label':'a', 'end':'S1=10'}}
+STIMULUS   'S1'     | R1: REWARD | STIMULUS
+REWARD     'reward' | STIMULUS
+
+@phase {{'label':'b', 'end':'S2=5'}}
+STIMULUS_2 'S2'     | R0: REWARD | STIMULUS_2
+REWARD     'reward' | STIMULUS_2
+
+@run {{'label':'r1'}}
+@run {{'label':'r2', 'phases':'b'}}
+
+{postcmds}
+'''
+
+# The series of the @export, as (v, w, p or n, arguments, properties)
+SERIES = [('v', "('S1','R1')", {}),
+          ('w', "'S1'", {'phase': 'a'}),
+          ('p', "('S1','R1')", {'beta': 2}),
+          ('p', "('S2','R0')", {}),
+          ('n', "['S1','R1'] 'S1'", {'cumulative': 'off'}),
+          ('v', "('S2','R0')", {'subject': 'all'})]
+
+
+def read_columns(filename):
+    '''The dict with the header of each column of the file as key and its values (as
+       strings) as value.'''
+    with open(filename, newline='') as csvfile:
+        rows = list(csv.reader(csvfile))
+    return {label: [row[i] for row in rows[1:]] for i, label in enumerate(rows[0])}
+
+
+class TestGroupedExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, filename):
+        return os.path.join(self.tmp.name, filename).replace('\\\\', '/')
+
+    def test_same_as_single_exports(self):
+        postcmds = "@export {!r}\n".format({'runlabel': 'r1', 'filename': self.path('all.csv')})
+        for vwpn, arg, props in SERIES:
+            postcmds += "{0} {1} {2!r}\n".format(vwpn, arg, props)
+        for i, (vwpn, arg, props) in enumerate(SERIES):
+            props = dict(props, runlabel='r1', filename=self.path(str(i)))
+            postcmds += "@{0}export {1} {2!r}\n".format(vwpn, arg, props)
+        script_obj = LsScript.LsScript(script.format(postcmds=postcmds))
+        script_obj.postproc(script_obj.run(seed=1))
+
+        grouped = read_columns(self.path('all.csv'))
+        n_columns = 1
+        for i in range(len(SERIES)):
+            single = read_columns(self.path(str(i) + '.csv'))
+            for label, values in single.items():
+                if label == 'x':
+                    continue
+                n_columns += 1
+                self.assertEqual(grouped[label][:len(values)], values)
+                self.assertTrue(all(value == ' ' for value in grouped[label][len(values):]))
+        self.assertEqual(len(grouped), n_columns)
+        self.assertEqual(grouped['x'], [str(x) for x in range(len(grouped['x']))])
+
+    def test_props(self):
+        postcmds = ("@export {'runlabel':'r2', 'filename':'f', 'beta':3, 'cumulative':'off'}\n"
+                    "p ('S2','R0')\n"
+                    "p ('S2','R0') {'beta':1}\n"
+                    "n 'R0'\n"
+                    "n 'R0' {'runlabel':'r1', 'cumulative':'on'}\n"
+                    "w 'S2'\n")
+        cmd = LsScript.LsScript(script.format(postcmds=postcmds)).postcmds.cmds[0]
+        self.assertEqual([item.eval_prop for item in cmd.items],
+                         [{'runlabel': 'r2', 'beta': 3},
+                          {'runlabel': 'r2', 'beta': 1},
+                          {'runlabel': 'r2', 'cumulative': 'off'},
+                          {'runlabel': 'r1', 'cumulative': 'on'},
+                          {'runlabel': 'r2'}])
+
+    def test_evaluated_once(self):
+        # A series that is in the @export and in a plot command is evaluated once
+        postcmds = ("@export {'runlabel':'r1', 'filename':'" + self.path('f') + "'}\n"
+                    "v ('S1','R1') {'subject':'all'}\n"
+                    "v ('S1','R1') {'subject':'all'}\n"
+                    "@vplot ('S1','R1') {'runlabel':'r1', 'subject':'all'}\n")
+        script_obj = LsScript.LsScript(script.format(postcmds=postcmds))
+        simulation_data = script_obj.run(seed=1)
+        with mock.patch.object(RunOutputSubject, 'vwpn_eval',
+                               autospec=True,
+                               side_effect=RunOutputSubject.vwpn_eval) as vwpn_eval:
+            script_obj.postproc(simulation_data, figure_dir=self.tmp.name)
+        self.assertEqual(vwpn_eval.call_count, 3)
+        with open(self.path('f.csv'), newline='') as csvfile:
+            header = next(csv.reader(csvfile))
+        self.assertEqual(header, ['x'] + ["v('S1', 'R1') subject {}".format(i)
+                                          for i in [0, 1, 2]] * 2)
+
+    def test_same_x(self):
+        # A Series and a list with the same x values share the x column without merging them
+        class Item():
+            def __init__(self, ydata, label):
+                self.ydata = ydata
+                self.label = label
+                self.eval_prop = dict()
+
+            def evaluate(self, simulation_data):
+                return self.ydata, self.label
+
+        filename = self.path('x.csv')
+        cmd = LsScript.GroupedExportCmd({'filename': filename},
+                                        [Item(Series([1.5, 2.5, 3.5], [0, 1, 2]), 'a'),
+                                         Item([4, 5, 6], 'b')])
+        with mock.patch('LsScript.sorted', create=True, side_effect=AssertionError):
+            cmd.run(None)
+        self.assertEqual(read_columns(filename), {'x': ['0', '1', '2'],
+                                                  'a': ['1.5', '2.5', '3.5'],
+                                                  'b': ['4', '5', '6']})
+
+        cmd.items[1].ydata = [4, 5]
+        cmd.run(None)
+        self.assertEqual(read_columns(filename)['b'], ['4', '5', ' '])
+
+    def test_invalid(self):
+        for postcmds in ["@export {'filename':'f'}\n",
+                         "@export {'filename':'f'}\nh\n",
+                         "@export {'filename':'f'}\nv 'S1'\n",
+                         "@export {'filename':'f'}\nw 'S1' {'filename':'g'}\n",
+                         "@export {'filename':'f', 'label':'x'}\nw 'S1'\n",
+                         "@export 'f'\nw 'S1'\n"]:
+            with self.assertRaises(LsParseException):
+                LsScript.LsScript(script.format(postcmds=postcmds))
+
+        script_obj = LsScript.LsScript(script.format(postcmds="@export {'runlabel':'r1'}\nw 'S1'\n"))
+        with self.assertRaisesRegex(LsParseException, "filename"):
+            script_obj.postproc(script_obj.run())
+
+
+if __name__ == '__main__':
+    unittest.main()
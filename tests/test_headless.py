@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+
+import matplotlib.pyplot as plt
+
+import LsScript
+
+
+script = '''
+@parameters
+{
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1'],
+'stimulus_elements' : ['S1','reward','new trial'],
+'beta'              : 1,
+'u'                 : {'reward':10, 'default': 0},
+'omit_learning'     : ['new trial']
+}
+
+@phase {'label':'train', 'end':'reward=1500'}
+NEW_TRIAL 'new trial' | STIMULUS
+STIMULUS  'S1'        | R1: REWARD | NEW_TRIAL
+REWARD    'reward'    | NEW_TRIAL
+
+@run {'label':'r'}
+
+@figure 'Values: v/w'
+@vplot ('S1','R1')
+@wplot 'S1'
+
+@figure 'Values: v/w'
+@pplot ('S1','R1')
+
+@figure
+@nplot 'R1' {'cumulative':'on'}
+'''
+
+
+class TestHeadless(unittest.TestCase):
+
+    def tearDown(self):
+        plt.close('all')
+
+    def test_save_figures(self):
+        script_obj = LsScript.LsScript(script)
+        simulation_data = script_obj.run()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            figure_dir = os.path.join(tmpdir, "figures")
+            script_obj.postproc(simulation_data, figure_dir=figure_dir, figure_format='svg')
+            filenames = sorted(os.listdir(figure_dir))
+            self.assertEqual(filenames, ['Values_ v_w.svg', 'Values_ v_w_2.svg', 'figure3.svg'])
+            self.assertEqual(plt.get_fignums(), [])
+
+            with self.assertRaises(Exception):
+                script_obj.postproc(simulation_data, figure_dir=figure_dir, figure_format='foo')
+
+    def test_decimation(self):
+        script_obj = LsScript.LsScript(script)
+        simulation_data = script_obj.run()
+        n_points = len(simulation_data.vwpn_eval('v', ('S1', 'R1'), {}))
+        plt.switch_backend('Agg')
+        script_obj.postcmds.run(simulation_data)
+
+        ax = plt.figure(1).axes[0]
+        max_points = LsScript.PLOT_POINTS_PER_PIXEL * int(ax.bbox.width) + 2
+        self.assertGreater(n_points, max_points)
+        for line in ax.get_lines():
+            x = list(line.get_xdata())
+            y = list(line.get_ydata())
+            self.assertLessEqual(len(y), max_points)
+            self.assertEqual(x[0], 0)
+            self.assertEqual(x[-1], n_points - 1)
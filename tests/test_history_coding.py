@@ -0,0 +1,103 @@
+import os
+import tempfile
+import unittest
+
+import LsScript
+import LsStore
+import LsUtil
+from LsExceptions import LsParseException
+from LsHistory import CodedHistory, RunLengthHistory
+
+from tests.test_counter import script, postcmds, N_EVALS, PHASES
+
+HISTORY = [('S1', 'R0'), ('S1', 'R0'), ('S1', 'R0'), ('reward', 'R1'), (('S1', 'S2'), 'R0'),
+           ('reward', 'R1'), ('reward', 'R1'), ('S1', 'R0')]
+
+
+def write(history, steps):
+    for stimulus, response in steps:
+        history.write(stimulus, response)
+    return history
+
+
+class TestHistoryCoding(unittest.TestCase):
+
+    def test_same_as_list(self):
+        kept = LsScript.LsScript(script.format(history='on', postcmds=postcmds()))
+        kept_data = kept.run(seed=4)
+        for coding, history_class in [('coded', CodedHistory), ('runlength', RunLengthHistory)]:
+            coded = LsScript.LsScript(script.format(history=coding, postcmds=postcmds()))
+            coded_data = coded.run(seed=4)
+            for kept_subject, coded_subject in zip(kept_data.run_outputs['r'].output_subjects,
+                                                   coded_data.run_outputs['r'].output_subjects):
+                self.assertIsInstance(coded_subject.history, history_class)
+                self.assertEqual(list(coded_subject.history), kept_subject.history)
+            for arg, evalprops in N_EVALS:
+                for phase in PHASES:
+                    props = dict(evalprops, subject='all')
+                    if phase is not None:
+                        props['phase'] = phase
+                    self.assertEqual(coded_data.vwpn_eval('n', arg, dict(props)),
+                                     kept_data.vwpn_eval('n', arg, dict(props)), (arg, props))
+
+            with tempfile.TemporaryDirectory() as tmp:
+                filename = os.path.join(tmp, 'out.lsr')
+                LsStore.save(coded_data, filename)
+                loaded = LsStore.load(filename)
+                self.assertEqual(list(loaded.run_outputs['r'].output_subjects[0].history),
+                                 kept_data.run_outputs['r'].output_subjects[0].history)
+
+                hexport = "@hexport {{'filename':'{}'}}"
+                for data, name in [(kept_data, 'kept'), (coded_data, coding)]:
+                    path = os.path.join(tmp, name + '.csv').replace('\\', '/')
+                    LsScript.LsScript(script.format(history='on', postcmds=hexport.format(
+                        path))).postproc(data)
+                with open(os.path.join(tmp, 'kept.csv')) as kept_file:
+                    with open(os.path.join(tmp, coding + '.csv')) as coded_file:
+                        self.assertEqual(coded_file.read(), kept_file.read())
+
+    def test_access(self):
+        items = [item for step in HISTORY for item in step]
+        for history in [write(CodedHistory(), HISTORY), write(RunLengthHistory(), HISTORY)]:
+            self.assertEqual(len(history), len(items))
+            self.assertEqual(list(history), items)
+            self.assertEqual([history[i] for i in range(-len(items), len(items))], items * 2)
+            for start, end in [(0, 16), (3, 10), (5, 6), (8, 8), (1, 15)]:
+                self.assertEqual(history[start:end], items[start:end])
+            self.assertEqual(history[1::3], items[1::3])
+            with self.assertRaises(IndexError):
+                history[len(items)]
+            for ranges in [[(0, 16)], [(2, 6)], [(8, 16), (0, 6)], [(4, 6), (6, 8)], [(3, 9)],
+                           [(1, 2), (5, 12)]]:
+                selected = history.select(ranges)
+                self.assertEqual(list(selected), [items[i] for start, end in ranges
+                                                  for i in range(start, end)])
+                for pattern in ['S1', 'R1', ['R0', 'S1'], ['S1', 'R0', 'S1'], [('S1', 'S2')]]:
+                    for use_exact_match in [False, True]:
+                        self.assertEqual(
+                            LsUtil.find_and_cumsum(selected, pattern, use_exact_match),
+                            LsUtil.find_and_cumsum(list(selected), pattern, use_exact_match))
+
+    def test_size(self):
+        run_length = write(RunLengthHistory(), HISTORY)
+        self.assertEqual(list(run_length.run_steps), [0, 1, 2, 1, 0])
+        self.assertEqual(list(run_length.run_ends), [6, 8, 10, 14, 16])
+
+        # One byte per item, and less for repeated steps
+        steps = [('S1', 'R0')] * 1000 + [('reward', 'R1')] * 1000
+        coded = write(CodedHistory(), steps)
+        self.assertEqual(coded.nbytes(), 4000)
+        self.assertLess(write(RunLengthHistory(), steps).nbytes(), 100)
+
+        # Wider codes for many symbols
+        steps = [('S{}'.format(i), 'R') for i in range(300)]
+        coded = write(CodedHistory(), steps)
+        self.assertEqual(coded.codes.typecode, 'H')
+        self.assertEqual(list(coded), [item for step in steps for item in step])
+        run_length = write(RunLengthHistory(), steps)
+        self.assertEqual(run_length.run_steps.typecode, 'H')
+        self.assertEqual(list(run_length), list(coded))
+
+    def test_invalid(self):
+        with self.assertRaisesRegex(LsParseException, "runlength"):
+            LsScript.LsScript(script.format(history='rle', postcmds=""))
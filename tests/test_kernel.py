@@ -0,0 +1,99 @@
+import pickle
+import random
+import unittest
+
+import LsMechanism
+from LsKernel import KernelWriter
+
+MECHANISMS = [LsMechanism.RescorlaWagner, LsMechanism.EXP_SARSA, LsMechanism.Qlearning,
+              LsMechanism.ActorCritic, LsMechanism.Enquist]
+
+PARAMETERS = {'behaviors': ['R0', 'R1', 'R2'],
+              'stimulus_elements': ['S1', 'S2', 'reward', 'off'],
+              'response_requirements': {'R2': ['S2', 'reward']},
+              'start_v': {'default': -0.5, ('S1', 'R1'): 1.25},
+              'u': {'reward': 7.5, 'default': 0.1},
+              'behavior_cost': {'R0': 0.3, 'default': 0},
+              'alpha_v': 0.13,
+              'alpha_w': 0.07,
+              'beta': 0.9,
+              'omit_learning': ['off']}
+
+STIMULI = [('S1',), ('S2',), ('reward',), ('S1', 'S2'), ('S2', 'reward'), ('off',)]
+
+
+def simulate(mechanism_class, parameters, use_kernels, n_steps=300):
+    mechanism = mechanism_class(**parameters)
+    mechanism.use_kernels = use_kernels
+    stimuli = random.Random(1)
+    random.seed(2)
+    responses = list()
+    for _ in range(n_steps):
+        responses.append(mechanism.learn_and_respond(stimuli.choice(STIMULI)))
+    return mechanism, responses
+
+
+class TestKernel(unittest.TestCase):
+
+    def assert_same(self, parameters):
+        for mechanism_class in MECHANISMS:
+            with self.subTest(mechanism=mechanism_class.__name__):
+                generic, responses = simulate(mechanism_class, parameters, False)
+                kernel, kernel_responses = simulate(mechanism_class, parameters, True)
+                self.assertTrue(kernel.use_kernels)
+                self.assertEqual(kernel_responses, responses)
+                self.assertEqual(dict(kernel.v), dict(generic.v))
+                self.assertEqual(kernel.w, generic.w)
+
+    def test_same_as_learn(self):
+        self.assert_same(PARAMETERS)
+
+    def test_alpha_dicts(self):
+        parameters = dict(PARAMETERS)
+        parameters['alpha_v'] = {'default': 0.11, ('S2', 'R0'): 0.31}
+        parameters['alpha_w'] = {'default': 0.05, 'reward': 0.2}
+        for mechanism_class in [LsMechanism.EXP_SARSA, LsMechanism.Qlearning,
+                                LsMechanism.Enquist]:
+            generic, responses = simulate(mechanism_class, parameters, False)
+            kernel, kernel_responses = simulate(mechanism_class, parameters, True)
+            self.assertEqual(kernel_responses, responses)
+            self.assertEqual(dict(kernel.v), dict(generic.v))
+            self.assertEqual(kernel.w, generic.w)
+
+    def test_cached(self):
+        mechanism, _ = simulate(LsMechanism.Enquist, PARAMETERS, True)
+        n_kernels = len(mechanism.kernels)
+        self.assertGreater(n_kernels, 0)
+        self.assertLessEqual(n_kernels, len(STIMULI) * len(STIMULI) * 3)
+
+        # Kept between subjects, shared by copies, and not pickled
+        mechanism.subject_reset()
+        self.assertEqual(len(mechanism.kernels), n_kernels)
+        self.assertIs(LsMechanism.copy.deepcopy(mechanism).kernels, mechanism.kernels)
+        self.assertEqual(pickle.loads(pickle.dumps(mechanism)).kernels, dict())
+        self.assertEqual(len(mechanism.kernels), n_kernels)
+
+    def test_fallback(self):
+        # RescorlaWagner.learn uses the scalar alpha_v only
+        parameters = dict(PARAMETERS)
+        parameters['alpha_v'] = {'default': 0.1}
+        mechanism = LsMechanism.RescorlaWagner(**parameters)
+        mechanism.learn_and_respond(('S1',))
+        with self.assertRaises(TypeError):
+            mechanism.learn_and_respond(('S2',))
+        self.assertFalse(mechanism.use_kernels)
+
+    def test_writer(self):
+        writer = KernelWriter()
+        self.assertEqual(writer.const(0.5), "(0.5)")
+        self.assertEqual(writer.const(('S1', 'R0')), "('S1', 'R0')")
+        name = writer.const(float('inf'))
+        self.assertEqual(writer.namespace[name], float('inf'))
+        writer.add("v['a'] += {}".format(name))
+        writer.add("w['a'] = " + writer.sum(["1", "2"]))
+        kernel = writer.compile()
+        v, w = {'a': 0}, {}
+        kernel(v, w)
+        self.assertEqual(v, {'a': float('inf')})
+        self.assertEqual(w, {'a': 3})
+        self.assertIn("def kernel(v, w", kernel.source)
@@ -0,0 +1,122 @@
+import os
+import tempfile
+import unittest
+
+import LsScript
+import LsStore
+from LsExceptions import LsParseException
+
+deterministic_script = '''
+@parameters
+{{
+'subjects'          : 2,
+'mechanism'         : '{mechanism}',
+'behaviors'         : ['R0'],
+'stimulus_elements' : ['S1','S2','reward'],
+'u'                 : {{'reward':2, 'default': 0}},
+'alpha_v'           : 0.2,
+'alpha_w'           : 0.3,
+'beta'              : 1
+}}
+
+@phase {{'label':'first', 'end':'S1=6'}}
+STIMULUS   'S1'        | 2: REWARD | STIMULUS
+REWARD     'reward'    | STIMULUS
+
+@phase {{'label':'second', 'end':'reward=4 or S2=12'}}
+STIMULUS_2 ('S1','S2') | R0=3: REWARD | STIMULUS_2
+REWARD     'reward'    | STIMULUS_2
+
+@run {{'label':'mc'}}
+@run {{'label':'mf', 'engine':'meanfield'}}
+'''
+
+random_script = '''
+@parameters
+{{
+'subjects'          : 1000,
+'mechanism'         : '{mechanism}',
+'behaviors'         : ['R0','R1'],
+'stimulus_elements' : ['S1','reward','new trial'],
+'u'                 : {{'reward':2, 'default': 0}},
+'alpha_v'           : 0.1,
+'alpha_w'           : 0.1,
+'omit_learning'     : ['new trial']
+}}
+
+@phase {{'label':'train', 'end':'new trial=30'}}
+NEW_TRIAL  'new trial' | STIMULUS(0.7),NEW_TRIAL(0.3)
+STIMULUS   'S1'        | R1: REWARD(0.8),NEW_TRIAL(0.2) | NEW_TRIAL
+REWARD     'reward'    | NEW_TRIAL
+
+@run {{'label':'mc'}}
+@run {{'label':'mf', 'engine':'meanfield'}}
+'''
+
+MECHANISMS = ['rescorla_wagner', 'q_learning', 'exp_sarsa', 'actor_critic', 'ga']
+
+
+def evaluate(simulation_data, run_label, vwpn, arg):
+    return simulation_data.vwpn_eval(vwpn, arg, {'runlabel': run_label, 'subject': 'average',
+                                                 'beta': 1})
+
+
+class TestMeanField(unittest.TestCase):
+
+    def test_deterministic(self):
+        # All subjects see the same stimuli and make the same responses, so the expected values
+        # are the values of each subject
+        for mechanism in MECHANISMS:
+            simulation_data = LsScript.LsScript(deterministic_script.format(
+                mechanism=mechanism)).run(seed=1)
+            self.assertEqual(len(simulation_data.run_outputs['mf'].output_subjects), 1)
+            for vwpn, arg in [('v', ('S1', 'R0')), ('v', ('S2', 'R0')), ('w', 'S1'),
+                              ('w', 'reward')]:
+                mc = evaluate(simulation_data, 'mc', vwpn, arg)
+                mf = evaluate(simulation_data, 'mf', vwpn, arg)
+                self.assertEqual(len(mf), len(mc))
+                for mc_value, mf_value in zip(mc, mf):
+                    self.assertAlmostEqual(mf_value, mc_value, places=12)
+
+    def test_monte_carlo(self):
+        # Close to the average of many simulated subjects, in the steps before the subjects
+        # start to finish (the average of the remaining subjects is biased towards those that
+        # were rewarded less)
+        for mechanism in ['rescorla_wagner', 'ga']:
+            simulation_data = LsScript.LsScript(random_script.format(
+                mechanism=mechanism)).run(seed=1)
+            for vwpn, arg, tolerance in [('v', ('S1', 'R1'), 0.03), ('w', 'S1', 0.03),
+                                         ('p', (('S1',), 'R1'), 0.01)]:
+                mc = evaluate(simulation_data, 'mc', vwpn, arg)
+                mf = evaluate(simulation_data, 'mf', vwpn, arg)
+                self.assertGreater(len(mf), len(mc))
+                for mc_value, mf_value in zip(mc[:45], mf[:45]):
+                    self.assertAlmostEqual(mf_value, mc_value, delta=tolerance)
+
+    def test_store(self):
+        script = deterministic_script.format(mechanism='ga')
+        simulation_data = LsScript.LsScript(script).run()
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'out.lsr')
+            LsStore.save(simulation_data, filename)
+            loaded = LsStore.load(filename)
+        self.assertEqual(evaluate(loaded, 'mf', 'v', ('S1', 'R0')),
+                         evaluate(simulation_data, 'mf', 'v', ('S1', 'R0')))
+
+    def test_invalid(self):
+        script = deterministic_script.format(mechanism='ga')
+        for postcmd in ["@nplot 'R0' {'runlabel':'mf'}",
+                        "@vplot ('S1','R0') {'subject':'all'}",
+                        "@vplot ('S1','R0') {'runlabel':'mf', 'steps':'reward'}",
+                        "@wplot 'S1' {'runlabel':'mf', 'phase':'first'}",
+                        "@hexport {'filename':'h.txt'}"]:
+            with self.assertRaisesRegex(LsParseException, "'engine':'meanfield'"):
+                LsScript.LsScript(script + postcmd + "\n")
+        LsScript.LsScript(script + "@nplot 'R0' {'runlabel':'mc'}\n" +
+                          "@pplot ('S1','R0') {'runlabel':'mf'}\n")
+
+        with self.assertRaises(LsParseException):
+            LsScript.LsScript(script.replace("'meanfield'", "'exact'"))
+        with self.assertRaisesRegex(LsParseException, "target_se"):
+            LsScript.LsScript(script.replace("'meanfield'", "'meanfield', 'target_se':0.1") +
+                              "@vplot ('S1','R0') {'runlabel':'mf'}\n")
@@ -0,0 +1,76 @@
+import unittest
+
+import LsScript
+from LsSimulation import subject_chunks
+
+
+script = '''
+@parameters
+{
+'subjects'          : 5,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1','R2'],
+'stimulus_elements' : ['S1','S2','reward','new trial'],
+'u'                 : {'reward':10, 'default': 0},
+'omit_learning'     : ['new trial']
+}
+
+@phase {'label':'train', 'end':'reward=30'}
+NEW_TRIAL  'new trial' | STIMULUS(0.5),STIMULUS_2(0.5)
+STIMULUS   'S1'        | R1: REWARD | NEW_TRIAL
+STIMULUS_2 'S2'        | R2: REWARD | NEW_TRIAL
+REWARD     'reward'    | NEW_TRIAL
+
+@run {'label':'ga'}
+
+@parameters
+{'mechanism': 'q_learning'}
+@run {'label':'q'}
+
+@parameters
+{'mechanism': 'rescorla_wagner', 'subjects': 2}
+@run {'label':'rw'}
+'''
+
+
+def output_data(simulation_data):
+    '''The simulated values and histories, as nested lists.'''
+    data = list()
+    for label, run_output in simulation_data.run_outputs.items():
+        subjects = list()
+        for subject in run_output.output_subjects:
+            subjects.append((list(subject.history),
+                             subject.first_step_phase,
+                             [(key, list(val.values), list(val.steps))
+                              for key, val in subject.v.items()],
+                             [(key, list(val.values), list(val.steps))
+                              for key, val in subject.w.items()]))
+        data.append((label, run_output.n_subjects, subjects))
+    return data
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_same_as_serial(self):
+        script_obj = LsScript.LsScript(script)
+        serial = output_data(script_obj.run(seed=7))
+        self.assertEqual([run[0] for run in serial], ['ga', 'q', 'rw'])
+        self.assertEqual([run[1] for run in serial], [5, 5, 2])
+
+        # The same seed gives the same result, regardless of the number of processes
+        self.assertEqual(output_data(script_obj.run(seed=7)), serial)
+        for jobs in [2, 3, 8]:
+            self.assertEqual(output_data(script_obj.run(jobs=jobs, seed=7)), serial)
+
+        # Without seed the results differ, but not the structure
+        parallel = output_data(script_obj.run(jobs=3))
+        self.assertEqual([run[:2] for run in parallel], [run[:2] for run in serial])
+        self.assertNotEqual(parallel, serial)
+
+    def test_subject_chunks(self):
+        self.assertEqual(subject_chunks([5, 5, 2], 2),
+                         [(0, range(0, 5)), (1, range(0, 5)), (2, range(0, 2))])
+        self.assertEqual(subject_chunks([10], 3),
+                         [(0, range(0, 3)), (0, range(3, 6)), (0, range(6, 10))])
+        self.assertEqual(subject_chunks([2, 1], 8),
+                         [(0, range(0, 1)), (0, range(1, 2)), (1, range(0, 1))])
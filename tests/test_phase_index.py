@@ -0,0 +1,109 @@
+import os
+import tempfile
+import unittest
+
+import LsScript
+import LsStore
+from LsExceptions import LsEvalException
+from LsHistory import CodedHistory, encode
+from LsOutput import RunOutputSubject
+
+script = '''
+@parameters
+{{
+'subjects'          : 3,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1'],
+'stimulus_elements' : ['S1','S2','reward'],
+'u'                 : {{'reward':10, 'default': 0}}
+}}
+
+@phase {{'label':'a', 'end':'S1=4'}}
+STIMULUS   'S1'     | R1: REWARD | STIMULUS
+REWARD     'reward' | STIMULUS
+
+@phase {{'label':'b', 'end':'S2=3'}}
+STIMULUS_2 'S2'     | R0: REWARD | STIMULUS_2
+REWARD     'reward' | STIMULUS_2
+
+@run {{'label':'r', 'phases':('a','b','a'){run_props}}}
+'''
+
+
+class TestPhaseIndex(unittest.TestCase):
+
+    def test_repeated_phase(self):
+        simulation_data = LsScript.LsScript(script.format(run_props="")).run(seed=1)
+        for subject in simulation_data.run_outputs['r'].output_subjects:
+            labels, steps = subject.first_step_phase
+            self.assertEqual(labels, ['a', 'b', 'a', 'last'])
+            index = subject.phase_index()
+            self.assertEqual(index['a'], [(steps[0], steps[1]), (steps[2], steps[3])])
+            self.assertEqual(index['b'], [(steps[1], steps[2])])
+            self.assertNotIn('last', index)
+
+            # In the order of the phase labels
+            self.assertEqual(subject.phase_ranges(('b', 'a')),
+                             [(steps[1], steps[2]), (steps[0], steps[1]), (steps[2], steps[3])])
+
+            evalprops = {'subject': 0, 'steps': 'all', 'exact_steps': 'off', 'exact_n': 'off',
+                         'cumulative': 'off'}
+            v = subject.vwpn_eval('v', ('S1', 'R1'), evalprops)
+            v_a = subject.vwpn_eval('v', ('S1', 'R1'), dict(evalprops, phase='a'))
+            self.assertEqual(v_a, v[steps[0]:steps[1]] + v[steps[2]:steps[3]])
+            v_b = subject.vwpn_eval('v', ('S1', 'R1'), dict(evalprops, phase='b'))
+            self.assertEqual(v_b, v[steps[1]:steps[2]])
+
+            n_s2 = subject.vwpn_eval('n', 'S2', dict(evalprops, phase='a'))
+            self.assertEqual(sum(n_s2), 0)
+            n_s2 = subject.vwpn_eval('n', 'S2', dict(evalprops, phase='b'))
+            self.assertEqual(sum(n_s2), 3)
+
+            with self.assertRaises(LsEvalException):
+                subject.vwpn_eval('v', ('S1', 'R1'), dict(evalprops, phase='last'))
+
+    def test_joined(self):
+        subject = RunOutputSubject({'S1': ['R0']})
+        for label, step in [('a', 0), ('a', 1), ('b', 4), ('b', 5), ('c', 7), ('last', 9)]:
+            subject.write_step(label, step)
+        self.assertEqual(subject.first_step_phase, (['a', 'b', 'c', 'last'], [0, 4, 7, 9]))
+        self.assertEqual(subject.phase_ranges(('a', 'b')), [(0, 7)])
+        self.assertEqual(subject.phase_ranges(('a', 'c')), [(0, 4), (7, 9)])
+
+        # Not copied if all steps are used (as for the history)
+        values = list(range(9))
+        self.assertIs(subject.phasefilter(values, {'phase': ('a', 'b', 'c')}), values)
+        self.assertEqual(subject.phasefilter(values, {'phase': ('b', 'c')}), values[4:9])
+        self.assertEqual(subject.phasefilter(values, {'phase': ('c', 'a')}),
+                         values[7:9] + values[0:4])
+
+    def test_history_kinds(self):
+        # The same filtered evaluations from the history in memory, coded in a file, and
+        # counted during the simulation
+        postcmds = ("@nplot 'S1' {'phase':'a'}\n" +
+                    "@nplot ['reward','R0'] {'phase':('b','a'), 'cumulative':'off'}\n")
+        evals = [('S1', {'phase': 'a'}),
+                 (['reward', 'R0'], {'phase': ('b', 'a'), 'cumulative': 'off'})]
+        results = list()
+        simulation_data = LsScript.LsScript(script.format(run_props="") + postcmds).run(seed=2)
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'out.lsr')
+            LsStore.save(simulation_data, filename)
+            loaded = LsStore.load(filename)
+            counted = LsScript.LsScript(script.format(run_props=", 'history':'off'") +
+                                        postcmds).run(seed=2)
+            for data in [simulation_data, loaded, counted]:
+                results.append([data.vwpn_eval('n', (pattern, None), dict(props, runlabel='r',
+                                                                          subject='all'))
+                                for pattern, props in evals])
+            self.assertIsInstance(loaded.run_outputs['r'].output_subjects[0].history,
+                                  CodedHistory)
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], results[0])
+
+    def test_coded_select(self):
+        history = ['S1', 'R0', ('S1', 'S2'), 'R1', 'reward', 'R0', 'S1', 'R1']
+        codes, symbols = encode(history)
+        coded = CodedHistory(memoryview(codes), symbols)
+        self.assertEqual(list(coded.select([(2, 6)])), history[2:6])
+        self.assertEqual(list(coded.select([(6, 8), (0, 2)])), history[6:8] + history[0:2])
@@ -0,0 +1,96 @@
+import unittest
+
+import LsScript
+from LsSimulation import group_runs
+
+from tests.LsTestUtil import check_run_output_subject
+from tests.test_parallel import output_data
+
+
+script = '''
+@parameters
+{
+'subjects'          : 4,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1','R2'],
+'stimulus_elements' : ['S1','S2','reward','new trial'],
+'u'                 : {'reward':10, 'default': 0},
+'omit_learning'     : ['new trial']
+}
+
+@phase {'label':'pretrain', 'end':'reward=25'}
+NEW_TRIAL  'new trial' | STIMULUS(0.5),STIMULUS_2(0.5)
+STIMULUS   'S1'        | R1: REWARD | NEW_TRIAL
+STIMULUS_2 'S2'        | R2: REWARD | NEW_TRIAL
+REWARD     'reward'    | NEW_TRIAL
+
+@phase {'label':'test_a', 'end':'new trial=20'}
+NEW_TRIAL  'new trial' | STIMULUS
+STIMULUS   'S1'        | NEW_TRIAL
+
+@phase {'label':'test_b', 'end':'new trial=30'}
+NEW_TRIAL  'new trial' | STIMULUS
+STIMULUS   'S2'        | R2: REWARD | NEW_TRIAL
+REWARD     'reward'    | NEW_TRIAL
+
+@run {'label':'a', 'phases':('pretrain','test_a')}
+@run {'label':'b', 'phases':('pretrain','test_b')}
+@run {'label':'pretrain_only', 'phases':'pretrain'}
+@run {'label':'b_only', 'phases':'test_b'}
+
+@parameters
+{'beta': 2}
+@run {'label':'other_beta', 'phases':('pretrain','test_a')}
+'''
+
+
+class TestSharedPrefix(unittest.TestCase):
+
+    def setUp(self):
+        self.script_obj = LsScript.LsScript(script)
+
+    def test_group_runs(self):
+        runs = list(self.script_obj.runs.runs.values())
+        groups = group_runs(runs, share_prefix=True)
+        self.assertEqual([[run.runlabel for run in group.script_runs] for group in groups],
+                         [['a', 'b', 'pretrain_only'], ['b_only'], ['other_beta']])
+        self.assertEqual([group.n_shared for group in groups], [1, 0, 0])
+
+        groups = group_runs(runs, share_prefix=False)
+        self.assertEqual(len(groups), len(runs))
+
+    def test_shared_prefix(self):
+        shared = self.script_obj.run(seed=3, share_prefix=True)
+        self.assertEqual(list(shared.run_outputs),
+                         ['a', 'b', 'pretrain_only', 'b_only', 'other_beta'])
+
+        # The first run of a group is simulated exactly as without sharing
+        serial = self.script_obj.run(seed=3)
+        self.assertEqual(output_data(shared)[0], output_data(serial)[0])
+
+        for subject_ind in range(4):
+            subjects = {label: run_output.output_subjects[subject_ind]
+                        for label, run_output in shared.run_outputs.items()}
+            for subject in subjects.values():
+                check_run_output_subject(self, subject)
+
+            # The runs have the history of the shared phase in common, and then differ
+            prefix = subjects['pretrain_only'].history
+            prefix_steps = len(prefix) // 2
+            for label in ['a', 'b']:
+                subject = subjects[label]
+                self.assertEqual(subject.history[:len(prefix)], prefix)
+                self.assertGreater(len(subject.history), len(prefix))
+                self.assertEqual(subject.first_step_phase[0][:1], ['pretrain'])
+                self.assertEqual(subject.first_step_phase[1][1], prefix_steps)
+                for key, val in subjects['pretrain_only'].v.items():
+                    evalprops = {}
+                    self.assertEqual(subject.v[key].evaluate(evalprops)[:prefix_steps],
+                                     val.evaluate(evalprops)[:prefix_steps])
+            self.assertEqual(subjects['a'].first_step_phase[0][1], 'test_a')
+            self.assertEqual(subjects['b'].first_step_phase[0][1], 'test_b')
+
+    def test_shared_prefix_parallel(self):
+        serial = self.script_obj.run(seed=11, share_prefix=True)
+        parallel = self.script_obj.run(jobs=3, seed=11, share_prefix=True)
+        self.assertEqual(output_data(parallel), output_data(serial))
@@ -0,0 +1,151 @@
+import contextlib
+import importlib.util
+import io
+import os
+import tempfile
+import unittest
+
+import LsScript
+import LsProfile
+import LsWorld
+import LsOutput
+
+
+script = '''
+@parameters
+{
+'subjects'          : 2,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1'],
+'stimulus_elements' : ['S1','reward','new trial'],
+'u'                 : {'reward':10, 'default': 0},
+'omit_learning'     : ['new trial']
+}
+
+@phase {'label':'train', 'end':'reward=20'}
+NEW_TRIAL 'new trial' | STIMULUS
+STIMULUS  'S1'        | R1: REWARD | NEW_TRIAL
+REWARD    'reward'    | NEW_TRIAL
+
+@run {'label':'r'}
+
+@nplot 'R1' {'cumulative':'on'}
+'''
+
+
+class TestProfile(unittest.TestCase):
+
+    def setUp(self):
+        import matplotlib.pyplot as plt
+        plt.switch_backend('Agg')
+
+    def tearDown(self):
+        import matplotlib.pyplot as plt
+        plt.close('all')
+
+    def test_stages(self):
+        next_stimulus = LsWorld.World.next_stimulus
+        write_v = LsOutput.RunOutput.write_v
+
+        profiler = LsProfile.Profiler()
+        profiler.start()
+        with LsProfile.stage(profiler, LsProfile.PARSE):
+            script_obj = LsScript.LsScript(script)
+        with LsProfile.stage(profiler, LsProfile.SIMULATION):
+            simulation_data = script_obj.run()
+        profiler.instrument_postcmds(script_obj.postcmds)
+        with LsProfile.stage(profiler, LsProfile.POSTPROCESSING):
+            script_obj.postcmds.run(simulation_data)
+        profiler.stop()
+
+        # The timed methods are restored
+        self.assertIs(LsWorld.World.next_stimulus, next_stimulus)
+        self.assertIs(LsOutput.RunOutput.write_v, write_v)
+
+        n_steps = sum(len(out.history) // 2
+                      for out in simulation_data.run_outputs['r'].output_subjects)
+        timers = profiler.timers
+        self.assertEqual(timers[LsProfile.PARSE].calls, 1)
+        self.assertEqual(timers[LsProfile.LEARN_AND_RESPOND].calls, n_steps)
+        self.assertEqual(timers[LsProfile.WRITE_HISTORY].calls, n_steps)
+        self.assertEqual(timers[LsProfile.WRITE_ALL].calls, 2)  # The last step of each subject
+        self.assertGreater(timers[LsProfile.NEXT_STIMULUS].calls, n_steps)
+        self.assertEqual(timers[LsProfile.VWPN_EVAL].calls, 1)
+        self.assertEqual(len(profiler.postcmd_timers), 1)
+        self.assertEqual(profiler.postcmd_timers[0][1].calls, 1)
+
+        report = profiler.report()
+        self.assertIn(LsProfile.LEARN_AND_RESPOND, report)
+        self.assertIn("@nplot", report)
+
+    def test_grouped_export(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "all.csv").replace('\\', '/')
+            script_obj = LsScript.LsScript(script + "@export {'filename':'" + filename + "'}\n" +
+                                           "v ('S1','R1')\n" + "n 'R1'\n")
+            profiler = LsProfile.Profiler()
+            profiler.start()
+            simulation_data = script_obj.run()
+            profiler.instrument_postcmds(script_obj.postcmds)
+            with LsProfile.stage(profiler, LsProfile.POSTPROCESSING):
+                script_obj.postcmds.run(simulation_data)
+            profiler.stop()
+            self.assertTrue(os.path.isfile(filename))
+        self.assertEqual([label for label, _ in profiler.postcmd_timers],
+                         ["@nplot ('R1', None)", "@export {{'filename': '{}'}}".format(filename)])
+        self.assertEqual(profiler.postcmd_timers[1][1].calls, 1)
+        self.assertIn("@export", profiler.report())
+
+    def test_scheduled_recording(self):
+        # Recording at scheduled steps is timed as write_all
+        script_obj = LsScript.LsScript(script.replace("@run {'label':'r'}",
+                                                      "@run {'label':'r', 'record_every':5}"))
+        profiler = LsProfile.Profiler()
+        profiler.start()
+        with LsProfile.stage(profiler, LsProfile.SIMULATION):
+            simulation_data = script_obj.run()
+        profiler.stop()
+        n_steps = [len(out.history) // 2
+                   for out in simulation_data.run_outputs['r'].output_subjects]
+        self.assertGreaterEqual(profiler.timers[LsProfile.WRITE_ALL].calls,
+                                sum(n // 5 for n in n_steps))
+        self.assertIn(LsProfile.WRITE_ALL, profiler.report())
+
+    def test_jobs(self):
+        # The simulation stages are timed also with --jobs
+        spec = importlib.util.spec_from_file_location('lesim', 'lesim.py')
+        lesim = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(lesim)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "script.txt")
+            with open(filename, 'w') as f:
+                f.write(script.replace("@nplot 'R1' {'cumulative':'on'}", ""))
+            stdout, stderr = io.StringIO(), io.StringIO()
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                lesim.run_files([filename], {'--profile': True, '--jobs': '2'})
+        self.assertIn("--jobs", stderr.getvalue())
+        for line in stdout.getvalue().splitlines():
+            if line.strip().startswith(LsProfile.LEARN_AND_RESPOND):
+                self.assertGreater(int(line.split()[1]), 0)
+                break
+        else:
+            self.fail("No {} in the report".format(LsProfile.LEARN_AND_RESPOND))
+
+    def test_no_profiler(self):
+        with LsProfile.stage(None, LsProfile.PARSE):
+            LsScript.LsScript(script)
+
+    def test_cprofile_and_stacks(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cprofile_file = os.path.join(tmpdir, "out.prof")
+            stacks_file = os.path.join(tmpdir, "out.stacks")
+            profiler = LsProfile.Profiler(cprofile_file, stacks_file, sample_interval=0.001)
+            profiler.start()
+            script_obj = LsScript.LsScript(script.replace("reward=20", "reward=500"))
+            script_obj.run()
+            profiler.stop()
+            self.assertTrue(os.path.isfile(cprofile_file))
+            with open(stacks_file) as f:
+                for line in f:
+                    stack, count = line.rsplit(' ', 1)
+                    self.assertGreater(int(count), 0)
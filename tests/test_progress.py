@@ -0,0 +1,97 @@
+import unittest
+import LsScript
+from LsSimulation import Progress
+
+from tests.LsTestUtil import check_run_output_subject
+
+
+script = '''
+@parameters
+{
+'subjects'          : 3,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1'],
+'stimulus_elements' : ['S1','reward','new trial'],
+'u'                 : {'reward':10, 'default': 0},
+'omit_learning'     : ['new trial']
+}
+
+@phase {'label':'train', 'end':'reward=20'}
+NEW_TRIAL 'new trial' | STIMULUS
+STIMULUS  'S1'        | R1: REWARD | NEW_TRIAL
+REWARD    'reward'    | NEW_TRIAL
+
+@run {'label':'r1'}
+@run {'label':'r2'}
+'''
+
+
+class CancelAfter(Progress):
+    '''Cancels the simulation after the specified number of steps.'''
+
+    def __init__(self, n_steps):
+        super().__init__()
+        self.cancel_after = n_steps
+
+    @property
+    def cancelled(self):
+        return self.n_steps >= self.cancel_after
+
+    @cancelled.setter
+    def cancelled(self, value):
+        pass
+
+
+class CancelAfterSubject(Progress):
+    '''Cancels the simulation at the first step after the first subject is done.'''
+
+    @property
+    def cancelled(self):
+        return self.n_subjects_done >= 1
+
+    @cancelled.setter
+    def cancelled(self, value):
+        pass
+
+
+class TestProgress(unittest.TestCase):
+
+    def test_progress(self):
+        script_obj = LsScript.LsScript(script)
+        progress = Progress()
+        simulation_data = script_obj.run(progress)
+        self.assertEqual(progress.n_subjects, 6)
+        self.assertEqual(progress.n_subjects_done, 6)
+        n_steps = 0
+        for run_output in simulation_data.run_outputs.values():
+            for output_subject in run_output.output_subjects:
+                n_steps += len(output_subject.history) // 2
+        self.assertEqual(progress.n_steps, n_steps)
+        self.assertGreater(progress.steps_per_second(), 0)
+
+    def test_cancel(self):
+        script_obj = LsScript.LsScript(script)
+        progress = CancelAfter(10)
+        simulation_data = script_obj.run(progress)
+        self.assertEqual(list(simulation_data.run_outputs.keys()), ['r1'])
+        run_output = simulation_data.run_outputs['r1']
+        self.assertEqual(run_output.n_subjects, 1)
+        self.assertEqual(len(run_output.output_subjects), 1)
+        output_subject = run_output.output_subjects[0]
+        self.assertEqual(len(output_subject.history), 2 * 10)
+        check_run_output_subject(self, output_subject)
+
+        # The partial results can be evaluated
+        v = simulation_data.vwpn_eval('v', ('S1', 'R1'), {})
+        self.assertEqual(len(v), 10 + 1)
+
+    def test_cancel_second_subject(self):
+        script_obj = LsScript.LsScript(script)
+        progress = CancelAfterSubject()
+        simulation_data = script_obj.run(progress)
+        run_output = simulation_data.run_outputs['r1']
+        self.assertEqual(run_output.n_subjects, 2)
+        self.assertEqual(progress.n_subjects_done, 2)
+        self.assertEqual(len(run_output.output_subjects[1].history), 2)
+        for output_subject in run_output.output_subjects:
+            check_run_output_subject(self, output_subject)
@@ -0,0 +1,197 @@
+import csv
+import os
+import random
+import tempfile
+import unittest
+
+import LsScript
+from LsOutput import Val, DeltaVal
+from LsExceptions import LsParseException
+
+
+script = '''
+@parameters
+{
+'subjects'          : 3,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1','R2'],
+'stimulus_elements' : ['S1','S2','reward','new trial'],
+'u'                 : {'reward':10, 'default': 0},
+'alpha_v'           : {('S2','R2'):0, 'default':0.1},
+'omit_learning'     : ['new trial']
+}
+
+@phase {'label':'train', 'end':'reward=50'}
+NEW_TRIAL  'new trial' | STIMULUS(0.5),STIMULUS_2(0.5)
+STIMULUS   'S1'        | R1: REWARD | NEW_TRIAL
+STIMULUS_2 'S2'        | R2: REWARD | NEW_TRIAL
+REWARD     'reward'    | NEW_TRIAL
+
+@phase {'label':'test', 'end':'new trial=20'}
+NEW_TRIAL  'new trial' | STIMULUS
+STIMULUS   'S1'        | NEW_TRIAL
+
+@run {'label':'r'RECORD}
+'''
+
+EVALS = [('v', ('S1', 'R1'), {}),
+         ('v', ('S2', 'R2'), {'subject': 'all'}),
+         ('v', ('new trial', 'R0'), {'subject': 1}),
+         ('w', 'S1', {'subject': 2}),
+         ('w', 'reward', {'phase': 'test'}),
+         ('p', (('S1',), 'R1'), {'beta': 1, 'steps': 'S1'}),
+         ('p', (('S2',), 'R2'), {'beta': 1, 'phase': 'train', 'subject': 'all'})]
+
+
+class TestRecordChanges(unittest.TestCase):
+
+    def test_same_evaluation(self):
+        record_all = LsScript.LsScript(script.replace("RECORD", "")).run(seed=1)
+        record_changes = LsScript.LsScript(
+            script.replace("RECORD", ", 'record':'changes'")).run(seed=1)
+
+        for vwpn, arg, evalprops in EVALS:
+            self.assertEqual(record_changes.vwpn_eval(vwpn, arg, dict(evalprops)),
+                             record_all.vwpn_eval(vwpn, arg, dict(evalprops)))
+
+        n_all = 0
+        n_changes = 0
+        for subject_all, subject_changes in zip(record_all.run_outputs['r'].output_subjects,
+                                                record_changes.run_outputs['r'].output_subjects):
+            self.assertEqual(subject_changes.history, subject_all.history)
+            for key, val in subject_all.v.items():
+                n_all += len(val.values)
+                n_changes += len(subject_changes.v[key].values)
+                self.assertLessEqual(len(subject_changes.v[key].values), len(val.values))
+                self.assertEqual(subject_changes.v[key].steps[-1], val.steps[-1])
+
+            # alpha_v is 0 for ('S2','R2'), so v(S2->R2) keeps its start value
+            self.assertEqual(len(subject_changes.v[('S2', 'R2')].values), 2)
+        self.assertLess(n_changes, n_all)
+
+    def test_same_export(self):
+        # The exported files are the same, also where an int start value is followed by an
+        # equal float (v(S2->R2) is -1 and then -1.0, as alpha_v is 0.0)
+        csv_text = list()
+        with tempfile.TemporaryDirectory() as tmp:
+            for record in ["", ", 'record':'changes'"]:
+                filename = os.path.join(tmp, 'v.csv').replace('\\', '/')
+                postcmds = ("@vexport ('S2','R2') {{'subject':'all', 'filename':'{0}'}}\n"
+                            "@export {{'filename':'{1}'}}\n"
+                            "v ('S1','R1') {{'subject':0}}\n"
+                            "v ('S2','R2') {{'subject':0}}\n"
+                            "w 'reward'\n").format(filename, filename.replace('v.csv', 'g.csv'))
+                text = script.replace("RECORD", record).replace(
+                    "{('S2','R2'):0,", "{('S2','R2'):0.0,").replace(
+                    "'omit_learning'", "'start_v' : {'default':-1},\n'omit_learning'")
+                script_obj = LsScript.LsScript(text + postcmds)
+                script_obj.postproc(script_obj.run(seed=1))
+                texts = list()
+                for name in ['v.csv', 'g.csv']:
+                    with open(os.path.join(tmp, name)) as f:
+                        texts.append(f.read())
+                csv_text.append(texts)
+        self.assertEqual(csv_text[1], csv_text[0])
+        self.assertIn(",-1,", csv_text[0][0])
+        self.assertIn(",-1.0,", csv_text[0][0])
+
+    def test_invalid(self):
+        with self.assertRaises(LsParseException):
+            LsScript.LsScript(script.replace("RECORD", ", 'record':'foo'"))
+
+    def test_delta_val(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            val = Val()
+            delta_val = DeltaVal()
+            step = 0
+            for _ in range(rng.randint(1, 40)):
+                value = rng.choice([0, 0.0, 0.5, 1, 1.0])
+                val.write(value, step)
+                delta_val.write(value, step)
+                step += rng.randint(1, 3)
+            self.assertEqual([(type(y), y) for y in delta_val.evaluate({})],
+                             [(type(y), y) for y in val.evaluate({})])
+            self.assertLessEqual(len(delta_val.values), len(val.values))
+
+
+class TestRecordSchedule(unittest.TestCase):
+
+    def run_script(self, run_props, mechanism='GA'):
+        text = script.replace("RECORD", run_props).replace("'GA'", "'{}'".format(mechanism))
+        if mechanism != 'GA':
+            text = text.replace("{('S2','R2'):0, 'default':0.1}", "0.1")
+        return LsScript.LsScript(text).run(seed=2)
+
+    def test_same_values_at_recorded_steps(self):
+        for mechanism in ['GA', 'rescorla_wagner', 'q_learning', 'exp_sarsa', 'actor_critic']:
+            full = self.run_script("", mechanism)
+            sampled = self.run_script(", 'record_every':7", mechanism)
+            for subject_ind in range(3):
+                subject_full = full.run_outputs['r'].output_subjects[subject_ind]
+                subject = sampled.run_outputs['r'].output_subjects[subject_ind]
+                self.assertEqual(subject.history, subject_full.history)
+                evals = [('v', ('S1', 'R1'), {}), ('v', ('reward', 'R0'), {}),
+                         ('p', (('S1',), 'R1'), {'beta': 1})]
+                if subject_full.w:
+                    evals.append(('w', 'S1', {}))
+                for vwpn, arg, evalprops in evals:
+                    y_full = subject_full.vwpn_eval(vwpn, arg, dict(evalprops, steps='all'))
+                    y = subject.vwpn_eval(vwpn, arg, dict(evalprops, steps='all'))
+                    max_step = len(y_full) - 1
+                    self.assertEqual(y.x, list(range(0, max_step, 7)) + [max_step])
+                    self.assertEqual(list(y), [y_full[x] for x in y.x])
+
+    def test_evaluation(self):
+        full = self.run_script("")
+        sampled = self.run_script(", 'record_steps':[1,2,4,8,16,32,64,128,256,512]")
+
+        # Phase filter: x is the step within the phase
+        evalprops = {'phase': 'test', 'subject': 1}
+        y_full = full.vwpn_eval('v', ('S1', 'R1'), dict(evalprops))
+        y = sampled.vwpn_eval('v', ('S1', 'R1'), dict(evalprops))
+        self.assertEqual(list(y), [y_full[x] for x in y.x])
+
+        # n is evaluated from the full history
+        evalprops = {'subject': 0, 'cumulative': 'on'}
+        self.assertEqual(sampled.vwpn_eval('n', ['S1', 'R1'], dict(evalprops)),
+                         full.vwpn_eval('n', ['S1', 'R1'], dict(evalprops)))
+
+        # Steps filter: one value per matching step, the last recorded value before it
+        evalprops = {'subject': 0, 'steps': 'S1'}
+        y_full = full.vwpn_eval('v', ('S1', 'R1'), dict(evalprops))
+        y = sampled.vwpn_eval('v', ('S1', 'R1'), dict(evalprops))
+        self.assertEqual(len(y), len(y_full))
+
+        # All subjects share x, average is over the union of the recorded steps
+        y_all = sampled.vwpn_eval('v', ('S1', 'R1'), {'subject': 'all'})
+        self.assertEqual(len(y_all), 3)
+        longest = max(y_all, key=len)
+        for y in y_all:
+            self.assertEqual(y.x, longest.x[:len(y)])
+        y_full = full.vwpn_eval('v', ('S1', 'R1'), {})
+        y = sampled.vwpn_eval('v', ('S1', 'R1'), {})
+        self.assertEqual(y.x, longest.x)
+        for x, value in zip(y.x, y):
+            if x in (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512):
+                self.assertAlmostEqual(value, y_full[x])
+
+    def test_export(self):
+        sampled = self.run_script(", 'record_every':10")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'v.csv')
+            postcmds = LsScript.LsScript(script.replace("RECORD", "") + '''
+            @vexport ('S1','R1') {{'subject':0, 'filename':'{}'}}
+            '''.format(filename)).postcmds
+            postcmds.run(sampled)
+            with open(filename) as f:
+                rows = list(csv.reader(f))
+        y = sampled.vwpn_eval('v', ('S1', 'R1'), {'subject': 0})
+        self.assertEqual([int(row[0]) for row in rows[1:]], y.x)
+
+    def test_invalid(self):
+        for props in [", 'record_every':0", ", 'record_every':1.5", ", 'record_steps':5",
+                      ", 'record_every':2, 'record_steps':[1]",
+                      ", 'record_every':2, 'record':'changes'"]:
+            with self.assertRaises(LsParseException):
+                LsScript.LsScript(script.replace("RECORD", props))
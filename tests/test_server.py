@@ -0,0 +1,117 @@
+import os
+import tempfile
+import threading
+import unittest
+
+import LsServer
+import LsStore
+
+
+script = '''
+@parameters
+{
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1'],
+'stimulus_elements' : ['S1','reward','new trial'],
+'u'                 : {'reward':10, 'default': 0},
+'omit_learning'     : ['new trial']
+}
+
+@phase {'label':'train', 'end':'reward=20'}
+NEW_TRIAL 'new trial' | STIMULUS
+STIMULUS  'S1'        | R1: REWARD | NEW_TRIAL
+REWARD    'reward'    | NEW_TRIAL
+
+@run {'label':'r'}
+
+@vexport ('S1','R1') {'filename':'v_export'}
+@nexport ['S1','R1'] {'filename':'n_export.csv', 'cumulative':'on'}
+'''
+
+grouped_export = '''@export {'filename':'grouped_export'}
+v ('S1','R1')
+n ['S1','R1'] {'cumulative':'on'}
+'''
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.server = LsServer.Server("localhost:0", jobs=1)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        LsServer.submit({'op': LsServer.OP_SHUTDOWN}, self.server.address)
+        self.thread.join()
+        self.tmpdir.cleanup()
+
+    def test_run(self):
+        address = self.server.address
+        self.assertTrue(LsServer.submit({'op': LsServer.OP_PING}, address)['ok'])
+
+        request = {'script': script, 'cwd': self.tmpdir.name, 'save': 'results.lsr'}
+        response = LsServer.submit(request, address)
+        self.assertTrue(response['ok'], response.get('error'))
+        self.assertFalse(response['cached'])
+        exports = [os.path.join(self.tmpdir.name, filename)
+                   for filename in ['v_export.csv', 'n_export.csv']]
+        self.assertEqual([os.path.realpath(f) for f in response['exports']],
+                         [os.path.realpath(f) for f in exports])
+        for filename in exports:
+            self.assertTrue(os.path.exists(filename))
+        loaded = LsStore.load(response['save'])
+        self.assertEqual(list(loaded.run_outputs), ['r'])
+
+        # The parsed script is reused
+        response = LsServer.submit(request, address)
+        self.assertTrue(response['ok'], response.get('error'))
+        self.assertTrue(response['cached'])
+
+    def test_file_and_error(self):
+        address = self.server.address
+        filename = os.path.join(self.tmpdir.name, "script.txt")
+        with open(filename, 'w') as f:
+            f.write(script)
+        response = LsServer.submit({'file': filename, 'cwd': self.tmpdir.name,
+                                    'figures': 'figures'}, address)
+        self.assertTrue(response['ok'], response.get('error'))
+        self.assertEqual(len(response['exports']), 2)
+
+        response = LsServer.submit({'script': "@foo"}, address)
+        self.assertFalse(response['ok'])
+        self.assertIn("foo", response['error'])
+
+        response = LsServer.submit({'op': 'foo'}, address)
+        self.assertFalse(response['ok'])
+
+    def test_grouped_export(self):
+        request = {'script': script + grouped_export, 'cwd': self.tmpdir.name}
+        response = LsServer.submit(request, self.server.address)
+        self.assertTrue(response['ok'], response.get('error'))
+        exports = [os.path.join(self.tmpdir.name, filename)
+                   for filename in ['v_export.csv', 'n_export.csv', 'grouped_export.csv']]
+        self.assertEqual([os.path.realpath(f) for f in response['exports']],
+                         [os.path.realpath(f) for f in exports])
+        for filename in exports:
+            self.assertTrue(os.path.exists(filename))
+
+    def test_cwd_restored(self):
+        cwd = os.getcwd()
+        response = LsServer.run_request({'script': script + "# Not cached\n",
+                                         'cwd': self.tmpdir.name})
+        self.assertTrue(response['ok'], response.get('error'))
+        self.assertEqual(os.getcwd(), cwd)
+
+        # Also after a failed request
+        response = LsServer.run_request({'script': "@foo", 'cwd': self.tmpdir.name})
+        self.assertFalse(response['ok'])
+        self.assertEqual(os.getcwd(), cwd)
+
+    def test_parse_address(self):
+        self.assertEqual(LsServer.parse_address("1234")[1], ("localhost", 1234))
+        self.assertEqual(LsServer.parse_address("127.0.0.1:80")[1], ("127.0.0.1", 80))
+        self.assertEqual(LsServer.parse_address("/tmp/lesim.sock")[1], "/tmp/lesim.sock")
+        with self.assertRaises(Exception):
+            LsServer.parse_address("localhost:foo")
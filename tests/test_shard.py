@@ -0,0 +1,90 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import LsScript
+import LsShard
+import LsStore
+from tests.test_parallel import output_data
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+script = '''
+@parameters
+{
+'subjects'          : 5,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1','R2'],
+'stimulus_elements' : ['S1','S2','reward','new trial'],
+'u'                 : {'reward':10, 'default': 0},
+'omit_learning'     : ['new trial']
+}
+
+@phase {'label':'train', 'end':'reward=20'}
+NEW_TRIAL  'new trial' | STIMULUS(0.5),STIMULUS_2(0.5)
+STIMULUS   ('S1','S2') | R1: REWARD | NEW_TRIAL
+STIMULUS_2 'S2'        | R2: REWARD | NEW_TRIAL
+REWARD     'reward'    | NEW_TRIAL
+
+@run {'label':'r1'}
+
+@parameters
+{'subjects': 3}
+@run {'label':'r2'}
+'''
+
+
+class TestShard(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.spool_dir = os.path.join(self.tmpdir.name, "spool")
+        self.serial = output_data(LsScript.LsScript(script).run(seed=11))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_work_and_merge(self):
+        n_units = LsShard.create_spool(script, self.spool_dir, 4, seed=11)
+        self.assertEqual(n_units, 4)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.spool_dir, LsShard.TODO))),
+                         ["unit-00000.json", "unit-00001.json", "unit-00002.json",
+                          "unit-00003.json"])
+
+        self.assertEqual(LsShard.work(self.spool_dir, max_units=1), (1, 0))
+        with self.assertRaises(Exception) as cm:
+            LsShard.merge(self.spool_dir)
+        self.assertIn("3 of 4 units are not done", str(cm.exception))
+
+        self.assertEqual(LsShard.work(self.spool_dir), (3, 0))
+        self.assertEqual(LsShard.work(self.spool_dir), (0, 0))
+        self.assertEqual(os.listdir(os.path.join(self.spool_dir, LsShard.CLAIMED)), [])
+        self.assertEqual(output_data(LsShard.merge(self.spool_dir)), self.serial)
+
+    def test_not_empty(self):
+        LsShard.create_spool(script, self.spool_dir, 2)
+        with self.assertRaises(Exception):
+            LsShard.create_spool(script, self.spool_dir, 2)
+
+    def test_concurrent_workers(self):
+        script_file = os.path.join(self.tmpdir.name, "script.txt")
+        with open(script_file, "w") as f:
+            f.write(script)
+        save_file = os.path.join(self.tmpdir.name, "merged.lsr")
+        lesim = os.path.join(REPO_DIR, "lesim.py")
+
+        subprocess.check_call([sys.executable, lesim, "shard", "--shards", "8", "--seed", "11",
+                               script_file], stdout=subprocess.DEVNULL)
+        spool_dir = os.path.join(self.tmpdir.name, "script.spool")
+        workers = [subprocess.Popen([sys.executable, lesim, "worker", spool_dir],
+                                    stdout=subprocess.DEVNULL) for _ in range(3)]
+        for worker in workers:
+            self.assertEqual(worker.wait(), 0)
+        spool, _ = LsShard.read_spool(spool_dir)
+        self.assertEqual(len(os.listdir(os.path.join(spool_dir, LsShard.DONE))),
+                         spool['n_units'])
+        subprocess.check_call([sys.executable, lesim, "merge", "--save", save_file, spool_dir])
+
+        self.assertEqual(output_data(LsStore.load(save_file)), self.serial)
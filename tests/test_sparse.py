@@ -0,0 +1,125 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import LsMechanism
+import LsScript
+import LsStore
+
+script = '''
+@parameters
+{{
+'subjects'              : 3,
+'mechanism'             : 'GA',
+'behaviors'             : ['R0','R1','R2'],
+'stimulus_elements'     : ['S1','S2','reward','new trial'],
+'response_requirements' : {{'R1':'S1', 'R2':['S2']}},
+'start_v'               : {{'default':0, ('S1','R1'):1, ('reward','R2'):-1}},
+'alpha_v'               : {{'default':0.2, ('S2','R1'):0.05}},
+'u'                     : {{'reward':10, 'default': 0}},
+'omit_learning'         : ['new trial']
+}}
+
+@phase {{'label':'train', 'end':'reward=20'}}
+NEW_TRIAL  'new trial' | STIMULUS(0.5),STIMULUS_2(0.5)
+STIMULUS   ('S1','S2') | R1: REWARD | NEW_TRIAL
+STIMULUS_2 'S2'        | R2: REWARD | NEW_TRIAL
+REWARD     'reward'    | NEW_TRIAL
+
+@run {{'label':'r'{record}}}
+'''
+
+ELEMENTS = ['S1', 'S2', 'reward', 'new trial']
+BEHAVIORS = ['R0', 'R1', 'R2']
+
+
+def dense_initialize_v(self):
+    '''All pairs in a dict, as before v was sparse.'''
+    self.v = dict()
+    for element in self.stimulus_elements:
+        for behavior in self.behaviors:
+            key = (element, behavior)
+            self.v[key] = self.start_v.get(key, self.start_v['default'])
+
+
+def evaluations(simulation_data):
+    out = list()
+    for element in ELEMENTS:
+        for behavior in BEHAVIORS:
+            out.append(simulation_data.vwpn_eval('v', (element, behavior),
+                                                 {'subject': 'all'}))
+    for stimulus, behavior in [(('S1',), 'R1'), (('S2',), 'R2'), (('S1', 'S2'), 'R1')]:
+        out.append(simulation_data.vwpn_eval('p', (stimulus, behavior),
+                                             {'subject': 'all', 'beta': 1}))
+    return [[list(values) for values in subjects] for subjects in out]
+
+
+class TestSparse(unittest.TestCase):
+
+    def test_mechanism(self):
+        mechanism = LsScript.LsScript(script.format(record='')).runs.runs['r'].mechanism_obj
+        self.assertEqual(dict(mechanism.v), {('S1', 'R1'): 1, ('reward', 'R2'): -1})
+        self.assertEqual(mechanism.v[('S2', 'R0')], 0)
+        self.assertEqual(dict(mechanism.alpha_v_all), {('S2', 'R1'): 0.05})
+        self.assertEqual(mechanism.alpha_v_all[('S1', 'R1')], 0.2)
+
+        # Each subject starts from the start values
+        mechanism.v[('S1', 'R1')] += 2
+        mechanism.v[('S2', 'R2')] += 3
+        mechanism.subject_reset()
+        self.assertEqual(dict(mechanism.v), {('S1', 'R1'): 1, ('reward', 'R2'): -1})
+
+    def test_large_space(self):
+        elements = ["E{}".format(i) for i in range(3000)]
+        behaviors = ["B{}".format(i) for i in range(300)]
+        mechanism = LsMechanism.Enquist(
+            behaviors=behaviors, stimulus_elements=elements,
+            response_requirements={b: elements[(10 * i):(10 * i + 10)]
+                                   for i, b in enumerate(behaviors)})
+        self.assertEqual(len(mechanism.v), 0)
+        self.assertEqual(len(mechanism.alpha_v_all), 0)
+        mechanism.learn_and_respond(('E0',))
+        mechanism.learn_and_respond(('E11',))
+        self.assertEqual(list(mechanism.v), [('E0', 'B0')])
+
+    def test_output(self):
+        simulation_data = LsScript.LsScript(script.format(record='')).run(seed=1)
+        subject = simulation_data.run_outputs['r'].output_subjects[0]
+
+        # The possible responses to each element, the pairs learned in ('S1','S2') and the
+        # pairs with a start value of their own
+        self.assertEqual(set(subject.v), {('S1', 'R0'), ('S1', 'R1'), ('S2', 'R0'),
+                                          ('S2', 'R2'), ('reward', 'R0'), ('new trial', 'R0'),
+                                          ('S2', 'R1'), ('S1', 'R2'), ('reward', 'R2')})
+        self.assertNotIn(('new trial', 'R2'), subject.v)
+        n_steps = len(simulation_data.vwpn_eval('v', ('S1', 'R1'), {'subject': 0}))
+        self.assertEqual(simulation_data.vwpn_eval('v', ('reward', 'R2'), {'subject': 0}),
+                         [-1] * n_steps)
+        self.assertEqual(simulation_data.vwpn_eval('v', ('new trial', 'R2'), {'subject': 0}),
+                         [0] * n_steps)
+        s2_r1 = simulation_data.vwpn_eval('v', ('S2', 'R1'), {'subject': 0})
+        self.assertEqual(s2_r1[0], 0)
+        self.assertNotEqual(s2_r1[-1], 0)
+
+    def test_same_as_dense(self):
+        for record in ["", ", 'record':'changes'"]:
+            script_obj = LsScript.LsScript(script.format(record=record))
+            sparse = evaluations(script_obj.run(seed=2))
+            with mock.patch.object(LsMechanism.Mechanism, '_initialize_v', dense_initialize_v):
+                script_obj = LsScript.LsScript(script.format(record=record))
+                dense = evaluations(script_obj.run(seed=2))
+            self.assertEqual(sparse, dense)
+
+        # Recorded at each step, a pair learned late has the start value at the earlier steps
+        sampled = evaluations(LsScript.LsScript(script.format(record=", 'record_every':1")).
+                              run(seed=2))
+        self.assertEqual(sampled, sparse)
+
+    def test_store(self):
+        simulation_data = LsScript.LsScript(script.format(record='')).run(seed=3)
+        fd, filename = tempfile.mkstemp(suffix='.lsr')
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+        LsStore.save(simulation_data, filename)
+        self.assertEqual(evaluations(LsStore.load(filename)), evaluations(simulation_data))
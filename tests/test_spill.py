@@ -0,0 +1,93 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import LsScript
+import LsStore
+from tests.test_parallel import output_data
+
+
+script = '''
+@parameters
+{
+'subjects'          : 6,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1','R2'],
+'stimulus_elements' : ['S1','S2','reward','new trial'],
+'u'                 : {'reward':10, 'default': 0},
+'omit_learning'     : ['new trial']
+}
+
+@phase {'label':'train', 'end':'reward=30'}
+NEW_TRIAL  'new trial' | STIMULUS(0.5),STIMULUS_2(0.5)
+STIMULUS   ('S1','S2') | R1: REWARD | NEW_TRIAL
+STIMULUS_2 'S2'        | R2: REWARD | NEW_TRIAL
+REWARD     'reward'    | NEW_TRIAL
+
+@phase {'label':'test', 'end':'new trial=20'}
+NEW_TRIAL  'new trial' | STIMULUS
+STIMULUS   'S1'        | NEW_TRIAL
+
+@run {'label':'r1'}
+@run {'label':'r2', 'record_every':5}
+'''
+
+EVALS = [('v', ('S1', 'R1'), {}),
+         ('v', ('S2', 'R2'), {'subject': 'all', 'phase': 'train'}),
+         ('w', 'S1', {'subject': 4}),
+         ('p', (('S1', 'S2'), 'R1'), {'beta': 1, 'steps': ['new trial', 'R0']}),
+         ('n', ['S2', 'R2'], {'cumulative': 'on', 'phase': 'test'}),
+         ('n', (('S1', 'S2'), 'R1'), {'subject': 'all'})]
+
+
+def spilled(simulation_data):
+    return [[subject.spill_file is not None for subject in run_output.output_subjects]
+            for run_output in simulation_data.run_outputs.values()]
+
+
+class TestSpill(unittest.TestCase):
+
+    def setUp(self):
+        self.script_obj = LsScript.LsScript(script)
+        self.in_memory = self.script_obj.run(seed=5)
+
+    def assert_same_evaluation(self, simulation_data):
+        for run_label in ['r1', 'r2']:
+            for vwpn, arg, evalprops in EVALS:
+                evalprops = dict(evalprops, runlabel=run_label)
+                self.assertEqual(simulation_data.vwpn_eval(vwpn, arg, dict(evalprops)),
+                                 self.in_memory.vwpn_eval(vwpn, arg, dict(evalprops)))
+
+    def test_budget(self):
+        subject_memory = LsStore.estimate_memory(
+            self.in_memory.run_outputs['r1'].output_subjects[0])
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            simulation_data = self.script_obj.run(seed=5, memory_budget=2.5 * subject_memory,
+                                                  scratch_dir=scratch_dir)
+            is_spilled = spilled(simulation_data)
+            self.assertFalse(any(is_spilled[0][:2]))
+            self.assertTrue(all(is_spilled[0][2:]))
+            self.assertTrue(all(is_spilled[1]))
+            spill_dir, = os.listdir(scratch_dir)
+            self.assertEqual(len(os.listdir(os.path.join(scratch_dir, spill_dir))), 10)
+            self.assertEqual(output_data(simulation_data), output_data(self.in_memory))
+            self.assert_same_evaluation(simulation_data)
+
+        # The output fits in the budget
+        simulation_data = self.script_obj.run(seed=5, memory_budget=10 ** 9)
+        self.assertFalse(any(any(is_spilled) for is_spilled in spilled(simulation_data)))
+
+    def test_parallel(self):
+        simulation_data = self.script_obj.run(jobs=3, seed=5, memory_budget=0)
+        self.assertTrue(all(all(is_spilled) for is_spilled in spilled(simulation_data)))
+        self.assert_same_evaluation(simulation_data)
+
+    def test_pickle(self):
+        simulation_data = self.script_obj.run(seed=5, memory_budget=0)
+        subject = simulation_data.run_outputs['r1'].output_subjects[3]
+        pickled = pickle.dumps(subject)
+        self.assertLess(len(pickled), 1000)
+        unpickled = pickle.loads(pickled)
+        self.assertEqual(unpickled.spill_file, subject.spill_file)
+        self.assertEqual(list(unpickled.history), list(subject.history))
@@ -0,0 +1,77 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Upper bound for the time to import the modules needed by "lesim.py run". Without
+# matplotlib this is a small fraction of the bound, with matplotlib it is typically above it.
+MAX_IMPORT_TIME = 0.5
+
+GUI_MODULES = ('matplotlib', 'tkinter')
+
+export_script = '''
+@parameters
+{
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1'],
+'stimulus_elements' : ['S1','reward'],
+'u'                 : {'reward':10, 'default': 0}
+}
+
+@phase {'label':'train', 'end':'reward=10'}
+STIMULUS  'S1'        | R1: REWARD | STIMULUS
+REWARD    'reward'    | STIMULUS
+
+@run {'label':'r'}
+
+@vexport ('S1','R1') {'filename':'v_export'}
+'''
+
+
+def run_python(code, cwd=REPO_DIR):
+    '''Runs code in a new interpreter with the repository on the path and returns stdout.'''
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    return subprocess.check_output([sys.executable, "-c", code], cwd=cwd, env=env,
+                                   universal_newlines=True)
+
+
+def loaded_gui_modules():
+    return '''
+import sys
+print(sorted(m for m in sys.modules if m.split('.')[0] in {}))
+'''.format(GUI_MODULES)
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_lesim_imports(self):
+        code = '''
+import importlib.util
+spec = importlib.util.spec_from_file_location('lesim', 'lesim.py')
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+''' + loaded_gui_modules()
+        self.assertEqual(run_python(code).strip(), "[]")
+
+    def test_import_time(self):
+        code = '''
+import time
+t0 = time.perf_counter()
+import LsScript, LsStore, LsProfile, LsBench, LsServer
+print(time.perf_counter() - t0)
+'''
+        # Best of three, to not fail on a single slow start
+        import_time = min(float(run_python(code)) for _ in range(3))
+        self.assertLess(import_time, MAX_IMPORT_TIME)
+
+    def test_export_only_script(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            code = '''
+import LsScript
+script_obj = LsScript.LsScript({!r})
+script_obj.postproc(script_obj.run())
+'''.format(export_script) + loaded_gui_modules()
+            self.assertEqual(run_python(code, tmpdir).strip(), "[]")
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, "v_export.csv")))
@@ -0,0 +1,179 @@
+import os
+import tempfile
+import unittest
+from array import array
+
+import LsScript
+import LsStore
+import LsUtil
+from LsHistory import CodedHistory, encode
+from LsOutput import ScriptOutput
+from LsExceptions import LsEvalException
+
+
+script = '''
+@parameters
+{
+'subjects'          : 3,
+'mechanism'         : 'GA',
+'behaviors'         : ['R0','R1','R2'],
+'stimulus_elements' : ['S1','S2','reward','new trial'],
+'beta'              : 1,
+'u'                 : {'reward':10, 'default': 0},
+'omit_learning'     : ['new trial']
+}
+
+@phase {'label':'train', 'end':'reward=40'}
+NEW_TRIAL 'new trial' | STIMULUS
+STIMULUS  ('S1','S2') | R1: REWARD | R2: STIMULUS_2 | NEW_TRIAL
+STIMULUS_2 'S2'       | R1: REWARD | NEW_TRIAL
+REWARD    'reward'    | NEW_TRIAL
+
+@phase {'label':'test', 'end':'new trial=20'}
+NEW_TRIAL 'new trial' | STIMULUS
+STIMULUS  'S1'        | NEW_TRIAL
+
+@run {'label':'run1'}
+
+@run {'label':'run2', 'phases':'train'}
+'''
+
+EVALS = [('v', ('S1', 'R1'), {}),
+         ('v', ('S2', 'R2'), {'subject': 'all'}),
+         ('w', 'S1', {'subject': 1, 'runlabel': 'run2'}),
+         ('p', (('S1', 'S2'), 'R1'), {'phase': 'train', 'beta': 1}),
+         ('p', (('S2',), 'R1'), {'steps': 'S2', 'beta': 1}),
+         ('n', ['S1', 'R1'], {'cumulative': 'on'}),
+         ('n', (('S1', 'S2'), 'R2'), {'steps': ['new trial', 'R0'], 'exact_n': 'on'}),
+         ('n', ('reward', 'new trial'), {'phase': 'test', 'subject': 'all'})]
+
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        self.script_obj = LsScript.LsScript(script)
+        self.simulation_data = self.script_obj.run()
+        fd, self.filename = tempfile.mkstemp(suffix='.lsr')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_roundtrip(self):
+        LsStore.save(self.simulation_data, self.filename)
+        loaded = LsStore.load(self.filename)
+
+        self.assertEqual(list(loaded.run_outputs), ['run1', 'run2'])
+        for run_label, run_output in self.simulation_data.run_outputs.items():
+            loaded_run_output = loaded.run_outputs[run_label]
+            self.assertEqual(loaded_run_output.n_subjects, run_output.n_subjects)
+            for subject, loaded_subject in zip(run_output.output_subjects,
+                                               loaded_run_output.output_subjects):
+                self.assertEqual(list(loaded_subject.history), subject.history)
+                self.assertEqual(loaded_subject.first_step_phase, subject.first_step_phase)
+                self.assertEqual(list(loaded_subject.v), list(subject.v))
+                for key, val in subject.v.items():
+                    self.assertEqual(list(loaded_subject.v[key].values), val.values)
+                    self.assertEqual(list(loaded_subject.v[key].steps), val.steps)
+                for key, val in subject.w.items():
+                    self.assertEqual(list(loaded_subject.w[key].values), val.values)
+
+        for vwpn, arg, evalprops in EVALS:
+            evalprops = dict({'runlabel': 'run1'}, **evalprops)
+            expected = self.simulation_data.vwpn_eval(vwpn, arg, dict(evalprops))
+            actual = loaded.vwpn_eval(vwpn, arg, dict(evalprops))
+            self.assertEqual(actual, expected)
+
+    def test_postcmds_on_loaded(self):
+        LsStore.save(self.simulation_data, self.filename)
+        loaded = LsStore.load(self.filename)
+        postcmds_script = script + '''
+        @vplot ('S1','R1') {'runlabel':'run1'}
+        @nplot ['S1','R1'] {'runlabel':'run2', 'subject':'all'}
+        '''
+        script_obj = LsScript.LsScript(postcmds_script)
+        script_obj.postcmds.run(loaded)
+
+    def test_same_export(self):
+        # The exported text is the same from the simulation, a saved file, other processes and
+        # spilled subjects. v and w start as the int 0, and are then floats.
+        exports = ["@vexport ('S1','R1') {{'subject':0, 'runlabel':'run1', 'filename':'{}'}}",
+                   "@vexport ('S2','R2') {{'subject':'all', 'runlabel':'run1', 'filename':'{}'}}",
+                   "@wexport 'S2' {{'subject':1, 'runlabel':'run2', 'filename':'{}'}}",
+                   "@wexport 'reward' {{'runlabel':'run2', 'filename':'{}'}}"]
+        with tempfile.TemporaryDirectory() as tmp:
+            def export_text(simulation_data, name):
+                filenames = [os.path.join(tmp, "{0}{1}.csv".format(name, i)).replace('\\', '/')
+                             for i in range(len(exports))]
+                postcmds = "\n".join(export.format(filename)
+                                     for export, filename in zip(exports, filenames))
+                LsScript.LsScript(script + postcmds + "\n").postproc(simulation_data)
+                texts = list()
+                for filename in filenames:
+                    with open(filename) as f:
+                        texts.append(f.read())
+                return texts
+
+            serial = self.script_obj.run(seed=3)
+            LsStore.save(serial, self.filename)
+            expected = export_text(serial, 'serial')
+            self.assertIn("0,0\n", expected[0])
+            self.assertEqual(export_text(LsStore.load(self.filename), 'loaded'), expected)
+            self.assertEqual(export_text(self.script_obj.run(jobs=2, seed=3), 'parallel'),
+                             expected)
+            spilled = self.script_obj.run(seed=3, memory_budget=0, scratch_dir=tmp)
+            self.assertEqual(export_text(spilled, 'spilled'), expected)
+            del spilled
+
+    def test_mixed_values(self):
+        values = LsStore.MixedValues(array('d', [0, 1.5, 2, 0, 0]), array('q', [0, 2, 4]))
+        self.assertEqual([(type(value), value) for value in values],
+                         [(int, 0), (float, 1.5), (int, 2), (float, 0.0), (int, 0)])
+        self.assertEqual([(type(values[i]), values[i]) for i in range(-5, 5)],
+                         [(type(value), value) for value in values] * 2)
+        self.assertEqual(values[1:3], [1.5, 2])
+        self.assertIs(type(values[2:3][0]), int)
+
+    def test_not_a_result_file(self):
+        with open(self.filename, 'w') as f:
+            f.write("@parameters")
+        with self.assertRaises(LsEvalException):
+            LsStore.load(self.filename)
+
+    def test_shared_memory(self):
+        run_outputs = list(self.simulation_data.run_outputs.values())
+        LsStore.save_subject(run_outputs[1].output_subjects[2], self.filename)
+        spilled_subject = LsStore.load_subject(self.filename)
+        spilled_subject.spill_file = self.filename
+        run_outputs[1].output_subjects[2] = spilled_subject
+
+        name, header = LsStore.to_shared_memory(run_outputs)
+        received = LsStore.from_shared_memory((name, header))
+
+        self.assertEqual(len(received), 2)
+        self.assertEqual(received[1].output_subjects[2].spill_file, self.filename)
+        self.assertIsNone(received[1].output_subjects[2].shared_memory)
+        shared = ScriptOutput(dict(zip(['run1', 'run2'], received)))
+        for vwpn, arg, evalprops in EVALS:
+            for run_label in ['run1', 'run2']:
+                if run_label == 'run2' and evalprops.get('phase') == 'test':
+                    continue
+                evalprops = dict(evalprops, runlabel=run_label)
+                expected = self.simulation_data.vwpn_eval(vwpn, arg, dict(evalprops))
+                actual = shared.vwpn_eval(vwpn, arg, dict(evalprops))
+                self.assertEqual(actual, expected)
+
+
+class TestCodedHistory(unittest.TestCase):
+
+    def test_find_and_cumsum(self):
+        history = ['new trial', 'R0', ('S1', 'S2'), 'R1', 'reward', 'R0', 'new trial', 'R0',
+                   ('S1', 'S2'), 'R2', 'S2', 'R1', 'reward', 'R0', 'S1', 'R1']
+        coded = CodedHistory(*encode(history))
+        self.assertEqual(list(coded), history)
+        self.assertEqual(coded[2:6], history[2:6])
+        for pattern in ['S1', 'R1', ('S1', 'S2'), ['S1', 'R1'], [('S1', 'S2'), 'R2', 'S2'],
+                        ['reward', 'new trial'], 'nonexistent']:
+            for exact in [True, False]:
+                self.assertEqual(LsUtil.find_and_cumsum(coded, pattern, exact),
+                                 LsUtil.find_and_cumsum(history, pattern, exact))
@@ -41,6 +41,10 @@ class TestLsUtil(unittest.TestCase):
         with self.assertRaises(Exception):
             dinv = LsUtil.dict_inv(d)
 
+        # Keys in the order of d, once per value
+        d = {'b': ['x', 'y', 'x'], 'a': ['y', 'x']}
+        self.assertEqual(LsUtil.dict_inv(d), {'x': ['b', 'a'], 'y': ['b', 'a']})
+
     def test_find_and_cumsum(self):
         seq = ['a', 'b', ('a', 'b', 'c'), 'a', ('a',), ('a', 'b'), 'b', ('a', 'b'),
                ('a', 'b', 'c', 'd'), 'aa', 'bb', ('aa', 'bb', 'cc'), 'cc']
@@ -146,3 +150,30 @@ class TestLsUtil(unittest.TestCase):
                             if len(pattern[0]) > 1:
                                 findind, cumsum = LsUtil.find_and_cumsum(seq, t, True)
                                 self.assertTrue(findind[i] != 1)
+
+    def test_decimate(self):
+        y = [0, 1, 2]
+        x_out, y_out = LsUtil.decimate(None, y, 10)
+        self.assertEqual(x_out, [0, 1, 2])
+        self.assertEqual(y_out, y)
+
+        y = [(i % 7) - 3 for i in range(10000)]
+        y[5000] = 100
+        y[7001] = -100
+        x_out, y_out = LsUtil.decimate(None, y, 50)
+        self.assertLessEqual(len(y_out), 2 * 50 + 2)
+        self.assertEqual(x_out[0], 0)
+        self.assertEqual(x_out[-1], 9999)
+        self.assertEqual(x_out, sorted(x_out))
+        self.assertEqual(max(y_out), 100)
+        self.assertEqual(min(y_out), -100)
+        self.assertIn(5000, x_out)
+        self.assertIn(7001, x_out)
+        for xi, yi in zip(x_out, y_out):
+            self.assertEqual(y[xi], yi)
+
+        x = [10 * i for i in range(1000)]
+        y = list(range(1000))
+        x_out, y_out = LsUtil.decimate(x, y, 20)
+        self.assertEqual(x_out[-1], 9990)
+        self.assertEqual(y_out[-1], 999)
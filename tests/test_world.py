@@ -164,6 +164,63 @@ class TestPhaseWorld(unittest.TestCase):
     #     with self.assertRaises(TypeError):
     #         s.split(2)
 
+    def test_compound_endcond(self):
+        phase = """CONTEXT context              | 25:US       | CONTEXT
+                   US      ('us','context')     | R: REWARD   | CONTEXT
+                   REWARD  ('reward','context') | CONTEXT"""
+        stimulus_elements = ['context', 'reward', 'us']
+        behaviors = ['R', 'R0']
+
+        # reward=20 is met first
+        pv = {'label': 'compound', 'end': 'reward=20 or context=10000'}
+        phase_obj = make_phase(phase, pv, stimulus_elements, behaviors)
+        self.assertEqual(phase_obj.endphase_obj.items, ['reward', 'context'])
+        self.assertEqual(phase_obj.endphase_obj.limits, [20, 10000])
+        n_rewards = 0
+        s = phase_obj.next_stimulus(None)
+        while s is not None:
+            if 'reward' in s:
+                n_rewards += 1
+            s = phase_obj.next_stimulus('R')
+        self.assertEqual(n_rewards, 20)
+
+        # US=3 is met first, counting the line label
+        pv = {'label': 'compound', 'end': 'reward=20 or US=3'}
+        phase_obj = make_phase(phase, pv, stimulus_elements, behaviors)
+        n_us = 0
+        s = phase_obj.next_stimulus(None)
+        while s is not None:
+            if 'us' in s:
+                n_us += 1
+            s = phase_obj.next_stimulus('R0')
+        self.assertEqual(n_us, 3)
+
+        # The response counts
+        pv = {'label': 'compound', 'end': 'R0=7 or reward=20'}
+        phase_obj = make_phase(phase, pv, stimulus_elements, behaviors)
+        n_steps = 0
+        s = phase_obj.next_stimulus(None)
+        while s is not None:
+            n_steps += 1
+            s = phase_obj.next_stimulus('R0')
+        self.assertEqual(n_steps, 8)
+
+        # Same counts after subject reset
+        phase_obj.subject_reset()
+        n_steps = 0
+        s = phase_obj.next_stimulus(None)
+        while s is not None:
+            n_steps += 1
+            s = phase_obj.next_stimulus('R0')
+        self.assertEqual(n_steps, 8)
+
+        with self.assertRaises(LsParseException):
+            make_phase(phase, {'label': 'compound', 'end': 'reward=20 or foo=2'},
+                       stimulus_elements, behaviors)
+        with self.assertRaises(LsParseException):
+            make_phase(phase, {'label': 'compound', 'end': 'reward=20 or US=x'},
+                       stimulus_elements, behaviors)
+
     def setup_fixed_interval(self):
         phase = """OFF    'lever'   | 4:ON | OFF
                    ON     'lever'   | R: REWARD | ON